@@ -0,0 +1,808 @@
+#!/usr/bin/python3
+#
+# Micro-benchmarks for the hot paths of the sync and generation scripts.
+#
+#   bin/benchmark.py index-db [--packages N]
+#   bin/benchmark.py nevra [--rounds N]
+#   bin/benchmark.py page-data [--packages N]
+#   bin/benchmark.py file-tree [--filelists DB] [--largest N]
+#   bin/benchmark.py catalog [--packages N]
+#   bin/benchmark.py catalog-memory [--packages N]
+#
+# Every benchmark runs against synthetic data created in a temporary
+# directory and compares the current implementation with the code it
+# replaced, so the numbers can be reproduced without network access.
+# file-tree can also run on the largest packages of a synced filelists
+# database. catalog-memory measures the resident memory of the packages in
+# fresh interpreters.
+import argparse
+import contextlib
+import importlib.util
+import io
+import os
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+
+BIN_DIR = Path(__file__).parent
+
+
+def load_script(name):
+    """Import one of the bin/ scripts, whose names are not valid module names."""
+    spec = importlib.util.spec_from_file_location(
+        name.replace("-", "_"), BIN_DIR / f"{name}.py"
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return (time.perf_counter() - start, result)
+
+
+def report(label, seconds, baseline=None):
+    line = f"  {label.ljust(24)} {seconds:9.3f}s"
+    if baseline:
+        line += f"  ({baseline / seconds:.1f}x)"
+    print(line)
+
+
+def make_primary(path, count):
+    """Create a primary.sqlite-like database with count binary packages.
+
+    Returns the name of the source package of every source RPM.
+    """
+    conn = sqlite3.connect(path)
+    conn.execute(
+        """
+        CREATE TABLE packages (
+            pkgKey INTEGER PRIMARY KEY, pkgId TEXT, name TEXT, arch TEXT,
+            version TEXT, epoch TEXT, release TEXT, summary TEXT,
+            description TEXT, url TEXT, rpm_license TEXT, rpm_sourcerpm TEXT
+        )
+        """
+    )
+    rows = []
+    names = {}
+    for key in range(count):
+        # Roughly three subpackages per source package, with the dashes and
+        # digits found in real names.
+        source = f"python-pkg{key // 3}-2"
+        version = f"1.{key % 7}.{key % 13}"
+        release = f"{key % 5 + 1}.fc39"
+        names[f"{source}-{version}-{release}.src.rpm"] = source
+        rows.append(
+            (
+                key + 1,
+                f"{key:064x}",
+                f"{source}-sub{key % 3}",
+                "x86_64" if key % 4 else "noarch",
+                version,
+                "0",
+                release,
+                "Synthetic package",
+                "Synthetic package used for benchmarks.",
+                "https://example.org",
+                "MIT",
+                f"{source}-{version}-{release}.src.rpm",
+            )
+        )
+    conn.executemany(f"INSERT INTO packages VALUES ({', '.join('?' * 12)})", rows)
+    conn.commit()
+    conn.close()
+    return names
+
+
+def legacy_fill_srpm_names(conn, srpm_name):
+    """The per-row, hawkey based index_db loop that fill_srpm_names replaced."""
+    for package_info in conn.execute("SELECT * FROM packages"):
+        conn.execute(
+            "UPDATE packages SET rpm_sourcerpm_name = ? WHERE pkgKey = ?",
+            [srpm_name(package_info["rpm_sourcerpm"]), package_info["pkgKey"]],
+        )
+
+
+def bench_index_db(args, work_dir):
+    fetch = load_script("fetch-repository-dbs")
+    template = os.path.join(work_dir, "template_primary.sqlite")
+    names = make_primary(template, args.packages)
+    if have_hawkey():
+        srpm_name = hawkey_srpm_name
+    else:
+        # The per-row loop is timed without the cost of hawkey's parsing.
+        print("python3-dnf is not installed, using the known names instead.")
+        srpm_name = names.__getitem__
+    print(f"Source RPM names for {args.packages} packages:")
+
+    results = {}
+    baseline = None
+    for label, fill in [
+        ("per-row loop", lambda conn: legacy_fill_srpm_names(conn, srpm_name)),
+        ("bulk executemany", lambda conn: fetch.fill_srpm_names("benchmark", conn)),
+    ]:
+        db = os.path.join(work_dir, "primary.sqlite")
+        shutil.copy(template, db)
+        conn = sqlite3.connect(db)
+        conn.row_factory = sqlite3.Row
+        conn.execute("CREATE INDEX packageSource ON packages (rpm_sourcerpm)")
+        conn.execute("ALTER TABLE packages ADD rpm_sourcerpm_name TEXT")
+        (seconds, _) = timed(fill, conn)
+        conn.commit()
+        results[label] = conn.execute(
+            "SELECT pkgKey, rpm_sourcerpm_name FROM packages ORDER BY pkgKey"
+        ).fetchall()
+        conn.close()
+        report(label, seconds, baseline)
+        baseline = baseline or seconds
+
+    (legacy, bulk) = results.values()
+    if [tuple(row) for row in legacy] != [tuple(row) for row in bulk]:
+        raise SystemExit("!! Results differ between implementations")
+
+
+def hawkey_srpm_name(sourcerpm):
+    from dnf.subject import Subject
+    import hawkey
+
+    subject = Subject(sourcerpm)
+    return subject.get_nevra_possibilities(forms=hawkey.FORM_NEVRA)[0].name
+
+
+def have_hawkey():
+    try:
+        hawkey_srpm_name("bash-5.2.15-5.fc39.src.rpm")
+    except ImportError:
+        return False
+    return True
+
+
+def import_time(statement):
+    """Time a fresh interpreter running statement from the bin/ directory."""
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", statement], cwd=BIN_DIR, check=True)
+    return time.perf_counter() - start
+
+
+def bench_nevra(args, work_dir):
+    import nevra
+
+    with_hawkey = have_hawkey()
+    if with_hawkey:
+        mismatches = 0
+        for sourcerpm in nevra.SOURCE_RPMS:
+            (name, expected) = (nevra.srpm_name(sourcerpm), hawkey_srpm_name(sourcerpm))
+            if name != expected:
+                print(f"!! {sourcerpm}: {name!r} != {expected!r}")
+                mismatches += 1
+    else:
+        print("python3-dnf is not installed, comparing with known names only.")
+        mismatches = nevra.check()
+
+    print("Startup (fresh interpreter):")
+    baseline = None
+    if with_hawkey:
+        baseline = import_time("import dnf.subject, hawkey")
+        report("dnf + hawkey", baseline)
+    report("nevra", import_time("import nevra"), baseline)
+
+    sourcerpms = list(nevra.SOURCE_RPMS) * args.rounds
+    print(f"Parsing {len(sourcerpms)} source RPM names:")
+    baseline = None
+    if with_hawkey:
+        (baseline, _) = timed(lambda: [hawkey_srpm_name(s) for s in sourcerpms])
+        report("hawkey Subject", baseline)
+    (seconds, _) = timed(lambda: [nevra.srpm_name(s) for s in sourcerpms])
+    report("nevra.srpm_name", seconds, baseline)
+
+    if mismatches:
+        raise SystemExit(f"!! {mismatches} names differ")
+
+
+# Libraries of the base system, required by most packages of make_branch.
+BASE_LIBRARIES = 50
+
+
+def make_branch(work_dir, name, count):
+    """Create and index the three databases of a release_branch."""
+    primary = os.path.join(work_dir, f"{name}_primary.sqlite")
+    make_primary(primary, count)
+    conn = sqlite3.connect(primary)
+    conn.executescript(
+        """
+        CREATE TABLE provides (name TEXT, flags TEXT, epoch TEXT, version TEXT,
+            release TEXT, pkgKey INTEGER);
+        CREATE TABLE requires (name TEXT, flags TEXT, epoch TEXT, version TEXT,
+            release TEXT, pkgKey INTEGER, pre BOOLEAN DEFAULT FALSE);
+        """
+    )
+    provides = []
+    requires = []
+    for key in range(1, count + 1):
+        provides += [
+            (f"lib{key}.so", None, key),
+            (f"cap{key % (count // 2 + 1)}", "EQ", key),
+        ]
+        requires += [
+            (f"lib{(key * 7) % count + 1}.so", None, None, key),
+            (f"cap{(key * 3) % (count // 2 + 1)}", "GE", "1.0", key),
+        ]
+        # Most packages also need a few of the libraries of the base system.
+        requires += [
+            (f"lib{(key + n * 13) % BASE_LIBRARIES + 1}.so", None, None, key)
+            for n in range(6)
+        ]
+    conn.executemany(
+        "INSERT INTO provides (name, flags, pkgKey) VALUES (?, ?, ?)", provides
+    )
+    conn.executemany(
+        "INSERT INTO requires (name, flags, version, pkgKey) VALUES (?, ?, ?, ?)",
+        requires,
+    )
+    conn.commit()
+    conn.close()
+
+    for (db_type, table, columns) in [
+        ("filelists", "filelist", "dirname TEXT, filenames TEXT, filetypes TEXT"),
+        ("other", "changelog", "author TEXT, date INTEGER, changelog TEXT"),
+    ]:
+        conn = sqlite3.connect(os.path.join(work_dir, f"{name}_{db_type}.sqlite"))
+        conn.execute("CREATE TABLE packages (pkgKey INTEGER PRIMARY KEY, pkgId TEXT)")
+        conn.execute(f"CREATE TABLE {table} (pkgKey INTEGER, {columns})")
+        conn.executemany(
+            "INSERT INTO packages VALUES (?, ?)",
+            [(key, f"{key - 1:064x}") for key in range(1, count + 1)],
+        )
+        if table == "filelist":
+            rows = [
+                (key, f"/usr/share/pkg{key}/{sub}", "a/b/c/d", "fffd")
+                for key in range(1, count + 1)
+                for sub in range(4)
+            ]
+        else:
+            author = "Packager <packager@example.org> - 1.0-1"
+            rows = [
+                (key, author, 1600000000 + n, "- Rebuilt")
+                for key in range(1, count + 1)
+                for n in range(5)
+            ]
+        conn.executemany(f"INSERT INTO {table} VALUES (?, ?, ?, ?)", rows)
+        conn.commit()
+        conn.close()
+
+    fetch = load_script("fetch-repository-dbs")
+    for db_type in ["primary", "filelists", "other"]:
+        fetch.index_db(name, os.path.join(work_dir, f"{name}_{db_type}.sqlite"))
+
+
+def legacy_page_data(conns, pkg_key):
+    """The four per-page queries that BranchLoader replaced."""
+    files = conns["filelist"].execute(
+        "SELECT * FROM filelist WHERE pkgKey = ?", (pkg_key,)
+    ).fetchall()
+    changelog = conns["other"].execute(
+        "SELECT * FROM changelog WHERE pkgKey = ?", (pkg_key,)
+    ).fetchall()
+    provides = [
+        row["name"]
+        for row in conns["primary"].execute(
+            "SELECT name FROM provides where pkgkey = ? GROUP BY name", (pkg_key,)
+        )
+    ]
+    requires = conns["primary"].execute(
+        """
+        SELECT requires.flags, requires.version, requires.release, packages.rpm_sourcerpm_name, packages.name AS provides FROM requires
+        INNER JOIN provides ON requires.name=provides.name
+        INNER JOIN packages ON provides.pkgkey=packages.pkgkey
+        WHERE requires.pkgkey = ?
+        GROUP BY packages.name
+        """,
+        (pkg_key,),
+    ).fetchall()
+    return (files, changelog, provides, requires)
+
+
+def bench_page_data(args, work_dir):
+    with contextlib.redirect_stdout(io.StringIO()):
+        make_branch(work_dir, "fedora-39", args.packages)
+    generate = load_script("generate-html")
+    generate.DBS_DIR = work_dir
+    conns = {
+        "primary": generate.open_db_readonly("fedora-39_primary.sqlite"),
+        "filelist": generate.open_db_readonly("fedora-39_filelists.sqlite"),
+        "other": generate.open_db_readonly("fedora-39_other.sqlite"),
+    }
+    pkg_keys = list(range(1, args.packages + 1))
+    print(f"Page data of {args.packages} packages:")
+
+    # Pages used to be rendered in source package order, which has nothing
+    # to do with pkgKey order.
+    page_order = list(pkg_keys)
+    random.Random(0).shuffle(page_order)
+    (baseline, legacy) = timed(
+        lambda: {pkg_key: legacy_page_data(conns, pkg_key) for pkg_key in page_order}
+    )
+    report(f"per page ({4 * len(pkg_keys)} queries)", baseline)
+
+    loader = generate.BranchLoader(conns["primary"], conns["filelist"], conns["other"])
+    window = generate.LOAD_WINDOW
+
+    def load_all(loader):
+        data = {}
+        for start in range(0, len(pkg_keys), window):
+            data.update(loader.load(pkg_keys[start : start + window]))
+        return data
+
+    (seconds, batched) = timed(lambda: load_all(loader))
+    report(f"batched ({loader.queries} queries)", seconds, baseline)
+
+    # Databases synced before resolved_requires existed resolve requirements
+    # with a join on every batch.
+    joined = generate.BranchLoader(conns["primary"], conns["filelist"], conns["other"])
+    joined.resolved = False
+    unresolved = load_all(joined)
+    print("Requirements of the batched loads:")
+    report("joined", joined.dependency_seconds)
+    report("resolved_requires", loader.dependency_seconds, joined.dependency_seconds)
+
+    def as_tuples(rows):
+        return [tuple(row) for row in rows]
+
+    for (pkg_key, (files, changelog, provides, requires)) in legacy.items():
+        data = batched[pkg_key]
+        # Batched requires rows start with the pkgKey they belong to.
+        if (
+            as_tuples(files) != as_tuples(data.files)
+            or as_tuples(changelog) != as_tuples(data.changelog)
+            or provides != data.provides
+            or as_tuples(requires) != [tuple(row)[1:] for row in data.requires]
+            or as_tuples(data.requires) != as_tuples(unresolved[pkg_key].requires)
+        ):
+            raise SystemExit(f"!! Page data of pkgKey {pkg_key} differs")
+
+
+def legacy_file_tree(entries):
+    """The nested dict tree and recursive flattening build_file_tree replaced."""
+
+    def gen_file_array(dir_representation, data=None):
+        if not data:
+            data = []
+        for dir in sorted(dir_representation):
+            if type(dir_representation[dir]) is str:
+                data.append({"name": dir, "control": "file"})
+            else:
+                data.append({"name": dir, "control": "dir"})
+                data = gen_file_array(dir_representation[dir], data)
+
+        if len(data) != 0:
+            data.append({"control": "exit-list"})
+        return data
+
+    files = {}
+    for entry in entries:
+        filenames = entry["filenames"].split("/")
+        filetype_index = 0
+        for filename in filenames:
+            try:
+                filetype = entry["filetypes"][filetype_index]
+            except Exception:
+                filetype = "?"
+
+            current = files
+            for dir in entry["dirname"].split("/"):
+                if dir != "":
+                    if dir not in current or type(current[dir]) == str:
+                        current[dir] = {}
+                    current = current[dir]
+
+            if filetype == "d" and not filename in current:
+                current[filename] = {}
+            elif filetype != "d":
+                current[filename] = filetype
+            filetype_index += 1
+    return gen_file_array(files)
+
+
+def synthetic_filelists():
+    """Filelist rows shaped like the largest packages of a release."""
+    kernel = []
+    for (n, subsystem) in enumerate(["drivers", "fs", "net", "sound", "crypto"]):
+        for group in range(60):
+            for sub in range(12):
+                dirname = (
+                    f"/lib/modules/6.5.6-300.fc39.x86_64/kernel/{subsystem}"
+                    f"/group{group}/sub{sub}"
+                )
+                names = [f"mod{n}_{group}_{sub}_{i}.ko.xz" for i in range(8)]
+                kernel.append((dirname, names, "f" * len(names)))
+    texlive = []
+    for package in range(900):
+        for kind in ["tex/latex", "doc/latex", "fonts/type1/public"]:
+            dirname = f"/usr/share/texlive/texmf-dist/{kind}/pkg{package}"
+            names = [f"file{i}.sty" for i in range(40)]
+            texlive.append((dirname, names, "f" * len(names)))
+    firmware = []
+    for vendor in range(200):
+        dirname = f"/usr/lib/firmware/vendor{vendor}"
+        names = [f"fw{i}.bin.xz" for i in range(150)] + ["blobs"]
+        firmware.append((dirname, names, "f" * 150 + "d"))
+        firmware.append((f"{dirname}/blobs", ["a.bin", "b.bin"], "ff"))
+    return {
+        name: [
+            {"dirname": dirname, "filenames": "/".join(names), "filetypes": types}
+            for (dirname, names, types) in rows
+        ]
+        for (name, rows) in [
+            ("kernel-modules", kernel),
+            ("texlive", texlive),
+            ("linux-firmware", firmware),
+        ]
+    }
+
+
+def real_filelists(path, largest):
+    """Filelist rows of the largest packages of a filelists database."""
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    keys = conn.execute(
+        """
+        SELECT pkgKey FROM filelist GROUP BY pkgKey
+        ORDER BY SUM(LENGTH(filetypes)) DESC LIMIT ?
+        """,
+        (largest,),
+    ).fetchall()
+    packages = {}
+    for (pkg_key,) in keys:
+        packages[f"pkgKey {pkg_key}"] = conn.execute(
+            "SELECT * FROM filelist WHERE pkgKey = ?", (pkg_key,)
+        ).fetchall()
+    conn.close()
+    return packages
+
+
+def bench_file_tree(args, work_dir):
+    generate = load_script("generate-html")
+    if args.filelists:
+        packages = real_filelists(args.filelists, args.largest)
+    else:
+        packages = synthetic_filelists()
+
+    # A package is rendered once per branch it is in.
+    branches = 3
+    for (name, entries) in packages.items():
+        count = sum(len(entry["filetypes"]) for entry in entries)
+        print(f"File tree of {name} ({count} files, {branches} branches):")
+        (baseline, legacy) = timed(
+            lambda: [legacy_file_tree(entries) for _ in range(branches)]
+        )
+        report("nested dicts", baseline)
+        generate.dir_prefixes.cache_clear()
+        (seconds, built) = timed(
+            lambda: [generate.build_file_tree(entries) for _ in range(branches)]
+        )
+        report("build_file_tree", seconds, baseline)
+        if built != legacy:
+            raise SystemExit(f"!! File tree of {name} differs")
+
+
+# Release_branches of the catalog benchmark, with the fraction of the
+# packages of rawhide each of them has.
+CATALOG_BRANCHES = {
+    "fedora-rawhide": 1.0,
+    "fedora-39": 0.9,
+    "fedora-39-updates": 0.3,
+    "fedora-39-updates-testing": 0.05,
+    "fedora-38": 0.85,
+    "fedora-38-updates": 0.3,
+}
+
+
+def make_catalog_branches(work_dir, count):
+    """Create the primary databases of CATALOG_BRANCHES, as synced."""
+    fetch = load_script("fetch-repository-dbs")
+    for (release_branch, fraction) in CATALOG_BRANCHES.items():
+        path = os.path.join(work_dir, f"{release_branch}_primary.sqlite")
+        make_primary(path, int(count * fraction))
+        conn = sqlite3.connect(path)
+        conn.execute("CREATE INDEX packagename ON packages (name)")
+        conn.execute("CREATE INDEX packageSource ON packages (rpm_sourcerpm)")
+        conn.execute("ALTER TABLE packages ADD rpm_sourcerpm_name TEXT")
+        fetch.fill_srpm_names(release_branch, conn)
+        conn.commit()
+        conn.close()
+        # Only their presence is checked.
+        for db_type in ["filelists", "other"]:
+            Path(work_dir, f"{release_branch}_{db_type}.sqlite").touch()
+
+
+class LegacyPackage:
+    """The Package of generate-html.py and update-solr.py, before slots."""
+
+    def __init__(self, name):
+        self.name = name
+        self.summary = "No summary specified."
+        self.description = "No description specified."
+
+        self.license = "unknown"
+        self.upstream = ""
+        self.maintainers = []
+        self.releases = {}
+        self.source = ""
+
+    def set_release(self, name, pkgKey, branch, arch, revision, human_name=None):
+        if name not in self.releases:
+            self.releases[name] = {}
+            self.releases[name]["branches"] = {}
+
+        self.releases[name]["branches"][branch] = {}
+        self.releases[name]["branches"][branch]["revision"] = revision
+        self.releases[name]["branches"][branch]["pkg_key"] = pkgKey
+        self.releases[name]["branches"][branch]["arch"] = arch
+        self.releases[name]["human_name"] = human_name or name
+
+    def get_release(self, name):
+        return self.releases[name]["branches"]
+
+
+def package_state(pkg):
+    """What templates and update-solr.py read of a package."""
+    return (
+        pkg.name,
+        pkg.source,
+        pkg.summary,
+        pkg.description,
+        pkg.license,
+        pkg.upstream,
+        pkg.maintainers,
+        pkg.releases,
+        {release: pkg.get_release(release) for release in pkg.releases},
+    )
+
+
+def legacy_catalog(work_dir, databases, release_mapping, maintainer_mapping):
+    """The scan of every primary database generate-html.py used to run."""
+    catalog = load_script("catalog")
+    packages = {}
+    for release_branch in databases:
+        conn = sqlite3.connect(
+            os.path.join(work_dir, databases[release_branch]["primary"])
+        )
+        conn.row_factory = sqlite3.Row
+        for raw in conn.execute("SELECT * FROM packages"):
+            srpm_name = raw["rpm_sourcerpm_name"]
+            pkg = packages.setdefault(srpm_name, {}).get(raw["name"])
+            first_pkg_encounter = pkg is None
+            if first_pkg_encounter:
+                pkg = packages[srpm_name][raw["name"]] = LegacyPackage(raw["name"])
+                pkg.source = srpm_name
+            if first_pkg_encounter or release_branch == "fedora-rawhide":
+                pkg.summary = raw["summary"]
+                pkg.description = raw["description"]
+                pkg.upstream = raw["url"]
+                pkg.license = raw["rpm_license"]
+                pkg.maintainers = maintainer_mapping["rpms"].get(srpm_name, [])
+            (release, branch) = catalog.split_release_branch(release_branch)
+            pkg.set_release(
+                release,
+                raw["pkgKey"],
+                branch,
+                raw["arch"],
+                "{}-{}".format(raw["version"], raw["release"]),
+                release_mapping.get(release),
+            )
+        conn.close()
+    return packages
+
+
+def bench_catalog(args, work_dir):
+    catalog = load_script("catalog")
+    journal = load_script("journal")
+    make_catalog_branches(work_dir, args.packages)
+    release_mapping = {
+        release_branch: release_branch.title() for release_branch in CATALOG_BRANCHES
+    }
+    maintainer_mapping = {"rpms": {}}
+    databases = catalog.group_databases(work_dir, release_mapping)
+    log = journal.Journal(work_dir)
+    print(f"Package catalog of {len(databases)} release_branches:")
+
+    def load():
+        with contextlib.redirect_stdout(io.StringIO()):
+            package_catalog = catalog.load(work_dir, databases, log)
+        return package_catalog.packages(release_mapping, maintainer_mapping)
+
+    (baseline, legacy) = timed(
+        legacy_catalog, work_dir, databases, release_mapping, maintainer_mapping
+    )
+    report("scan every branch", baseline)
+    (seconds, built) = timed(load)
+    report("catalog, built", seconds, baseline)
+    (seconds, unchanged) = timed(load)
+    report("catalog, unchanged", seconds, baseline)
+
+    # An hourly sync: a few updates land in one release_branch.
+    path = os.path.join(work_dir, databases["fedora-39-updates"]["primary"])
+    conn = sqlite3.connect(path)
+    updated = conn.execute(
+        "SELECT name, arch, rpm_sourcerpm_name FROM packages ORDER BY pkgKey LIMIT 100"
+    ).fetchall()
+    conn.execute(
+        "UPDATE packages SET release = release || '.1', summary = 'Updated'"
+        " WHERE pkgKey <= 100"
+    )
+    conn.commit()
+    conn.close()
+    log.conn.executemany(
+        "INSERT INTO entries (recorded, release_branch, name, arch,"
+        " rpm_sourcerpm_name, change) VALUES (0, 'fedora-39-updates', ?, ?, ?,"
+        " 'updated')",
+        updated,
+    )
+    log.conn.commit()
+    (seconds, changed) = timed(load)
+    report("catalog, one updated", seconds, baseline)
+    rescanned = legacy_catalog(work_dir, databases, release_mapping, maintainer_mapping)
+
+    def as_dicts(packages):
+        return {
+            source: {name: package_state(pkg) for (name, pkg) in subpackages.items()}
+            for (source, subpackages) in packages.items()
+        }
+
+    if as_dicts(built) != as_dicts(legacy) or as_dicts(unchanged) != as_dicts(legacy):
+        raise SystemExit("!! Catalog differs from the scan")
+    if as_dicts(changed) != as_dicts(rescanned):
+        raise SystemExit("!! Updated catalog differs from the scan")
+
+
+def legacy_packages(package_catalog, release_mapping, maintainer_mapping):
+    """Catalog.packages() building the dict based packages it used to."""
+    catalog = load_script("catalog")
+    packages = {}
+    for release_branch in sorted(package_catalog.branches):
+        (release, branch) = catalog.split_release_branch(release_branch)
+        human_name = release_mapping.get(release)
+        for (pkg_key, name, source, arch, revision) in package_catalog.branches[
+            release_branch
+        ][1]:
+            pkg = packages.setdefault(source, {}).get(name)
+            if pkg is None:
+                pkg = packages[source][name] = LegacyPackage(name)
+                pkg.source = source
+                (pkg.summary, pkg.description, pkg.upstream, pkg.license) = (
+                    package_catalog.metadata[(source, name)]
+                )
+                pkg.maintainers = maintainer_mapping["rpms"].get(source, [])
+            pkg.set_release(release, pkg_key, branch, arch, revision, human_name)
+    return packages
+
+
+def resident_memory():
+    with open("/proc/self/statm") as fh:
+        return int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def measure_packages(work_dir, representation):
+    """Print the memory the packages of the catalog in work_dir take.
+
+    Run in a fresh interpreter, see bench_catalog_memory(). The catalog is
+    loaded first and kept, as generate-html.py does, so only the packages
+    built from it are measured.
+    """
+    import gc
+
+    catalog = load_script("catalog")
+    package_catalog = catalog.Catalog(work_dir)
+    release_mapping = {
+        release_branch: release_branch.title() for release_branch in CATALOG_BRANCHES
+    }
+    maintainer_mapping = {"rpms": {}}
+    gc.collect()
+    before = resident_memory()
+    if representation == "compact":
+        packages = package_catalog.packages(release_mapping, maintainer_mapping)
+    else:
+        with catalog.gc_paused():
+            packages = legacy_packages(
+                package_catalog, release_mapping, maintainer_mapping
+            )
+    gc.collect()
+    count = sum(len(subpackages) for subpackages in packages.values())
+    print(resident_memory() - before, count)
+
+
+def bench_catalog_memory(args, work_dir):
+    catalog = load_script("catalog")
+    journal = load_script("journal")
+    make_catalog_branches(work_dir, args.packages)
+    release_mapping = dict.fromkeys(CATALOG_BRANCHES)
+    databases = catalog.group_databases(work_dir, release_mapping)
+    with contextlib.redirect_stdout(io.StringIO()):
+        catalog.load(work_dir, databases, journal.Journal(work_dir))
+
+    print(f"Resident memory of the packages of {len(databases)} release_branches:")
+    baseline = None
+    for (label, representation) in [("dicts", "legacy"), ("slots", "compact")]:
+        output = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "import benchmark; benchmark.measure_packages"
+                f"({work_dir!r}, {representation!r})",
+            ],
+            cwd=BIN_DIR,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        (size, count) = (int(value) for value in output.split())
+        line = (
+            f"  {label.ljust(24)} {size / 2**20:8.1f} MiB"
+            f"  ({size / count:.0f} bytes per package)"
+        )
+        if baseline:
+            line += f"  ({baseline / size:.1f}x smaller)"
+        print(line)
+        baseline = baseline or size
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark hot paths of fedora-packages-static"
+    )
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    index_db = subparsers.add_parser(
+        "index-db", help="source RPM name derivation in index_db"
+    )
+    index_db.add_argument("--packages", type=int, default=60000)
+    index_db.set_defaults(func=bench_index_db)
+
+    nevra = subparsers.add_parser(
+        "nevra", help="nevra module against hawkey: results, startup and throughput"
+    )
+    nevra.add_argument("--rounds", type=int, default=5000)
+    nevra.set_defaults(func=bench_nevra)
+
+    page_data = subparsers.add_parser(
+        "page-data", help="per page queries against batched loading in generate-html"
+    )
+    page_data.add_argument("--packages", type=int, default=20000)
+    page_data.set_defaults(func=bench_page_data)
+
+    file_tree = subparsers.add_parser(
+        "file-tree", help="file tree of the largest packages in generate-html"
+    )
+    file_tree.add_argument(
+        "--filelists", help="filelists database to take the packages from"
+    )
+    file_tree.add_argument("--largest", type=int, default=5)
+    file_tree.set_defaults(func=bench_file_tree)
+
+    catalog = subparsers.add_parser(
+        "catalog", help="package catalog against scanning every primary database"
+    )
+    catalog.add_argument("--packages", type=int, default=60000)
+    catalog.set_defaults(func=bench_catalog)
+
+    catalog_memory = subparsers.add_parser(
+        "catalog-memory", help="memory of the packages built from the catalog"
+    )
+    catalog_memory.add_argument("--packages", type=int, default=60000)
+    catalog_memory.set_defaults(func=bench_catalog_memory)
+
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory(prefix="benchmark-") as work_dir:
+        args.func(args, work_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,425 @@
+#
+# Catalog of the packages of the synced repositories, shared by
+# generate-html.py and update-solr.py.
+#
+# The catalog maps every source package to its subpackages and the
+# release_branches they are in. It is kept in $(DB_DIR)/.sync/catalog.pickle
+# and brought up to date from the change journal: only the release_branches
+# whose primary database changed are read again, and only the packages the
+# journal lists get their summary and description looked up. Without a
+# catalog, or after a journal entry asking for everything, it is built from
+# scratch.
+#
+# Naming conventions used in this module:
+#   * release: fedora-31, epel-7, ...
+#   * branch: base (= none), updates, updates-testing
+#   * release_branch: fedora-31, fedora-31-updates, fedora-31-updates-testing, ...
+import contextlib
+import gc
+import os
+import pickle
+import re
+import sqlite3
+import sys
+import time
+
+from collections import defaultdict
+from pathlib import Path
+
+CATALOG_FILE = os.path.join(".sync", "catalog.pickle")
+CATALOG_VERSION = 1
+JOURNAL_CONSUMER = "catalog"
+
+# Summaries and descriptions come from rawhide when a package is there, from
+# the first release_branch in sorted order otherwise.
+RAWHIDE = "fedora-rawhide"
+
+DB_PATTERN = re.compile(
+    "^(fedora|epel)-([\w|-]+)_(primary|filelists|other).sqlite$"
+)
+RELEASE_BRANCH_PATTERN = re.compile("^([fedora|epel]+-[\w|\d]+)-?([a-z|-]+)?$")
+
+# Columns of the rows kept for every package of a release_branch, and of the
+# metadata kept for every package.
+ROW_COLUMNS = "pkgKey, name, rpm_sourcerpm_name, arch, version, release"
+METADATA_COLUMNS = "summary, description, url, rpm_license"
+
+
+class Package:
+    """A binary package and the release_branches it is built in.
+
+    Builds are kept as (branch_id, row) pairs, where branch_id indexes the
+    (release, branch, human_name) entries of a table shared by every package
+    and row is the catalog row of the build, so that a package costs a few
+    tuples instead of three levels of dicts. releases, get_release() and
+    build() give the dicts templates use, built on every call: callers keep
+    the result for as long as they need it.
+    """
+
+    __slots__ = (
+        "name",
+        "source",
+        "summary",
+        "description",
+        "license",
+        "upstream",
+        "maintainers",
+        "should_update",
+        "branch_table",
+        "builds",
+    )
+
+    def __init__(self, name, branch_table):
+        self.name = name
+        self.summary = "No summary specified."
+        self.description = "No description specified."
+
+        self.license = "unknown"
+        self.upstream = ""
+        self.maintainers = []
+        self.source = ""
+        self.should_update = False
+        self.branch_table = branch_table
+        self.builds = ()
+
+    def add_build(self, branch_id, row):
+        """Add the build row of the branch_table entry branch_id.
+
+        A later build of the same entry replaces the earlier one.
+        """
+        builds = self.builds
+        for (index, build) in enumerate(builds):
+            if build[0] == branch_id:
+                self.builds = builds[:index] + ((branch_id, row),) + builds[index + 1 :]
+                return
+        self.builds = builds + ((branch_id, row),)
+
+    @property
+    def releases(self):
+        """{release: {"branches": {branch: build}, "human_name": str}}."""
+        releases = {}
+        for (branch_id, row) in self.builds:
+            (release, branch, human_name) = self.branch_table[branch_id]
+            entry = releases.get(release)
+            if entry is None:
+                entry = releases[release] = {"branches": {}}
+            entry["branches"][branch] = build_info(row)
+            entry["human_name"] = human_name
+        return releases
+
+    def get_release(self, name):
+        branches = {}
+        for (branch_id, row) in self.builds:
+            (release, branch, _) = self.branch_table[branch_id]
+            if release == name:
+                branches[branch] = build_info(row)
+        if not branches:
+            raise KeyError(name)
+        return branches
+
+    def build(self, release, branch):
+        """Return the build in release and branch, like get_release()[branch]."""
+        for (branch_id, row) in self.builds:
+            if self.branch_table[branch_id][:2] == (release, branch):
+                return build_info(row)
+        raise KeyError((release, branch))
+
+    def human_name(self, release):
+        """Return the name release is shown with, like releases[...]["human_name"]."""
+        for (branch_id, _) in self.builds:
+            (build_release, _, human_name) = self.branch_table[branch_id]
+            if build_release == release:
+                return human_name
+        raise KeyError(release)
+
+
+def build_info(row):
+    (pkg_key, _, _, arch, revision) = row
+    return {"revision": revision, "pkg_key": pkg_key, "arch": arch}
+
+
+def open_db_readonly(dbs_dir, db):
+    uri = Path(dbs_dir, db).resolve().as_uri() + "?mode=ro"
+    return sqlite3.connect(uri, uri=True)
+
+
+def split_release_branch(release_branch):
+    """Return (release, branch) of a release_branch, branch "base" if none."""
+    (release, branch) = RELEASE_BRANCH_PATTERN.findall(release_branch)[0]
+    return (release, branch or "base")
+
+
+def group_databases(dbs_dir, release_mapping):
+    """Return {release_branch: {db_type: file name}} of the databases in dbs_dir.
+
+    Only the release_branches of release_mapping are kept. Exits if dbs_dir
+    holds something else than databases, or if one of the three databases of
+    a release_branch is missing.
+    """
+    databases = defaultdict(dict)
+    for db in os.listdir(dbs_dir):
+        # Hidden entries hold the sync state, not databases.
+        if db.startswith("."):
+            continue
+        if not DB_PATTERN.match(db):
+            sys.exit("Invalid object in {}: {}".format(dbs_dir, db))
+
+        (product, branch, db_type) = DB_PATTERN.findall(db)[0]
+        release_branch = "{}-{}".format(product, branch)
+        if release_branch in release_mapping:
+            databases[release_branch][db_type] = db
+
+    for release_branch in databases:
+        for db_type in ["primary", "filelists", "other"]:
+            if db_type not in databases[release_branch]:
+                sys.exit("No {} database for {}.".format(db_type, release_branch))
+    return dict(sorted(databases.items()))
+
+
+@contextlib.contextmanager
+def gc_paused():
+    """Pause the cyclic garbage collector while building many objects.
+
+    The catalog creates hundreds of thousands of dicts and tuples without
+    cycles, which would otherwise trigger full collections over and over.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def identity(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+
+def precedence(release_branches):
+    """Order in which release_branches provide the metadata of packages."""
+    return sorted(
+        release_branches,
+        key=lambda release_branch: (release_branch != RAWHIDE, release_branch),
+    )
+
+
+class Catalog:
+    """Source packages, their subpackages and the release_branches they are in.
+
+    branches holds, for every release_branch, the identity of its primary
+    database when it was read and one (pkgKey, name, source, arch, revision)
+    row per package, in pkgKey order. metadata holds the (summary,
+    description, upstream, license) of every (source, name).
+    """
+
+    def __init__(self, dbs_dir):
+        self.dbs_dir = dbs_dir
+        self.path = os.path.join(dbs_dir, CATALOG_FILE)
+        self.branches = {}
+        self.metadata = {}
+        self.loaded = False
+        try:
+            with open(self.path, "rb") as raw, gc_paused():
+                data = pickle.load(raw)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return
+        if data.get("version") == CATALOG_VERSION:
+            self.branches = data["branches"]
+            self.metadata = data["metadata"]
+            self.loaded = True
+
+    def _read_rows(self, databases, release_branch, metadata=None):
+        """Return (identity, rows) of the primary database of release_branch.
+
+        If metadata is given, the metadata of the packages missing from it is
+        added, or of every package for rawhide.
+        """
+        db = databases[release_branch]["primary"]
+        columns = ROW_COLUMNS
+        if metadata is not None:
+            columns += f", {METADATA_COLUMNS}"
+        conn = open_db_readonly(self.dbs_dir, db)
+        rows = []
+        for raw in conn.execute(f"SELECT {columns} FROM packages ORDER BY pkgKey"):
+            (pkg_key, name, source, arch, version, release) = raw[:6]
+            (name, source) = (sys.intern(name), sys.intern(source))
+            rows.append((pkg_key, name, source, arch, f"{version}-{release}"))
+            # Rawhide is read first; the last of its rows wins, other
+            # release_branches only fill in what is missing.
+            if metadata is not None and (
+                release_branch == RAWHIDE or (source, name) not in metadata
+            ):
+                metadata[(source, name)] = raw[6:]
+        conn.close()
+        return (identity(os.path.join(self.dbs_dir, db)), rows)
+
+    def build(self, databases):
+        """Read every release_branch of databases from scratch."""
+        self.branches = {}
+        self.metadata = {}
+        for release_branch in precedence(databases):
+            print("> Processing database files for {}.".format(release_branch))
+            self.branches[release_branch] = self._read_rows(
+                databases, release_branch, self.metadata
+            )
+
+    def update(self, databases, entries):
+        """Bring the catalog up to date with databases and journal entries.
+
+        entries are the journal entries recorded since the last update, None
+        if they are not known. Returns the number of release_branches read
+        again or dropped.
+        """
+        if not self.loaded or entries is None or any(
+            entry.change == "full" and entry.release_branch is None
+            for entry in entries
+        ):
+            self.build(databases)
+            return len(databases)
+
+        dirty = set()
+        full_branches = set()
+        for entry in entries:
+            if entry.change == "full":
+                full_branches.add(entry.release_branch)
+            else:
+                dirty.add((entry.rpm_sourcerpm_name, entry.name))
+
+        read = 0
+        for release_branch in list(self.branches):
+            if release_branch not in databases:
+                (_, rows) = self.branches.pop(release_branch)
+                dirty.update((row[2], row[1]) for row in rows)
+                read += 1
+
+        # The rows of every release_branch whose primary database changed are
+        # read again, pkgKeys are not stable from one sync to the next. The
+        # metadata of its packages is only looked up again if the journal
+        # lists them, or asked for the whole release_branch.
+        for release_branch in databases:
+            path = os.path.join(self.dbs_dir, databases[release_branch]["primary"])
+            known = self.branches.get(release_branch)
+            full = known is None or release_branch in full_branches
+            if not full and known[0] == identity(path):
+                continue
+
+            print("> Processing database files for {}.".format(release_branch))
+            self.branches[release_branch] = self._read_rows(databases, release_branch)
+            read += 1
+            if full:
+                for (_, rows) in (known or (None, []), self.branches[release_branch]):
+                    dirty.update((row[2], row[1]) for row in rows)
+
+        self._refresh_metadata(databases, dirty)
+        return read
+
+    def _refresh_metadata(self, databases, keys):
+        """Look up the metadata of keys again, forget those of gone packages."""
+        if not keys:
+            return
+        # First release_branch of every key, in precedence order.
+        located = {}
+        for release_branch in precedence(self.branches):
+            for row in self.branches[release_branch][1]:
+                key = (row[2], row[1])
+                if key in keys:
+                    located.setdefault(key, release_branch)
+
+        conns = {}
+        for key in keys:
+            if key not in located:
+                self.metadata.pop(key, None)
+                continue
+            release_branch = located[key]
+            if release_branch not in conns:
+                conns[release_branch] = open_db_readonly(
+                    self.dbs_dir, databases[release_branch]["primary"]
+                )
+            order = "DESC" if release_branch == RAWHIDE else "ASC"
+            raw = conns[release_branch].execute(
+                f"""
+                SELECT {METADATA_COLUMNS} FROM packages
+                WHERE name = ? AND rpm_sourcerpm_name = ?
+                ORDER BY pkgKey {order} LIMIT 1
+                """,
+                (key[1], key[0]),
+            ).fetchone()
+            self.metadata[key] = tuple(raw)
+        for conn in conns.values():
+            conn.close()
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp = f"{self.path}.tmp"
+        with open(temp, "wb") as fh:
+            pickle.dump(
+                {
+                    "version": CATALOG_VERSION,
+                    "branches": self.branches,
+                    "metadata": self.metadata,
+                },
+                fh,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+        os.replace(temp, self.path)
+
+    def names(self, release_branch):
+        """Return the (source, name) of the packages of release_branch."""
+        if release_branch not in self.branches:
+            return set()
+        return {(row[2], row[1]) for row in self.branches[release_branch][1]}
+
+    def packages(self, release_mapping, maintainer_mapping=None):
+        """Return {source: {name: Package}} of every package of the catalog."""
+        with gc_paused():
+            return self._packages(release_mapping, maintainer_mapping)
+
+    def _packages(self, release_mapping, maintainer_mapping):
+        packages = {}
+        branch_table = []
+        for release_branch in sorted(self.branches):
+            (release, branch) = split_release_branch(release_branch)
+            branch_id = len(branch_table)
+            branch_table.append(
+                (release, branch, release_mapping.get(release) or release)
+            )
+            for row in self.branches[release_branch][1]:
+                (name, source) = row[1:3]
+                subpackages = packages.get(source)
+                if subpackages is None:
+                    subpackages = packages[source] = {}
+                pkg = subpackages.get(name)
+                if pkg is None:
+                    pkg = subpackages[name] = Package(name, branch_table)
+                    pkg.source = source
+                    (pkg.summary, pkg.description, pkg.upstream, pkg.license) = (
+                        self.metadata[(source, name)]
+                    )
+                    if maintainer_mapping is not None:
+                        pkg.maintainers = maintainer_mapping["rpms"].get(source, [])
+                pkg.add_build(branch_id, row)
+        return packages
+
+
+def load(dbs_dir, databases, journal, save=True):
+    """Return the Catalog of databases, updated and saved if needed.
+
+    Without save, the catalog is only brought up to date in memory and the
+    journal entries are left pending.
+    """
+    start = time.perf_counter()
+    catalog = Catalog(dbs_dir)
+    (journal_seq, entries) = journal.pending(JOURNAL_CONSUMER)
+    with gc_paused():
+        read = catalog.update(databases, entries)
+    if save:
+        if read or entries:
+            catalog.save()
+        journal.advance(JOURNAL_CONSUMER, journal_seq)
+    print(
+        f"> Loaded the package catalog in {time.perf_counter() - start:.2f}s"
+        f" ({read} of {len(databases)} release_branches read)"
+    )
+    return catalog
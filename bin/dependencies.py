@@ -0,0 +1,195 @@
+#
+# Dependency links of the package pages generate-html.py rendered.
+#
+# The page of a package links to the providers of its requirements and to
+# the packages requiring it, as resolved by the sync in the resolved_requires
+# table of each primary database. When a provider is added, removed or moves
+# to another source package, the journal only lists the provider, while the
+# pages linking to it change too.
+#
+# The links every page was last rendered with are kept here, one row per
+# release_branch, dependent and provider. When the primary database of a
+# release_branch changes, its links are read again and compared with the
+# known ones: both ends of every link added or removed have to be
+# regenerated. The new links are only stored by commit(), once the pages
+# are rendered, so an interrupted run compares them again.
+import json
+import os
+import sqlite3
+import time
+
+from pathlib import Path
+
+from catalog import identity
+
+LINKS_FILE = os.path.join(".sync", "dependencies.sqlite")
+
+LINK_COLUMNS = "dependent_srpm, dependent_name, provider_srpm, provider_name"
+
+
+class DependencyIndex:
+    def __init__(self, dbs_dir, readonly=False):
+        """Open the links of dbs_dir.
+
+        With readonly, the links are compared but never stored, and a
+        missing index is treated as empty instead of being created.
+        """
+        self.dbs_dir = dbs_dir
+        path = os.path.join(dbs_dir, LINKS_FILE)
+        if not readonly:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.conn = sqlite3.connect(path)
+        elif os.path.isfile(path):
+            uri = Path(path).resolve().as_uri() + "?mode=ro"
+            self.conn = sqlite3.connect(uri, uri=True)
+        else:
+            self.conn = sqlite3.connect(":memory:")
+        self.conn.executescript(
+            f"""
+            CREATE TABLE IF NOT EXISTS branches (
+                release_branch TEXT PRIMARY KEY,
+                identity TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS links (
+                release_branch TEXT NOT NULL,
+                dependent_srpm TEXT NOT NULL,
+                dependent_name TEXT NOT NULL,
+                provider_srpm TEXT NOT NULL,
+                provider_name TEXT NOT NULL,
+                PRIMARY KEY (release_branch, {LINK_COLUMNS})
+            ) WITHOUT ROWID;
+            CREATE TEMP TABLE fresh (
+                release_branch TEXT NOT NULL,
+                dependent_srpm TEXT NOT NULL,
+                dependent_name TEXT NOT NULL,
+                provider_srpm TEXT NOT NULL,
+                provider_name TEXT NOT NULL,
+                PRIMARY KEY (release_branch, {LINK_COLUMNS})
+            ) WITHOUT ROWID;
+            """
+        )
+        self.known = {
+            release_branch: json.loads(stamp)
+            for (release_branch, stamp) in self.conn.execute(
+                "SELECT release_branch, identity FROM branches"
+            )
+        }
+        # release_branch -> identity of the primary database read by update(),
+        # or None for release_branches to forget.
+        self.read = {}
+
+    def update(self, databases):
+        """Read the links of the release_branches whose primary db changed.
+
+        Returns the (source, name) of the packages at either end of a link
+        added or removed since the links were last committed. Links of a
+        release_branch never seen before are only recorded: its pages are
+        regenerated as a whole, by a 'full' journal entry or a first run.
+        """
+        start = time.perf_counter()
+        linked = set()
+        for release_branch in self.known:
+            if release_branch not in databases:
+                self.read[release_branch] = None
+
+        for release_branch in databases:
+            path = os.path.join(self.dbs_dir, databases[release_branch]["primary"])
+            stamp = identity(path)
+            if self.known.get(release_branch) == stamp:
+                continue
+            self.read[release_branch] = stamp
+            if not self._read_links(release_branch, path):
+                # Synced before resolved_requires existed, its pages have no
+                # links to keep track of.
+                self.read[release_branch] = None
+                continue
+            if release_branch not in self.known:
+                continue
+            # Links added, then links removed.
+            for (new, old) in [
+                ("temp.fresh", "main.links"),
+                ("main.links", "temp.fresh"),
+            ]:
+                rows = self.conn.execute(
+                    f"""
+                    SELECT {LINK_COLUMNS} FROM {new} WHERE release_branch = ?
+                    EXCEPT
+                    SELECT {LINK_COLUMNS} FROM {old} WHERE release_branch = ?
+                    """,
+                    (release_branch, release_branch),
+                )
+                for (dependent_srpm, dependent, provider_srpm, provider) in rows:
+                    linked.add((dependent_srpm, dependent))
+                    linked.add((provider_srpm, provider))
+
+        if self.read:
+            print(
+                f"> Compared the dependency links of {len(self.read)} release_branches"
+                f" in {time.perf_counter() - start:.2f}s"
+                f" ({len(linked)} packages linked to changes)"
+            )
+        return linked
+
+    def _read_links(self, release_branch, path):
+        """Fill temp.fresh with the links of release_branch.
+
+        Returns False if its primary database has no resolved_requires.
+        """
+        self.conn.execute("ATTACH DATABASE ? AS repo", (path,))
+        try:
+            resolved = self.conn.execute(
+                "SELECT 1 FROM repo.sqlite_master WHERE type = 'table'"
+                " AND name = 'resolved_requires'"
+            ).fetchone()
+            if resolved:
+                self.conn.execute(
+                    f"""
+                    INSERT OR IGNORE INTO temp.fresh (release_branch, {LINK_COLUMNS})
+                    SELECT ?, packages.rpm_sourcerpm_name, packages.name,
+                        resolved_requires.provider_srpm,
+                        resolved_requires.provider_name
+                    FROM repo.resolved_requires
+                        INNER JOIN repo.packages
+                            ON resolved_requires.pkgKey = packages.pkgKey
+                    """,
+                    (release_branch,),
+                )
+                self.conn.commit()
+        finally:
+            self.conn.execute("DETACH DATABASE repo")
+        return bool(resolved)
+
+    def commit(self):
+        """Store the links read by update(), to compare with the next ones."""
+        for (release_branch, stamp) in self.read.items():
+            self.conn.execute(
+                "DELETE FROM links WHERE release_branch = ?", (release_branch,)
+            )
+            if stamp is None:
+                self.conn.execute(
+                    "DELETE FROM branches WHERE release_branch = ?", (release_branch,)
+                )
+                continue
+            self.conn.execute(
+                f"""
+                INSERT INTO links (release_branch, {LINK_COLUMNS})
+                SELECT release_branch, {LINK_COLUMNS} FROM temp.fresh
+                WHERE release_branch = ?
+                """,
+                (release_branch,),
+            )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO branches (release_branch, identity)"
+                " VALUES (?, ?)",
+                (release_branch, json.dumps(stamp)),
+            )
+        self.conn.commit()
+        for (release_branch, stamp) in self.read.items():
+            if stamp is None:
+                self.known.pop(release_branch, None)
+            else:
+                self.known[release_branch] = stamp
+        self.read = {}
+
+    def close(self):
+        self.conn.close()
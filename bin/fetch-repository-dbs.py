@@ -9,10 +9,29 @@ import os
 import argparse
 import hashlib
 import sys
+import json
+import threading
+import time
+import lzma
+import zlib
+import bz2
+import random
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from requests.models import HTTPError
 import tqdm
-from dnf.subject import Subject
-import hawkey
+from collections import namedtuple
+
+import repoxml
+import zchunk
+from httpcache import LocalAdapter, ResponseCache, mirror_url
+from journal import Journal
+from nevra import srpm_name
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 repomd_xml_namespace = {
     "repo": "http://linux.duke.edu/metadata/repo",
@@ -20,112 +39,870 @@ repomd_xml_namespace = {
 }
 padding = 22
 
+# Indexes needed by the lookups of generate-html.py, per database type, as
+# (index name, table, columns). Upstream databases already ship some of them,
+# those are detected and not built twice.
+LOOKUP_INDEXES = {
+    "primary": [
+        ("packageSource", "packages", ("rpm_sourcerpm",)),
+        ("packageName", "packages", ("name",)),
+        ("packageId", "packages", ("pkgId",)),
+        ("providesName", "provides", ("name",)),
+        ("providesPkgKey", "provides", ("pkgKey",)),
+        ("requiresPkgKey", "requires", ("pkgKey",)),
+    ],
+    "filelists": [("filelistPkgKey", "filelist", ("pkgKey",))],
+    "other": [("changelogPkgKey", "changelog", ("pkgKey",))],
+}
+
+# Per package content compared between syncs of the filelists and other
+# databases, as (table, columns).
+FINGERPRINTED = {
+    "filelists": ("filelist", ("dirname", "filenames", "filetypes")),
+    "other": ("changelog", ("author", "date", "changelog")),
+}
+
+# A database listed in repomd.xml. checksum and open_checksum are
+# (type, hexdigest) pairs for the compressed and decompressed file, size is
+# the compressed size in bytes or None if repomd.xml does not tell. Zchunk
+# files also come with the checksum and size of their header, or None.
+RepomdEntry = namedtuple(
+    "RepomdEntry",
+    ["href", "checksum", "open_checksum", "size", "header_checksum", "header_size"],
+)
+
 MIRROR = "https://dl.fedoraproject.org"
 KOJI_REPO = "https://kojipkgs.fedoraproject.org/repos"
+PDC_URI = "https://pdc.fedoraproject.org/rest_api/v1/product-versions/"
+# Directory inside --target-dir holding the state of the sync and of the
+# scripts reading its databases.
+STATE_DIR = ".sync"
+# Directory inside STATE_DIR holding the ledger of every repository, and
+# nothing else: ledgers of inactive repositories are deleted from it.
+LEDGER_DIR = os.path.join(STATE_DIR, "state")
+# Directory inside --target-dir keeping the last zchunk file of every
+# database, the base of the next delta download (--zchunk).
+ZCK_DIR = os.path.join(STATE_DIR, "zck")
+# Sync the XML metadata in zchunk format instead of the sqlite databases.
+ZCHUNK = False
 # Enforce, or not, checking the SSL certs
 DL_VERIFY = True
+# Attempts without progress before a download is given up, and the base of
+# the exponential backoff between them, in seconds.
+DL_RETRIES = 5
+DL_BACKOFF = 1.0
+# Seconds without data before a connection is considered dead.
+DL_TIMEOUT = 60
+# HTTP statuses worth retrying, the others skip the file until the next run.
+RETRY_STATUS = {408, 429, 500, 502, 503, 504}
+# Other base URLs serving the content of MIRROR (--extra-mirror). They take
+# over when a transfer fails, and files of at least SPLIT_SIZE bytes are
+# fetched from all of them at once in byte ranges.
+EXTRA_MIRRORS = []
+SPLIT_SIZE = 32 * 1024 * 1024
+
+# Shared by every worker thread so connections to the mirrors are pooled and
+# reused. main() mounts an adapter sized for the number of download workers.
+session = requests.Session()
+# Local copies of repomd.xml and the PDC listing, set up by main().
+response_cache = None
+
 
+def log(message):
+    """Print message from any thread without breaking the progress bars.
 
-def needs_update(local_file, remote_sha, sha_type):
-    """Compare sha of a local and remote file.
-    Return True if our local file needs to be updated.
+    Downloads and processing run in pools of threads, each download with its
+    own bar. tqdm's lock serializes the messages with the bar updates, and
+    the bars are redrawn below the message.
     """
+    with tqdm.tqdm.get_lock():
+        tqdm.tqdm.write(message)
+
+
+def setup_session(pool_size):
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.mount("file://", LocalAdapter())
+
+
+class SyncState:
+    """Ledger of what was last installed for one repository.
+
+    Stored as JSON in <target_dir>/.sync/state/<repository>.json. For every
+    database it records the upstream checksums from repomd.xml and the
+    identity (size, mtime, inode) of the local file as installed, so deciding
+    whether a database changed never requires hashing the local copy, which
+    index_db and gen_db_diff modify anyway.
+
+    Changes are only saved by save(), once the changes of the repository are
+    journaled. A database installed by a run that failed before that no
+    longer matches its recorded identity, and the next run journals its
+    repository for full regeneration (see unjournaled()).
+    """
+
+    def __init__(self, target_dir, name):
+        self.path = os.path.join(target_dir, LEDGER_DIR, f"{name}.json")
+        self.lock = threading.Lock()
+        # Ledgers used to be kept in STATE_DIR itself.
+        legacy = os.path.join(target_dir, STATE_DIR, f"{name}.json")
+        if os.path.isfile(legacy) and not os.path.isfile(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            os.replace(legacy, self.path)
+        try:
+            with open(self.path) as raw:
+                self.data = json.load(raw)
+        except (OSError, ValueError):
+            self.data = {}
+        self.data.setdefault("files", {})
+        # Databases installed or found unchanged by this run.
+        self.current = set()
+        # Databases installed by this run.
+        self.installed = set()
+        # Whether a database was installed by a run that did not journal it.
+        self.untrusted = False
+
+    @staticmethod
+    def identity(path):
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
 
-    if not os.path.isfile(local_file):
-        # If we have never downloaded this before, then obviously it has
-        # "changed"
-        return True
+    def needs_update(self, db, entry, local_file):
+        """Return True if local_file is not the installed copy of entry."""
+        if not os.path.isfile(local_file):
+            # If we have never downloaded this before, then obviously it has
+            # "changed"
+            return True
 
+        recorded = self.data["files"].get(db)
+        if recorded is None:
+            return True
+
+        return (
+            recorded["checksum"] != list(entry.checksum)
+            or recorded["open_checksum"] != list(entry.open_checksum)
+            or recorded["identity"] != self.identity(local_file)
+        )
+
+    def unjournaled(self, db, local_file):
+        """Return True if local_file changed since it was last recorded."""
+        recorded = self.data["files"].get(db)
+        return (
+            recorded is not None
+            and os.path.isfile(local_file)
+            and recorded["identity"] != self.identity(local_file)
+        )
+
+    def set_revision(self, revision):
+        with self.lock:
+            self.data["revision"] = revision
+
+    def record(self, db, entry, local_file):
+        """Record local_file as the installed copy of entry."""
+        with self.lock:
+            self.data["files"][db] = {
+                "href": entry.href,
+                "checksum": list(entry.checksum),
+                "open_checksum": list(entry.open_checksum),
+                "identity": self.identity(local_file),
+            }
+            self.current.add(db)
+            self.installed.add(db)
+
+    def keep(self, db, local_file):
+        """Record that local_file is still the installed copy of its entry."""
+        self.refresh(db, local_file)
+        with self.lock:
+            self.current.add(db)
+
+    def refresh(self, db, local_file):
+        """Update the recorded identity of a file we modified ourselves."""
+        with self.lock:
+            recorded = self.data["files"].get(db)
+            identity = self.identity(local_file)
+            if recorded is not None and recorded["identity"] != identity:
+                recorded["identity"] = identity
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp = f"{self.path}.tmp"
+        with open(temp, "w") as fh:
+            json.dump(self.data, fh, indent=2)
+        os.replace(temp, self.path)
+
+
+class ChecksumError(Exception):
+    """Downloaded data does not match the checksum announced in repomd.xml."""
+
+
+def new_hash(sha_type):
     # Old old epel5 doesn't even know which sha it is using..
     if sha_type == "sha":
         sha_type = "sha1"
+    return getattr(hashlib, sha_type)()
+
+
+def get_decompressor(archive):
+    """Return an incremental decompressor for the given archive name."""
+    if archive.endswith(".xz"):
+        return lzma.LZMADecompressor()
+    elif archive.endswith(".gz"):
+        return zlib.decompressobj(zlib.MAX_WBITS | 16)
+    elif archive.endswith(".bz2"):
+        return bz2.BZ2Decompressor()
+    elif archive.endswith(".zst"):
+        if zstandard is None:
+            raise NotImplementedError(f"{archive} (python3-zstandard is missing)")
+        return zstandard.ZstdDecompressor().decompressobj()
+    else:
+        raise NotImplementedError(archive)
 
-    hash = getattr(hashlib, sha_type)()
-    with open(local_file, "rb") as f:
-        hash.update(f.read())
 
-    local_sha = hash.hexdigest()
-    if local_sha != remote_sha:
-        return True
+def mirror_urls(url):
+    """Return url followed by the same file on every extra mirror."""
+    if not url.startswith(MIRROR):
+        return [url]
+    path = url[len(MIRROR) :]
+    return [url] + [f"{mirror}{path}" for mirror in EXTRA_MIRRORS]
 
-    return False
 
+def is_transient(err):
+    if isinstance(err, HTTPError):
+        return err.response is not None and err.response.status_code in RETRY_STATUS
+    return isinstance(
+        err,
+        (
+            requests.ConnectionError,
+            requests.Timeout,
+            requests.exceptions.ChunkedEncodingError,
+        ),
+    )
 
-def download_db(name, repomd_url, archive):
-    print(f"{name.ljust(padding)} Downloading file: {repomd_url} to {archive}")
-    response = requests.get(repomd_url, verify=DL_VERIFY, stream=True)
-    response.raise_for_status()
-    with tqdm.tqdm.wrapattr(
-        open(archive, "wb"),
-        "write",
-        desc=repomd_url.split("/")[-1],
-        total=int(response.headers.get("content-length", 0)),
-    ) as stream:
-        for chunk in response.iter_content(chunk_size=1024 * 1024):
-            stream.write(chunk)
 
+def backoff_delay(failures):
+    """Seconds to wait after the given number of consecutive failures."""
+    return DL_BACKOFF * 2 ** (failures - 1) * random.uniform(0.5, 1.5)
 
-def decompress_db(name, archive, location):
-    """Decompress the given XZ archive at the specified location."""
-    print(f"{name.ljust(padding)} Extracting {archive} to {location}")
-    if archive.endswith(".xz"):
-        import lzma
 
-        with lzma.open(archive) as inp, open(location, "wb") as out:
-            out.write(inp.read())
-    elif archive.endswith(".tar.gz"):
-        import tarfile
+def retrying(name, request, *args, **kwargs):
+    """Call request(*args, **kwargs), retrying transient errors.
 
-        with tarfile.open(archive) as tar:
-            tar.extractall(path=location)
-    elif archive.endswith(".gz"):
-        import gzip
+    Meant for small requests (repomd.xml, PDC, HEAD probes) whose response
+    is read at once; large files go through stream_range.
+    """
+    failures = 0
+    while True:
+        try:
+            response = request(*args, **kwargs)
+            if response.status_code in RETRY_STATUS:
+                response.raise_for_status()
+            return response
+        except requests.RequestException as err:
+            failures += 1
+            if not is_transient(err) or failures > DL_RETRIES:
+                raise
+            delay = backoff_delay(failures)
+            log(f"{name.ljust(padding)} {err}, retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+
+def stream_range(name, urls, start, end, consume):
+    """Feed bytes start to end (inclusive, None for the end of the file) of
+    the file at urls to consume, chunk by chunk.
+
+    A transfer broken by a transient error is resumed where it stopped with
+    a Range request, after an exponential backoff and from the next of urls,
+    which must all serve the same file. A mirror answering with a permanent
+    error is dropped while others are left. Servers ignoring Range are
+    handled by skipping the bytes already consumed.
+    """
+    urls = list(urls)
+    offset = start
+    attempt = 0
+    failures = 0
+    while True:
+        url = urls[attempt % len(urls)]
+        attempt += 1
+        headers = {}
+        if offset > 0 or end is not None:
+            headers["Range"] = f"bytes={offset}-{'' if end is None else end}"
+
+        before = offset
+        try:
+            with session.get(
+                url, headers=headers, verify=DL_VERIFY, stream=True, timeout=DL_TIMEOUT
+            ) as response:
+                response.raise_for_status()
+                if response.status_code == 206:
+                    # Content-Range: bytes first-last/total
+                    position = int(
+                        response.headers["Content-Range"].split()[1].split("-")[0]
+                    )
+                else:
+                    position = 0
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    if position < offset:
+                        skip = min(len(chunk), offset - position)
+                        position += skip
+                        chunk = chunk[skip:]
+                    if end is not None:
+                        chunk = chunk[: end + 1 - position]
+                    if not chunk:
+                        if end is not None and position > end:
+                            break
+                        continue
+                    consume(chunk)
+                    position += len(chunk)
+                    offset = position
+
+            if end is not None and offset <= end:
+                raise requests.exceptions.ChunkedEncodingError(
+                    f"{url}: transfer ended at byte {offset} of {end + 1}"
+                )
+            return offset - start
+        except requests.RequestException as err:
+            if not is_transient(err):
+                if len(urls) == 1:
+                    raise
+                log(f"{name.ljust(padding)} {err}, dropping {url}")
+                urls.remove(url)
+                continue
+
+            # Only count attempts that made no progress, a slow but working
+            # connection may need many resumes.
+            failures = 0 if offset > before else failures + 1
+            if failures > DL_RETRIES:
+                raise
+            delay = backoff_delay(max(failures, 1))
+            log(
+                f"{name.ljust(padding)} {err}, resuming at byte {offset}"
+                f" in {delay:.1f}s"
+            )
+            time.sleep(delay)
+
+
+def fetch_parts(name, urls, size, location, progress):
+    """Download the file at urls in parallel byte ranges, one per mirror.
+
+    Returns the paths of the downloaded parts, in order.
+    """
+    step = -(-size // len(urls))
+    ranges = [(first, min(first + step, size) - 1) for first in range(0, size, step)]
+    parts = [f"{location}.part{index}" for index in range(len(ranges))]
+
+    def fetch_part(index):
+        # Every range starts on its own mirror and falls back to the others.
+        order = urls[index:] + urls[:index]
+        with open(parts[index], "wb") as out:
+
+            def consume(chunk):
+                out.write(chunk)
+                progress.update(len(chunk))
+
+            stream_range(name, order, *ranges[index], consume)
+
+    with ThreadPoolExecutor(len(ranges), thread_name_prefix="range") as pool:
+        list(pool.map(fetch_part, range(len(ranges))))
+    return parts
+
+
+def fetch_db(name, repomd_url, location, checksum, open_checksum, size=None):
+    """Download, decompress and verify a database.
+
+    The body is fed through an incremental decompressor straight into
+    location, so memory use does not depend on the size of the database.
+    Interrupted transfers are resumed (see stream_range). With extra mirrors
+    configured, files of at least SPLIT_SIZE bytes are fetched in byte
+    ranges from all mirrors at once and decompressed once complete.
+    checksum and open_checksum are (type, hexdigest) pairs from repomd.xml
+    for the compressed and the decompressed data, size the compressed size.
+    """
+    log(f"{name.ljust(padding)} Downloading file: {repomd_url} to {location}")
+    urls = mirror_urls(repomd_url)
+    decompressor = get_decompressor(repomd_url)
+    compressed_hash = new_hash(checksum[0])
+    open_hash = new_hash(open_checksum[0])
+
+    with open(location, "wb") as out, tqdm.tqdm(
+        desc=f"{name} {repomd_url.split('/')[-1]}",
+        total=size or 0,
+        unit="B",
+        unit_scale=True,
+    ) as progress:
+
+        def consume(chunk):
+            compressed_hash.update(chunk)
+            data = decompressor.decompress(chunk)
+            open_hash.update(data)
+            out.write(data)
+
+        if len(urls) > 1 and size and size >= SPLIT_SIZE:
+            parts = fetch_parts(name, urls, size, location, progress)
+            for part in parts:
+                with open(part, "rb") as raw:
+                    for chunk in iter(lambda: raw.read(64 * 1024), b""):
+                        consume(chunk)
+                os.remove(part)
+        else:
+
+            def consume_with_progress(chunk):
+                consume(chunk)
+                progress.update(len(chunk))
+
+            stream_range(name, urls, 0, None, consume_with_progress)
+
+        if hasattr(decompressor, "flush"):
+            data = decompressor.flush()
+            open_hash.update(data)
+            out.write(data)
+
+    if compressed_hash.hexdigest() != checksum[1]:
+        raise ChecksumError(
+            f"{repomd_url}: expected {checksum[1]}, got {compressed_hash.hexdigest()}"
+        )
+    if open_hash.hexdigest() != open_checksum[1]:
+        raise ChecksumError(
+            f"{location}: expected {open_checksum[1]}, got {open_hash.hexdigest()}"
+        )
+
+
+def zck_copy(destfile):
+    """Path of the zchunk file kept for the database installed at destfile."""
+    (target_dir, db) = os.path.split(destfile)
+    return os.path.join(target_dir, ZCK_DIR, db.replace(".sqlite", ".xml.zck"))
 
-        with gzip.open(archive, "rb") as inp, open(location, "wb") as out:
-            out.write(inp.read())
-    elif archive.endswith(".bz2"):
-        import bz2
 
-        with bz2.open(archive) as inp, open(location, "wb") as out:
-            out.write(inp.read())
+def fetch_zck(name, repomd_url, location, entry, previous):
+    """Download a zchunk file, reusing the chunks of the previous copy.
+
+    Only the chunks missing from previous, the file kept from the last sync
+    if any, are downloaded. The reassembled file is written to location and
+    verified chunk by chunk and against the checksums of entry.
+    """
+    urls = mirror_urls(repomd_url)
+    header = bytearray()
+    if entry.header_size:
+        stream_range(name, urls, 0, entry.header_size - 1, header.extend)
     else:
-        raise NotImplementedError(archive)
+        stream_range(name, urls, 0, zchunk.MAX_LEAD_SIZE - 1, header.extend)
+        size = zchunk.header_size(header)
+        if size > len(header):
+            stream_range(name, urls, len(header), size - 1, header.extend)
+    header = bytes(header)
+
+    try:
+        remote = zchunk.parse_header(header)
+    except zchunk.ZchunkError as err:
+        raise ChecksumError(f"{repomd_url}: {err}") from None
+    if (
+        entry.header_checksum is not None
+        and entry.header_checksum[0] == zchunk.hash_type(remote.hash_type)[0]
+        and entry.header_checksum[1] != remote.digest.hex()
+    ):
+        raise ChecksumError(
+            f"{repomd_url}: expected header {entry.header_checksum[1]},"
+            f" got {remote.digest.hex()}"
+        )
+
+    reusable = {}
+    if previous is not None and os.path.isfile(previous):
+        try:
+            old = zchunk.read_header(previous)
+            if old.chunk_hash_type == remote.chunk_hash_type:
+                reusable = {chunk.digest: chunk for chunk in old.chunks}
+        except (OSError, zchunk.ZchunkError) as err:
+            log(f"{name.ljust(padding)} Ignoring {previous}: {err}")
+
+    missing = [chunk for chunk in remote.chunks if chunk.digest not in reusable]
+    to_fetch = sum(chunk.length for chunk in missing)
+    total = sum(chunk.length for chunk in remote.chunks)
+    log(
+        f"{name.ljust(padding)} Downloading {len(missing)}/{len(remote.chunks)}"
+        f" chunks ({to_fetch}/{total} bytes) of {repomd_url}"
+    )
+
+    file_hash = new_hash(entry.checksum[0])
+    file_hash.update(header)
+    with open(location, "wb") as out, tqdm.tqdm(
+        desc=f"{name} {repomd_url.split('/')[-1]}",
+        total=to_fetch,
+        unit="B",
+        unit_scale=True,
+    ) as progress:
+
+        def write_chunk(chunk, data):
+            if zchunk.chunk_digest(remote.chunk_hash_type, data) != chunk.digest:
+                raise ChecksumError(
+                    f"{repomd_url}: chunk at byte {chunk.offset} does not match"
+                )
+            file_hash.update(data)
+            out.write(data)
+
+        def fetch_run(run):
+            # Consecutive missing chunks are fetched with a single request
+            # and verified one by one as they arrive.
+            buffer = bytearray()
+            pending = list(reversed(run))
+
+            def consume(data):
+                buffer.extend(data)
+                progress.update(len(data))
+                while pending and len(buffer) >= pending[-1].length:
+                    chunk = pending.pop()
+                    write_chunk(chunk, bytes(buffer[: chunk.length]))
+                    del buffer[: chunk.length]
+
+            stream_range(
+                name,
+                urls,
+                run[0].offset,
+                run[-1].offset + run[-1].length - 1,
+                consume,
+            )
+
+        out.write(header)
+        run = []
+        with open(previous, "rb") if reusable else open(os.devnull, "rb") as old:
+            for chunk in remote.chunks:
+                if chunk.length == 0:
+                    continue
+                if chunk.digest not in reusable:
+                    run.append(chunk)
+                    continue
+                if run:
+                    fetch_run(run)
+                    run = []
+                local = reusable[chunk.digest]
+                old.seek(local.offset)
+                write_chunk(chunk, old.read(local.length))
+            if run:
+                fetch_run(run)
+
+    if file_hash.hexdigest() != entry.checksum[1]:
+        raise ChecksumError(
+            f"{repomd_url}: expected {entry.checksum[1]}, got {file_hash.hexdigest()}"
+        )
+
+
+def unpack_zck(name, zck_file, xml_file, open_checksum):
+    """Decompress a verified zchunk file into xml_file."""
+    start = time.perf_counter()
+    header = zchunk.read_header(zck_file)
+    open_hash = new_hash(open_checksum[0])
+    with open(zck_file, "rb") as raw, open(xml_file, "wb") as out:
+        (dictionary, *chunks) = header.chunks
+        raw.seek(dictionary.offset)
+        decompressor = zchunk.Decompressor(header, raw.read(dictionary.length))
+        for chunk in chunks:
+            data = decompressor.decompress(raw.read(chunk.length))
+            open_hash.update(data)
+            out.write(data)
+
+    if open_hash.hexdigest() != open_checksum[1]:
+        raise ChecksumError(
+            f"{xml_file}: expected {open_checksum[1]}, got {open_hash.hexdigest()}"
+        )
+    log(
+        f"{name.ljust(padding)} Unpacked {os.path.basename(zck_file)}"
+        f" in {time.perf_counter() - start:.2f}s"
+    )
+
+
+def build_db(name, xml_file, tempdb, db_type, open_checksum):
+    """Build the sqlite database of a repository from its XML metadata."""
+    start = time.perf_counter()
+    count = repoxml.build_db(xml_file, tempdb, db_type, open_checksum[1])
+    log(
+        f"{name.ljust(padding)} Built {db_type} database of {count} packages"
+        f" in {time.perf_counter() - start:.2f}s"
+    )
+
+
+def align_pkg_keys(name, target_dir, state):
+    """Renumber pkgKey in filelists and other to match primary, by pkgId.
+
+    Databases built from XML number packages in document order, which
+    createrepo_c keeps the same in the three documents. This only does
+    something if a repository breaks that.
+    """
+    primary = os.path.join(target_dir, f"{name}_primary.sqlite")
+    for (db_type, (table, _)) in FINGERPRINTED.items():
+        db = f"{name}_{db_type}.sqlite"
+        path = os.path.join(target_dir, db)
+        if not os.path.isfile(primary) or not os.path.isfile(path):
+            continue
+
+        conn = sqlite3.connect(path)
+        conn.execute("ATTACH DATABASE ? AS prim", (primary,))
+        (misaligned,) = conn.execute(
+            """
+            SELECT COUNT(*) FROM packages
+                LEFT JOIN prim.packages AS p USING (pkgKey)
+            WHERE p.pkgId IS NOT packages.pkgId
+            """
+        ).fetchone()
+        if misaligned:
+            log(f"{name.ljust(padding)} Renumbering {misaligned} packages of {db}")
+            conn.executescript(
+                f"""
+                CREATE TEMP TABLE keymap AS
+                    SELECT packages.pkgKey AS old, p.pkgKey AS new
+                    FROM packages INNER JOIN prim.packages AS p USING (pkgId);
+                CREATE INDEX temp.keymapOld ON keymap (old);
+                DELETE FROM {table} WHERE pkgKey NOT IN (SELECT old FROM keymap);
+                DELETE FROM packages WHERE pkgKey NOT IN (SELECT old FROM keymap);
+                UPDATE {table}
+                    SET pkgKey = (SELECT new FROM keymap WHERE old = pkgKey);
+                UPDATE packages
+                    SET pkgKey = -(SELECT new FROM keymap WHERE old = pkgKey);
+                UPDATE packages SET pkgKey = -pkgKey;
+                """
+            )
+            conn.commit()
+        conn.close()
+        if misaligned:
+            state.refresh(db, path)
 
 
 def index_db(name, tempdb):
-    print(f"{name.ljust(padding)} Indexing file: {tempdb}")
+    log(f"{name.ljust(padding)} Indexing file: {tempdb}")
 
-    if tempdb.endswith("primary.sqlite"):
-        conn = sqlite3.connect(tempdb)
-        conn.row_factory = sqlite3.Row
-        conn.execute("CREATE INDEX packageSource ON packages (rpm_sourcerpm)")
-        conn.commit()
+    db_type = tempdb.rsplit("_", 1)[-1][: -len(".sqlite")]
+    conn = sqlite3.connect(tempdb)
+    for index, table, columns in LOOKUP_INDEXES.get(db_type, []):
+        create_index(name, conn, index, table, columns)
+
+    if db_type == "primary":
         # Insert source package name field for diff creation
         conn.execute("ALTER TABLE packages ADD rpm_sourcerpm_name TEXT")
-        for package_info in conn.execute("SELECT * FROM packages"):
-            subject = Subject(package_info["rpm_sourcerpm"])
-            nevra = subject.get_nevra_possibilities(forms=hawkey.FORM_NEVRA)
-            conn.execute(
-                "UPDATE packages SET rpm_sourcerpm_name = ? WHERE pkgKey = ?",
-                [nevra[0].name, package_info["pkgKey"]],
-            )
-        conn.commit()
-        conn.close()
+        fill_srpm_names(name, conn)
+        create_index(
+            name,
+            conn,
+            "packageIdentity",
+            "packages",
+            ("name", "arch", "rpm_sourcerpm_name"),
+        )
+        resolve_requires(name, conn)
+        build_required_by(name, conn)
+    elif db_type in FINGERPRINTED:
+        store_fingerprints(conn, db_type)
+
+    # Let the query planner know about the new indexes.
+    conn.execute("ANALYZE")
+    conn.commit()
+    conn.close()
 
 
-# Adds a table named 'changes' listing if certian packages were changed,
-#  added, or deleted.
-def gen_db_diff(name, new, old, regen_all):
-    if not os.path.isfile(old) or not new.endswith("primary.sqlite"):
-        return
+def has_index(conn, table, columns):
+    """Return True if an index of table starts with the given columns."""
+    for index in conn.execute(f"PRAGMA index_list({table})").fetchall():
+        indexed = [row[2] for row in conn.execute(f"PRAGMA index_info({index[1]})")]
+        if [c.lower() for c in indexed[: len(columns)]] == [c.lower() for c in columns]:
+            return True
+    return False
 
-    # If we want to regen all, then just don't make changes tables
-    if regen_all:
+
+def create_index(name, conn, index, table, columns):
+    """Create an index unless an equivalent one exists, reporting its cost."""
+    description = f"{table} ({', '.join(columns)})"
+    if has_index(conn, table, columns):
+        log(f"{name.ljust(padding)} Index on {description} already exists")
         return
 
-    print(f"{name.ljust(padding)} Creating diff for file: {old}")
+    (page_size,) = conn.execute("PRAGMA page_size").fetchone()
+    (pages_before,) = conn.execute("PRAGMA page_count").fetchone()
+    start = time.perf_counter()
+    conn.execute(f"CREATE INDEX {index} ON {description}")
+    conn.commit()
+    elapsed = time.perf_counter() - start
+    (pages_after,) = conn.execute("PRAGMA page_count").fetchone()
+    size = (pages_after - pages_before) * page_size
+    log(
+        f"{name.ljust(padding)} Index {index} on {description}: "
+        f"{elapsed:.2f}s, {size / 1024:.0f} KiB"
+    )
+
+
+def fill_srpm_names(name, conn):
+    """Set packages.rpm_sourcerpm_name for every row of a primary db.
+
+    Subpackages share their source RPM, so each distinct rpm_sourcerpm is
+    parsed once and written back with a single executemany through the
+    packageSource index instead of one UPDATE per package. A source RPM that
+    is not a NEVRA is logged and its file name used as the source name.
+    """
+    names = []
+    for (source,) in conn.execute(
+        "SELECT DISTINCT rpm_sourcerpm FROM packages WHERE rpm_sourcerpm IS NOT NULL"
+    ):
+        try:
+            names.append((srpm_name(source), source))
+        except ValueError as err:
+            log(f"{name.ljust(padding)} {err}, using it as the source name")
+            names.append((source.removesuffix(".src.rpm"), source))
+    conn.executemany(
+        "UPDATE packages SET rpm_sourcerpm_name = ? WHERE rpm_sourcerpm = ?", names
+    )
+
+
+def resolve_requires(name, conn):
+    """Materialize the providers of every requirement of a primary db.
+
+    Fills resolved_requires with one row per package and name of a package
+    providing one of its requirements, which is what the dependency list of
+    a package page shows. generate-html.py then reads it through an index
+    instead of joining requires, provides and packages on every page.
+    """
+    start = time.perf_counter()
+    conn.executescript(
+        """
+        DROP TABLE IF EXISTS resolved_requires;
+        CREATE TABLE resolved_requires (
+            pkgKey INTEGER, provider_name TEXT, provider_srpm TEXT,
+            flags TEXT, version TEXT, release TEXT
+        );
+        INSERT INTO resolved_requires
+        SELECT requires.pkgKey, packages.name, packages.rpm_sourcerpm_name,
+            requires.flags, requires.version, requires.release
+        FROM requires
+            INNER JOIN provides ON requires.name = provides.name
+            INNER JOIN packages ON provides.pkgKey = packages.pkgKey
+        GROUP BY requires.pkgKey, packages.name
+        ORDER BY requires.pkgKey, packages.name;
+        CREATE INDEX resolvedRequiresPkgKey ON resolved_requires (pkgKey);
+        """
+    )
+    conn.commit()
+    (count,) = conn.execute("SELECT COUNT(*) FROM resolved_requires").fetchone()
+    log(
+        f"{name.ljust(padding)} Resolved {count} requirements: "
+        f"{time.perf_counter() - start:.2f}s"
+    )
+
+
+def build_required_by(name, conn):
+    """Index the dependents of every package name of a primary db.
+
+    required_by is resolved_requires turned around: one row per package
+    name and name of a package requiring something it provides. It is
+    built in a single pass over resolved_requires, so its cost grows with
+    the size of the repository and not with the number of pages reading it.
+    """
+    start = time.perf_counter()
+    conn.executescript(
+        """
+        DROP TABLE IF EXISTS required_by;
+        CREATE TABLE required_by (
+            provider_name TEXT, dependent_name TEXT, dependent_srpm TEXT
+        );
+        INSERT INTO required_by
+        SELECT DISTINCT resolved_requires.provider_name, packages.name,
+            packages.rpm_sourcerpm_name
+        FROM resolved_requires
+            INNER JOIN packages ON resolved_requires.pkgKey = packages.pkgKey
+        WHERE packages.name != resolved_requires.provider_name
+        ORDER BY resolved_requires.provider_name, packages.name;
+        CREATE INDEX requiredByProvider ON required_by (provider_name);
+        """
+    )
+    conn.commit()
+    (count, providers) = conn.execute(
+        "SELECT COUNT(*), COUNT(DISTINCT provider_name) FROM required_by"
+    ).fetchone()
+    log(
+        f"{name.ljust(padding)} Indexed {count} dependents of {providers} "
+        f"packages: {time.perf_counter() - start:.2f}s"
+    )
+
+
+class Fingerprint:
+    """SQLite aggregate hashing the rows of one package.
+
+    Rows are sorted before hashing so the digest does not depend on the
+    order in which SQLite visits them.
+    """
+
+    def __init__(self):
+        self.rows = []
+
+    def step(self, *values):
+        if any(value is not None for value in values):
+            self.rows.append(repr(values))
+
+    def finalize(self):
+        digest = hashlib.sha1()
+        for row in sorted(self.rows):
+            digest.update(row.encode())
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+
+def fingerprint_query(schema, db_type):
+    """SELECT returning (pkgId, digest) for every package of a database."""
+    (table, columns) = FINGERPRINTED[db_type]
+    columns = ", ".join(f"{schema}.{table}.{column}" for column in columns)
+    return f"""
+        SELECT {schema}.packages.pkgId, fingerprint({columns})
+        FROM {schema}.packages LEFT JOIN {schema}.{table}
+            ON {schema}.packages.pkgKey = {schema}.{table}.pkgKey
+        GROUP BY {schema}.packages.pkgKey
+        """
+
+
+def store_fingerprints(conn, db_type):
+    """Store a content digest of every package for diffing the next sync."""
+    conn.create_aggregate("fingerprint", len(FINGERPRINTED[db_type][1]), Fingerprint)
+    conn.execute(
+        "CREATE TABLE fingerprints (pkgId TEXT PRIMARY KEY, digest TEXT NOT NULL)"
+    )
+    conn.execute(
+        "INSERT OR REPLACE INTO fingerprints " + fingerprint_query("main", db_type)
+    )
+
+
+def has_table(conn, table, schema="main"):
+    result = conn.execute(
+        f"SELECT name FROM {schema}.sqlite_master WHERE type = 'table' AND name = ?",
+        (table,),
+    )
+    return result.fetchone() is not None
+
+
+# Adds a table named 'changes' listing if certian packages were changed,
+#  added, or deleted. For the filelists and other databases, a table named
+#  'package_changes' lists the pkgId of every package whose files or changelog
+#  changed; merge_db_diffs() folds those into the 'changes' table of primary.
+def gen_db_diff(name, new, old):
+    """Diff new against the installed old database.
+
+    Returns False if no diff could be made, in which case every package of
+    the repository has to be regenerated.
+    """
+    if not os.path.isfile(old):
+        return False
+
+    log(f"{name.ljust(padding)} Creating diff for file: {old}")
+    start = time.perf_counter()
+    db_type = new.rsplit("_", 1)[-1][: -len(".sqlite")]
     conn = sqlite3.connect(new)
     conn.execute(f"ATTACH DATABASE '{old}' as old")
+    if db_type == "primary":
+        diff_primary(conn)
+        (count,) = conn.execute("SELECT COUNT(*) FROM changes").fetchone()
+    else:
+        diff_contents(conn, db_type)
+        (count,) = conn.execute("SELECT COUNT(*) FROM package_changes").fetchone()
+    conn.commit()
+    conn.close()
+    log(
+        f"{name.ljust(padding)} Diff for {os.path.basename(new)}: {count} changes "
+        f"in {time.perf_counter() - start:.2f}s"
+    )
+    return True
+
+
+def create_changes_table(conn):
     # changes table schema:
     # name - package name
     # arch - package arch
@@ -143,6 +920,16 @@ def gen_db_diff(name, new, old, regen_all):
         )
         """
     )
+
+
+def create_package_changes_table(conn):
+    # package_changes table schema:
+    # pkgId - checksum of the package whose content is new or changed
+    conn.execute("CREATE TABLE package_changes (pkgId TEXT PRIMARY KEY)")
+
+
+def diff_primary(conn):
+    create_changes_table(conn)
     # Insert added packages list to changes table
     conn.execute(
         """
@@ -169,117 +956,368 @@ def gen_db_diff(name, new, old, regen_all):
         WHERE main.packages.name IS NULL
         """
     )
-    # Insert changed packages list to changes table
+    # Insert changed packages list to changes table. A package changed when
+    # one of its builds (pkgId) appeared or disappeared; added and removed
+    # packages were inserted above and are ignored by the UNIQUE constraint.
     conn.execute(
         """
         INSERT INTO changes (name, arch, rpm_sourcerpm_name, change)
-        SELECT name, arch, rpm_sourcerpm_name, 'updated' FROM
-            (SELECT main.packages.name, main.packages.arch, main.packages.rpm_sourcerpm_name,
-                IIF(main.packages.epoch IS NOT NULL, main.packages.epoch || ':', '') ||
-                main.packages.version || '-' || main.packages.release || '.' || main.packages.arch
-            FROM main.packages
-            UNION
-            SELECT old.packages.name, old.packages.arch, old.packages.rpm_sourcerpm_name,
-                IIF(old.packages.epoch IS NOT NULL, old.packages.epoch || ':', '') ||
-                old.packages.version || '-' || old.packages.release || '.' || old.packages.arch
-            FROM old.packages)
-        GROUP BY name, arch, rpm_sourcerpm_name
-        HAVING COUNT(*) > 1
+        SELECT main.packages.name, main.packages.arch, main.packages.rpm_sourcerpm_name, 'updated'
+        FROM main.packages LEFT JOIN old.packages ON main.packages.pkgId = old.packages.pkgId
+        WHERE old.packages.pkgId IS NULL
+        UNION
+        SELECT old.packages.name, old.packages.arch, old.packages.rpm_sourcerpm_name, 'updated'
+        FROM old.packages LEFT JOIN main.packages ON main.packages.pkgId = old.packages.pkgId
+        WHERE main.packages.pkgId IS NULL
         """
     )
-    conn.commit()
-    conn.close()
 
 
-def clear_diff_table(db):
-    conn = sqlite3.connect(db)
-    result = conn.execute(
-        "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'changes'"
+def diff_contents(conn, db_type):
+    # Databases installed before fingerprints were stored get them computed
+    # on the fly.
+    old_fingerprints = "old.fingerprints"
+    if not has_table(conn, "fingerprints", "old"):
+        conn.create_aggregate(
+            "fingerprint", len(FINGERPRINTED[db_type][1]), Fingerprint
+        )
+        conn.execute(
+            "CREATE TEMP TABLE old_fingerprints (pkgId TEXT PRIMARY KEY, digest TEXT)"
+        )
+        conn.execute(
+            "INSERT OR REPLACE INTO old_fingerprints " + fingerprint_query("old", db_type)
+        )
+        old_fingerprints = "temp.old_fingerprints"
+
+    create_package_changes_table(conn)
+    conn.execute(
+        f"""
+        INSERT INTO package_changes (pkgId)
+        SELECT main.fingerprints.pkgId
+        FROM main.fingerprints LEFT JOIN {old_fingerprints}
+            ON main.fingerprints.pkgId = {old_fingerprints}.pkgId
+        WHERE {old_fingerprints}.digest IS NULL
+            OR {old_fingerprints}.digest != main.fingerprints.digest
+        """
     )
-    if result.fetchone() is not None:
-        conn.execute("DELETE FROM changes")
+
+
+def merge_db_diffs(name, target_dir, state):
+    """Add the packages changed in filelists and other to primary's changes.
+
+    Runs once every database of the repository has been processed.
+    """
+    db = f"{name}_primary.sqlite"
+    primary = os.path.join(target_dir, db)
+    if not os.path.isfile(primary):
+        return
+
+    conn = sqlite3.connect(primary)
+    # Only a primary installed without a diff has no changes table, and the
+    # whole repository is then journaled for regeneration.
+    if not has_table(conn, "changes"):
+        conn.close()
+        return
+
+    start = time.perf_counter()
+    merged = 0
+    for db_type in FINGERPRINTED:
+        path = os.path.join(target_dir, f"{name}_{db_type}.sqlite")
+        # The diff of a database that failed to update is the one of the
+        # previous run, which was already merged.
+        if not os.path.isfile(path) or os.path.basename(path) not in state.current:
+            continue
+
+        conn.execute("ATTACH DATABASE ? AS diff", (path,))
+        if has_table(conn, "package_changes", "diff"):
+            merged += conn.execute(
+                """
+                INSERT INTO changes (name, arch, rpm_sourcerpm_name, change)
+                SELECT packages.name, packages.arch, packages.rpm_sourcerpm_name, 'updated'
+                FROM diff.package_changes
+                    INNER JOIN packages ON packages.pkgId = diff.package_changes.pkgId
+                """
+            ).rowcount
         conn.commit()
+        conn.execute("DETACH DATABASE diff")
+    conn.close()
+    state.refresh(db, primary)
+
+    if merged:
+        log(
+            f"{name.ljust(padding)} Merged {merged} file and changelog changes "
+            f"in {time.perf_counter() - start:.2f}s"
+        )
+
+
+def journal_changes(name, target_dir, journal, diffed):
+    """Append the changes of a synced repository to the change journal."""
+    primary = os.path.join(target_dir, f"{name}_primary.sqlite")
+    if not diffed:
+        log(f"{name.ljust(padding)} Journaled full regeneration")
+        journal.append_full(name)
+    elif os.path.isfile(primary):
+        conn = sqlite3.connect(primary)
+        changed = has_table(conn, "changes")
+        conn.close()
+        if changed:
+            count = journal.append_changes(name, primary)
+            log(f"{name.ljust(padding)} Journaled {count} changes")
+
+
+def sync_repository(name, target_dir, pipeline, downloads, state, journal):
+    """Wait for the databases of a repository and journal their changes.
+
+    The ledger of the repository is only saved once its changes are
+    journaled.
+    """
+    diffed = pipeline.wait(downloads) and not state.untrusted
+    if f"{name}_primary.sqlite" not in state.current:
+        # The changes table of the primary is the one of the previous run, the
+        # other databases installed are only journaled as a whole.
+        if state.installed:
+            journal_changes(name, target_dir, journal, False)
+        else:
+            log(f"{name.ljust(padding)} Primary not updated, nothing to journal")
+    else:
+        if ZCHUNK:
+            align_pkg_keys(name, target_dir, state)
+        merge_db_diffs(name, target_dir, state)
+        journal_changes(name, target_dir, journal, diffed)
+    state.save()
+
+
+def clear_diff_table(db, db_type):
+    """Empty the diff table of an unchanged database, creating it if needed.
+
+    The diffs of the other databases of the repository are merged into the
+    changes table of an unchanged primary, which has none if it was
+    installed without a diff.
+    """
+    (table, create) = {
+        "primary": ("changes", create_changes_table),
+        "filelists": ("package_changes", create_package_changes_table),
+        "other": ("package_changes", create_package_changes_table),
+    }[db_type]
+    conn = sqlite3.connect(db)
+    for stale in ["changes", "package_changes"]:
+        if has_table(conn, stale):
+            conn.execute(f"DELETE FROM {stale}")
+    if not has_table(conn, table):
+        create(conn)
+    conn.commit()
     conn.close()
 
 
+def parse_repomd(repomd):
+    """Yield a RepomdEntry for every checksummed file of a parsed repomd.xml."""
+    for node in repomd:
+        location = node.find("repo:location", repomd_xml_namespace)
+        checksum = node.find("repo:checksum", repomd_xml_namespace)
+        open_checksum = node.find("repo:open-checksum", repomd_xml_namespace)
+        size = node.find("repo:size", repomd_xml_namespace)
+        header_checksum = node.find("repo:header-checksum", repomd_xml_namespace)
+        header_size = node.find("repo:header-size", repomd_xml_namespace)
+        if location is None or checksum is None or open_checksum is None:
+            continue
+
+        yield RepomdEntry(
+            location.attrib["href"].replace("repodata/", ""),
+            (checksum.attrib["type"], checksum.text),
+            (open_checksum.attrib["type"], open_checksum.text),
+            int(size.text) if size is not None else None,
+            (header_checksum.attrib["type"], header_checksum.text)
+            if header_checksum is not None
+            else None,
+            int(header_size.text) if header_size is not None else None,
+        )
+
+
 def install_db(name, src, dest):
-    print(f"{name.ljust(padding)} Installing {src} to {dest}.")
+    log(f"{name.ljust(padding)} Installing {src} to {dest}.")
     shutil.move(src, dest)
 
 
-def handle(repo, target_dir, db_removed):
+class SyncPipeline:
+    """Bounded worker pools for the two stages of a database sync.
+
+    Fetching (download, decompress and verify) is mostly network bound while
+    indexing and diffing are CPU and disk bound, so each stage gets its own
+    pool. A database is handed over to the processing pool as soon as it is
+    fetched, which keeps the network busy while earlier files are processed.
+    """
+
+    def __init__(self, download_jobs, process_jobs):
+        self.downloads = ThreadPoolExecutor(
+            download_jobs, thread_name_prefix="download"
+        )
+        self.processing = ThreadPoolExecutor(
+            process_jobs, thread_name_prefix="process"
+        )
+
+    def submit(self, name, repomd_url, entry, destfile, state):
+        """Queue a database file; returns a future of its processing future."""
+        return self.downloads.submit(
+            self._download, name, repomd_url, entry, destfile, state
+        )
+
+    def _download(self, name, repomd_url, entry, destfile, state):
+        working_dir = tempfile.mkdtemp(prefix="mdapi-")
+        tempdb = os.path.join(working_dir, os.path.basename(destfile))
+        try:
+            if entry.href.endswith(".zck"):
+                fetched = os.path.join(working_dir, os.path.basename(entry.href))
+                fetch_zck(name, repomd_url, fetched, entry, zck_copy(destfile))
+            else:
+                fetch_db(
+                    name,
+                    repomd_url,
+                    tempdb,
+                    entry.checksum,
+                    entry.open_checksum,
+                    entry.size,
+                )
+        except (requests.RequestException, ChecksumError) as err:
+            log(f"{name.ljust(padding)} ERROR Downloading DB file: {err}")
+            log(f"{name.ljust(padding)} will be skipped.")
+            shutil.rmtree(working_dir, ignore_errors=True)
+            return None
+        except BaseException:
+            shutil.rmtree(working_dir, ignore_errors=True)
+            raise
+
+        return self.processing.submit(
+            self._process, name, working_dir, tempdb, entry, destfile, state
+        )
+
+    def _process(self, name, working_dir, tempdb, entry, destfile, state):
+        try:
+            if entry.href.endswith(".zck"):
+                fetched = os.path.join(working_dir, os.path.basename(entry.href))
+                xml_file = fetched[: -len(".zck")]
+                unpack_zck(name, fetched, xml_file, entry.open_checksum)
+                # Keep the verified file as the base of the next delta.
+                os.makedirs(os.path.dirname(zck_copy(destfile)), exist_ok=True)
+                shutil.move(fetched, zck_copy(destfile))
+                build_db(
+                    name,
+                    xml_file,
+                    tempdb,
+                    db_type_of(entry.href),
+                    entry.open_checksum,
+                )
+                os.remove(xml_file)
+            index_db(name, tempdb)
+            diffed = gen_db_diff(name, tempdb, destfile)
+            install_db(name, tempdb, destfile)
+            state.record(os.path.basename(destfile), entry, destfile)
+            return diffed
+        except Exception as err:
+            # Nothing was installed, the database is fetched again next run.
+            log(f"{name.ljust(padding)} ERROR Processing DB file: {err!r}")
+            log(f"{name.ljust(padding)} will be skipped.")
+            return None
+        finally:
+            shutil.rmtree(working_dir, ignore_errors=True)
+
+    def wait(self, queued):
+        """Wait for the given downloads and their processing to finish.
+
+        Returns True if every installed database came with a diff. Databases
+        that failed to download or to be processed are skipped.
+        """
+        diffed = True
+        for download in queued:
+            processing = download.result()
+            if processing is None:
+                continue
+            db_diffed = processing.result()
+            if db_diffed is not None:
+                diffed = db_diffed and diffed
+        return diffed
+
+    def shutdown(self):
+        self.downloads.shutdown()
+        self.processing.shutdown()
+
+
+def db_type_of(href):
+    """Return which database (primary, filelists, other) href holds."""
+    for db_type in ["primary", "filelists", "other"]:
+        if f"{db_type}.sqlite" in href or f"{db_type}.xml" in href:
+            return db_type
+    return None
+
+
+def handle(repo, target_dir, pipeline, state):
+    """Check a repository for changed databases and queue them on pipeline.
+
+    Returns the list of queued downloads, or None if repomd.xml could not
+    be fetched.
+    """
     url, name = repo
     repomd_url = f"{url}/repomd.xml"
-    response = requests.get(repomd_url, verify=DL_VERIFY)
-    if not response:
-        print(f"{name.ljust(padding)} !! Failed to get {repomd_url!r} {response!r}")
-        return
-
-    # Parse the xml doc and get a list of locations and their shasum.
-    files = (
-        (
-            node.find("repo:location", repomd_xml_namespace),
-            node.find("repo:open-checksum", repomd_xml_namespace),
+    try:
+        response = retrying(
+            name, response_cache.get, session, repomd_url, verify=DL_VERIFY
         )
-        for node in ET.fromstring(response.text)
-    )
+        response.raise_for_status()
+    except requests.RequestException as err:
+        log(f"{name.ljust(padding)} !! Failed to get {repomd_url!r}: {err}")
+        return None
 
-    # Extract out the attributes that we're really interested in.
-    files = (
-        (f.attrib["href"].replace("repodata/", ""), s.text, s.attrib["type"])
-        for f, s in files
-        if f is not None and s is not None
-    )
+    repomd = ET.fromstring(response.text)
+    revision = repomd.find("repo:revision", repomd_xml_namespace)
+    if revision is not None:
+        state.set_revision(revision.text)
 
-    # Filter down to only sqlite dbs
-    files = ((f, s, t) for f, s, t in files if ".sqlite" in f)
+    # Filter down to only sqlite dbs, or the zchunk XML documents they are
+    # built from if the repository has them.
+    entries = list(parse_repomd(repomd))
+    files = [entry for entry in entries if ".sqlite" in entry.href]
+    if ZCHUNK:
+        zck_files = [
+            entry
+            for entry in entries
+            if entry.href.endswith(".xml.zck") and db_type_of(entry.href)
+        ]
+        if len(zck_files) == len(FINGERPRINTED) + 1:
+            files = zck_files
 
-    # We need to ensure the primary db comes first so we can build a pkey cache
-    primary_first = lambda item: "primary" not in item[0]
+    # Queue the primary db first, it is the largest consumer of the other
+    # stages (indexing and diffing).
+    primary_first = lambda entry: "primary" not in entry.href
     files = sorted(files, key=primary_first)
 
-    # Primary-key caches built from the primary dbs so we can make sense
-    # of the contents of the filelist and changelog dbs.
-    cache1, cache2 = {}, {}
-
     if not files:
-        print(f"No sqlite database could be found in {url}")
+        log(f"No sqlite database could be found in {url}")
 
-    for filename, shasum, shatype in files:
+    queued = []
+    for entry in files:
+        filename = entry.href
         repomd_url = f"{url}/{filename}"
 
         # First, determine if the file has changed by comparing hash
-        db = None
-        if "primary.sqlite" in filename:
-            db = f"{name}_primary.sqlite"
-        elif "filelists.sqlite" in filename:
-            db = f"{name}_filelists.sqlite"
-        elif "other.sqlite" in filename:
-            db = f"{name}_other.sqlite"
+        db_type = db_type_of(filename)
+        db = f"{name}_{db_type}.sqlite"
 
         # Have we downloaded this before?  Did it change?
         destfile = os.path.join(target_dir, db)
-        if not needs_update(destfile, shasum, shatype):
-            clear_diff_table(destfile)
-            print(f"{name.ljust(padding)} No change of {repomd_url}")
+        if state.unjournaled(db, destfile):
+            log(f"{name.ljust(padding)} {db} was installed but never journaled")
+            state.untrusted = True
+        if not state.needs_update(db, entry, destfile):
+            clear_diff_table(destfile, db_type)
+            state.keep(db, destfile)
+            log(f"{name.ljust(padding)} No change of {repomd_url}")
             continue
 
         # If it has changed, then download it and move it into place.
-        tempargs = dict(prefix="mdapi-")
-        with tempfile.TemporaryDirectory(**tempargs) as working_dir:
-            tempdb = os.path.join(working_dir, db)
-            archive = os.path.join(working_dir, filename)
-
-            try:
-                download_db(name, repomd_url, archive)
-            except HTTPError as err:
-                print(f"{name.ljust(padding)} ERROR Downloading DB file: {err}")
-                print(f"{name.ljust(padding)} will be skipped.")
-                continue
-            decompress_db(name, archive, tempdb)
-            index_db(name, tempdb)
-            gen_db_diff(name, tempdb, destfile, db_removed)
-            install_db(name, tempdb, destfile)
+        queued.append(
+            pipeline.submit(name, repomd_url, entry, destfile, state)
+        )
+
+    return queued
 
 
 def get_repository_urls_for(product, version):
@@ -294,12 +1332,12 @@ def get_repository_urls_for(product, version):
                 MIRROR, version
             )
         )
-        db_check = requests.head(db_location)
+        db_check = retrying(release, session.head, db_location)
         if db_check.status_code == 404:
             develop_db_location = "{}/pub/fedora/linux/development/{}/Everything/x86_64/os/repodata".format(
                 MIRROR, version
             )
-            db_check = requests.head(develop_db_location)
+            db_check = retrying(release, session.head, develop_db_location)
             if db_check.status_code != 404:
                 db_location = develop_db_location
 
@@ -347,6 +1385,9 @@ def get_repository_urls_for(product, version):
 
 
 def main():
+    global MIRROR, KOJI_REPO, PDC_URI, response_cache
+    global EXTRA_MIRRORS, SPLIT_SIZE, DL_RETRIES, ZCHUNK
+
     # Handle command-line arguments.
     parser = argparse.ArgumentParser(
         description="Fetch SQL metadata databases of Fedora/EPEL repositories"
@@ -354,15 +1395,86 @@ def main():
     parser.add_argument(
         "--target-dir", dest="target_dir", action="store", required=True
     )
+    parser.add_argument(
+        "--download-jobs",
+        dest="download_jobs",
+        type=int,
+        default=4,
+        help="number of concurrent downloads (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--process-jobs",
+        dest="process_jobs",
+        type=int,
+        default=2,
+        help="number of databases decompressed and indexed concurrently"
+        " (default: %(default)s)",
+    )
+
+    parser.add_argument(
+        "--mirror",
+        dest="mirror",
+        action="store",
+        help="fetch repositories and the PDC listing from this URL or local"
+        " directory instead of the Fedora infrastructure",
+    )
+    parser.add_argument(
+        "--extra-mirror",
+        dest="extra_mirrors",
+        action="append",
+        default=[],
+        help="another URL or local directory with the layout and content of"
+        " the mirror, used to resume failed transfers and to split large files"
+        " across mirrors (may be repeated)",
+    )
+    parser.add_argument(
+        "--split-size",
+        dest="split_size",
+        type=int,
+        default=SPLIT_SIZE // (1024 * 1024),
+        help="size in MiB from which a file is fetched from every mirror in"
+        " parallel byte ranges (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--zchunk",
+        dest="zchunk",
+        action="store_true",
+        help="sync the zchunk XML metadata, downloading only the chunks that"
+        " changed since the last run, and build the databases from it",
+    )
+    parser.add_argument(
+        "--retries",
+        dest="retries",
+        type=int,
+        default=DL_RETRIES,
+        help="attempts without progress before a download is given up"
+        " (default: %(default)s)",
+    )
 
     args = parser.parse_args()
+    setup_session(args.download_jobs)
+
+    if args.mirror:
+        # Same layout as the public servers: pub/, repos/ and pdc/ (see README)
+        MIRROR = mirror_url(args.mirror)
+        KOJI_REPO = f"{MIRROR}/repos"
+        PDC_URI = f"{MIRROR}/pdc/rest_api/v1/product-versions/"
+    EXTRA_MIRRORS = [mirror_url(mirror) for mirror in args.extra_mirrors]
+    SPLIT_SIZE = args.split_size * 1024 * 1024
+    DL_RETRIES = args.retries
+    ZCHUNK = args.zchunk
+    if ZCHUNK and zchunk.zstandard is None:
+        sys.exit("--zchunk needs python3-zstandard")
+    response_cache = ResponseCache(os.path.join(args.target_dir, STATE_DIR, "http"))
 
     # Get active releases from PDC.
-    print("Fetching active releases from PDC... https://pdc.fedoraproject.org/")
-    r = requests.get(
-        "https://pdc.fedoraproject.org/rest_api/v1/product-versions/",
-        params={"active": "true"},
-    )
+    log(f"Fetching active releases from PDC... {PDC_URI}")
+    try:
+        r = retrying(
+            "PDC", response_cache.get, session, PDC_URI, params={"active": "true"}
+        )
+    except requests.RequestException as err:
+        sys.exit(f"Failed to fetch active releases from PDC ({err})")
     if r.status_code != 200:
         sys.exit(
             "Failed to fetch active releases from PDC (request returned {})".format(
@@ -372,16 +1484,30 @@ def main():
 
     # Generate repository URLs.
     repositories = []
-    active_releases = map(lambda e: (e["short"], e["version"]), r.json()["results"])
+    # A local stand-in may not filter on the query string, filter again.
+    active_releases = [
+        (e["short"], e["version"]) for e in r.json()["results"] if e.get("active", True)
+    ]
 
-    for (product, version) in active_releases:
-        repositories += get_repository_urls_for(product, version)
+    # Locating a release may take a couple of HEAD requests, probe them all
+    # at once.
+    with ThreadPoolExecutor(args.download_jobs) as probes:
+        for urls in probes.map(
+            lambda release: get_repository_urls_for(*release), active_releases
+        ):
+            repositories += urls
 
-    print("Found: " + str(list(map(lambda p: p[1], repositories))))
+    log("Found: " + str(list(map(lambda p: p[1], repositories))))
+
+    # Delete db files for inactive releases. Their packages are journaled as
+    # removed from that release branch first, so only the pages of those
+    # packages get regenerated.
+    journal = Journal(args.target_dir)
+    removed_branches = set()
+    for filename in sorted(os.listdir(args.target_dir)):
+        if filename.startswith("."):
+            continue
 
-    # Delete db files for inactive releases. If a db is deleted, all pages will be regenerated.
-    db_removed = False
-    for filename in os.listdir(args.target_dir):
         file_from_active_release = False
         for repo in repositories:
             if filename.find(repo[1]) != -1:
@@ -389,13 +1515,64 @@ def main():
                 break
 
         if not file_from_active_release:
-            os.remove(os.path.join(args.target_dir, filename))
-            # this will trigger a full regen
-            db_removed = True
+            path = os.path.join(args.target_dir, filename)
+            if filename.endswith("_primary.sqlite"):
+                release_branch = filename[: -len("_primary.sqlite")]
+                count = journal.append_removed_branch(release_branch, path)
+                log(f"{release_branch.ljust(padding)} Journaled {count} removed packages")
+                removed_branches.add(release_branch)
+            os.remove(path)
+
+    if removed_branches:
+        log("Removed: " + str(sorted(removed_branches)))
+
+    # Drop the sync state of inactive releases along with their databases.
+    ledger_dir = os.path.join(args.target_dir, LEDGER_DIR)
+    os.makedirs(ledger_dir, exist_ok=True)
+    active_states = {f"{repo[1]}.json" for repo in repositories}
+    for filename in os.listdir(ledger_dir):
+        if filename not in active_states:
+            os.remove(os.path.join(ledger_dir, filename))
+    zck_dir = os.path.join(args.target_dir, ZCK_DIR)
+    if os.path.isdir(zck_dir):
+        active_names = {repo[1] for repo in repositories}
+        for filename in os.listdir(zck_dir):
+            if filename.rsplit("_", 1)[0] not in active_names:
+                os.remove(os.path.join(zck_dir, filename))
+
+    # Fetch repository databases. Every repository is checked concurrently
+    # and its changed databases go through the download and processing pools.
+    pipeline = SyncPipeline(args.download_jobs, args.process_jobs)
+    states = {name: SyncState(args.target_dir, name) for (_, name) in repositories}
+    try:
+        with ThreadPoolExecutor(args.download_jobs) as metadata:
+            queued = metadata.map(
+                lambda repo: handle(repo, args.target_dir, pipeline, states[repo[1]]),
+                repositories,
+            )
+            for (_, name), downloads in zip(repositories, list(queued)):
+                if downloads is None:
+                    continue
+                try:
+                    sync_repository(
+                        name,
+                        args.target_dir,
+                        pipeline,
+                        downloads,
+                        states[name],
+                        journal,
+                    )
+                except Exception as err:
+                    # Its ledger is not saved, the next run finds the databases
+                    # installed meanwhile and journals a full regeneration.
+                    log(f"{name.ljust(padding)} !! Failed to sync: {err!r}")
+    finally:
+        pipeline.shutdown()
 
-    # Fetch repository databases.
-    for repo in repositories:
-        handle(repo, args.target_dir, db_removed)
+    pruned = journal.prune()
+    if pruned:
+        log(f"Pruned {pruned} journal entries no consumer needs anymore")
+    journal.close()
 
 
 if __name__ == "__main__":
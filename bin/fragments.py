@@ -0,0 +1,179 @@
+#
+# Cache of the parts of package pages that only depend on the build.
+#
+# The same build, identified by its pkgId, is often in several
+# release_branches: a release and its updates carrying the same NVR, EPEL
+# testing and stable. Its changelog, provides and file list are rendered
+# once and kept in $(DB_DIR)/.sync/fragments.sqlite, keyed by pkgId and
+# section, for its pages in the other release_branches and in the next runs.
+# The least recently used fragments are evicted once the cache grows past
+# its size, and every fragment is dropped when the way they are rendered
+# changes.
+#
+# Processes rendering pages read the cache through their own connection and
+# send what they rendered and reused back to the parent, which is the only
+# one writing it, like the writes of OutputManifest. The parent only keeps a
+# connection open while writing, so the cache can be passed to processes
+# forked after it was opened.
+import os
+import sqlite3
+import time
+
+from pathlib import Path
+
+FRAGMENTS_FILE = os.path.join(".sync", "fragments.sqlite")
+
+
+class FragmentCache:
+    def __init__(self, dbs_dir, version, max_size):
+        """Open the cache of dbs_dir for fragments rendered as version.
+
+        max_size is the number of bytes of fragments kept.
+        """
+        self.path = os.path.join(dbs_dir, FRAGMENTS_FILE)
+        self.max_size = max_size
+        # Fragments of this run are more recent than everything before.
+        self.used = time.time_ns()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.conn = self._connect()
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS fragments (
+                pkg_id TEXT NOT NULL,
+                section TEXT NOT NULL,
+                content NOT NULL,
+                size INTEGER NOT NULL,
+                used INTEGER NOT NULL,
+                PRIMARY KEY (pkg_id, section)
+            );
+            """
+        )
+        row = self.conn.execute(
+            "SELECT value FROM meta WHERE key = 'version'"
+        ).fetchone()
+        if row is None or row[0] != version:
+            self.conn.execute("DELETE FROM fragments")
+            self.conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('version', ?)",
+                (version,),
+            )
+        self.conn.commit()
+        self.conn.close()
+        self.conn = None
+
+        # Connection of the process reading the cache, and its pid.
+        self.reader = None
+        self.reader_pid = None
+        # Fragments rendered and reused since the last take().
+        self.pending = []
+        self.reused = []
+        self.hits = 0
+        self.misses = 0
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path)
+        # Readers are not blocked by the parent writing, and a lost write
+        # only costs rendering the fragment again.
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = OFF")
+        return conn
+
+    def lookup(self, pkg_ids):
+        """Return {pkgId: {section: content}} of the cached pkg_ids."""
+        if self.reader_pid != os.getpid():
+            uri = Path(self.path).resolve().as_uri() + "?mode=ro"
+            self.reader = sqlite3.connect(uri, uri=True)
+            self.reader_pid = os.getpid()
+        pkg_ids = [pkg_id for pkg_id in pkg_ids if pkg_id is not None]
+        found = {}
+        if not pkg_ids:
+            return found
+        placeholders = ", ".join("?" * len(pkg_ids))
+        for (pkg_id, section, content) in self.reader.execute(
+            "SELECT pkg_id, section, content FROM fragments"
+            f" WHERE pkg_id IN ({placeholders})",
+            pkg_ids,
+        ):
+            found.setdefault(pkg_id, {})[section] = content
+        return found
+
+    def fragment(self, pkg_id, section, known, render):
+        """Return section of pkg_id from known, or render() and cache it.
+
+        known is the {section: content} lookup() found for pkg_id, it gets
+        the rendered fragment too.
+        """
+        if section in known:
+            self.reused.append((pkg_id, section))
+            return known[section]
+        content = render()
+        if pkg_id is not None:
+            known[section] = content
+            self.pending.append((pkg_id, section, content))
+        return content
+
+    def take(self):
+        """Return the fragments rendered and reused since the last call.
+
+        Processes rendering through a copy of the cache send these to the
+        parent, which passes them to record().
+        """
+        taken = (self.pending, self.reused)
+        (self.pending, self.reused) = ([], [])
+        return taken
+
+    def record(self, taken):
+        (rendered, reused) = taken
+        self.misses += len(rendered)
+        self.hits += len(reused)
+        if not (rendered or reused):
+            return
+        if self.conn is None:
+            self.conn = self._connect()
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO fragments (pkg_id, section, content, size, used)"
+            " VALUES (?, ?, ?, ?, ?)",
+            [
+                (pkg_id, section, content, len(content), self.used)
+                for (pkg_id, section, content) in rendered
+            ],
+        )
+        self.conn.executemany(
+            "UPDATE fragments SET used = ? WHERE pkg_id = ? AND section = ?",
+            [(self.used, pkg_id, section) for (pkg_id, section) in reused],
+        )
+        self.conn.commit()
+
+    def close(self):
+        """Evict the least recently used fragments and print a summary."""
+        if self.conn is None:
+            self.conn = self._connect()
+        evicted = self.conn.execute(
+            """
+            DELETE FROM fragments WHERE (pkg_id, section) IN (
+                SELECT pkg_id, section FROM (
+                    SELECT pkg_id, section, SUM(size) OVER (
+                        ORDER BY used DESC, pkg_id, section
+                    ) AS total
+                    FROM fragments
+                )
+                WHERE total > ?
+            )
+            """,
+            (self.max_size,),
+        ).rowcount
+        self.conn.commit()
+        (count, size) = self.conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM fragments"
+        ).fetchone()
+        looked_up = self.hits + self.misses
+        print(
+            f"> Fragment cache: {self.hits} hits, {self.misses} misses"
+            f" ({self.hits * 100 / looked_up if looked_up else 0:.0f}% hits),"
+            f" {count} fragments of {size / 2**20:.1f} MiB kept,"
+            f" {evicted} evicted"
+        )
+        if self.reader is not None:
+            self.reader.close()
+        self.conn.close()
@@ -8,18 +8,27 @@
 import functools
 import os
 import re
-import sys
 import json
-import shutil
 import sqlite3
 import argparse
-import glob
+import hashlib
+import multiprocessing
+import time
 
 from datetime import date
-from collections import defaultdict
+from collections import defaultdict, namedtuple
+from itertools import groupby
 from pathlib import Path
 
 from jinja2 import Environment, FileSystemLoader
+from markupsafe import Markup
+
+import catalog
+from dependencies import DependencyIndex
+from fragments import FragmentCache
+from journal import Journal
+from manifest import GENERATED, OutputManifest, in_scope
+from precompress import Precompressor
 
 ROOT_DIR = Path(__file__).parent.parent
 TEMPLATE_DIR = ROOT_DIR / "templates"
@@ -33,80 +42,815 @@ PRODUCT_VERSION_MAPPING = (
 )
 SITEMAP_URL = os.environ.get("SITEMAP_URL") or "https://localhost:8080"
 SEARCH_BACKEND = os.environ.get("SEARCH_BACKEND", False)
+JOURNAL_CONSUMER = "html"
+
+# Timings of the last run, which --plan estimates the cost of the next one
+# from.
+RUN_STATS_FILE = os.path.join(".sync", "html-run.json")
+# Size of the cache of rendered page sections shared by the pages of the
+# same build, see fragments.py.
+FRAGMENT_CACHE_SIZE = int(os.environ.get("FRAGMENT_CACHE_MB") or 512) * 2**20
+
+# Packages with more files than this get their file tree written to a
+# separate JSON fragment next to the page, which loads it on demand.
+LAZY_FILE_TREE = 2000
+FILE_TREE_SUFFIX = ".files.json"
+
+# Packages loaded by a single batch of BranchLoader queries. Bounds the memory
+# used per batch and the length of the IN lists.
+LOAD_WINDOW = 500
+
+# Templates of the sections of a release page that only depend on the build,
+# cached by pkgId. Bump FRAGMENTS_VERSION when the code preparing their data
+# changes, fragments rendered by another version are dropped.
+FRAGMENT_TEMPLATES = {
+    "changelog": "package-changelog.html.j2",
+    "provides": "package-provides.html.j2",
+    "files": "package-files.html.j2",
+}
+FRAGMENTS_VERSION = "2"
+
+
+@functools.lru_cache(maxsize=65536)
+def dir_prefixes(dirname):
+    """Return the paths of dirname and its parents as tuples, outermost first.
+
+    Cached, so the directories shared by the branches of a package, and by
+    most packages, are split once and the same tuples reused.
+    """
+    parts = tuple(part for part in dirname.split("/") if part != "")
+    return tuple(parts[: length + 1] for length in range(len(parts)))
+
+
+def collect_files(entries):
+    """Return the content of every directory listed in filelist rows.
+
+    The result maps the path of every directory, as a tuple, to a
+    {name: is directory} dict. Rows are added a whole at a time. A file
+    replaces a directory of the same path and a directory listed as parent
+    replaces a file, the later entry winning.
+    """
+    content = {(): {}}
+    for entry in entries:
+        prefixes = dir_prefixes(entry["dirname"])
+        parent = ()
+        for prefix in prefixes:
+            names = content[parent]
+            if names.get(prefix[-1]) is not True:
+                names[prefix[-1]] = True
+                content[prefix] = {}
+            parent = prefix
+
+        names = content[parent]
+        filenames = entry["filenames"].split("/")
+        filetypes = entry["filetypes"]
+        if "d" not in filetypes and names.keys().isdisjoint(filenames):
+            # The common case: a directory's files, listed once.
+            names.update(dict.fromkeys(filenames, False))
+            continue
+        for (index, filename) in enumerate(filenames):
+            if index < len(filetypes) and filetypes[index] == "d":
+                if filename not in names:
+                    names[filename] = True
+                    content[parent + (filename,)] = {}
+            else:
+                names[filename] = False
+    return content
+
+
+def build_file_tree(entries):
+    """Return the flat list the files section of a page is rendered from.
+
+    entries are filelist rows. Every directory of the list is followed by
+    its content and an exit-list, names sorted at every level, and the whole
+    list ends with an exit-list closing the root. Flattened with an explicit
+    stack rather than recursion, so deep trees are fine.
+    """
+    content = collect_files(entries)
+    data = []
+    stack = [((), iter(sorted(content[()])))]
+    while stack:
+        (path, names) = stack[-1]
+        for name in names:
+            if content[path][name]:
+                data.append({"name": name, "control": "dir"})
+                child = path + (name,)
+                stack.append((child, iter(sorted(content[child]))))
+                break
+            data.append({"name": name, "control": "file"})
+        else:
+            stack.pop()
+            if data:
+                data.append({"control": "exit-list"})
+    return data
 
 
-class Package:
-    def __init__(self, name):
-        self.name = name
-        self.summary = "No summary specified."
-        self.description = "No description specified."
+def file_tree_fragment(entries):
+    """Return the file tree of filelist rows as JSON.
+
+    The tree is a list of entries sorted by name, a file being its name and
+    a directory a [name, entries] pair, which is what vue/src/FileTree.vue
+    expands on demand. The output only depends on the tree, so unchanged
+    trees give identical files.
+    """
+    content = collect_files(entries)
+    root = []
+    stack = [((), root)]
+    while stack:
+        (path, listing) = stack.pop()
+        for name in sorted(content[path]):
+            if content[path][name]:
+                children = []
+                listing.append([name, children])
+                stack.append((path + (name,), children))
+            else:
+                listing.append(name)
+    return json.dumps(root, separators=(",", ":"))
 
-        self.license = "unknown"
-        self.upstream = ""
-        self.maintainers = []
-        self.releases = {}
-        self.source = ""
 
-    def set_release(self, name, pkgKey, branch, arch, revision, human_name=None):
-        if name not in self.releases:
-            self.releases[name] = {}
+def has_fragments(known):
+    """Return True if the cached sections known are all a page needs."""
+    if "file-count" not in known:
+        return False
+    files = "file-tree" if int(known["file-count"]) > LAZY_FILE_TREE else "files"
+    return all(section in known for section in ("changelog", "provides", files))
 
-        if "branches" not in self.releases[name]:
-            self.releases[name]["branches"] = {}
 
-        if branch not in self.releases[name]:
-            self.releases[name]["branches"][branch] = {}
+def fragment_version():
+    """Identify how fragments are rendered, from their templates and code."""
+    digest = hashlib.sha256(FRAGMENTS_VERSION.encode())
+    for name in FRAGMENT_TEMPLATES.values():
+        digest.update((TEMPLATE_DIR / name).read_bytes())
+    return digest.hexdigest()
 
-        self.releases[name]["branches"][branch]["revision"] = revision
-        self.releases[name]["branches"][branch]["pkg_key"] = pkgKey
-        self.releases[name]["branches"][branch]["arch"] = arch
-        self.releases[name]["human_name"] = human_name or name
 
-    def get_release(self, name):
-        return self.releases[name]["branches"]
+def has_table(conn, table):
+    result = conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+    )
+    return result.fetchone() is not None
 
 
-def open_db(db):
-    conn = sqlite3.connect(os.path.join(DBS_DIR, db))
+def open_db_readonly(db):
+    conn = catalog.open_db_readonly(DBS_DIR, db)
     conn.row_factory = sqlite3.Row
-    c = conn.cursor()
+    return conn
 
-    return (conn, c)
+
+def make_env():
+    return Environment(
+        loader=FileSystemLoader(TEMPLATE_DIR),
+        autoescape=True,
+        trim_blocks=True,
+        lstrip_blocks=True
+    )
 
 
-def clean_dir(path):
-    files = glob.glob(os.path.join(path, "*.html"))
-    for file in files:
-        try:
-            os.remove(file)
-        except:
-            print("Error cleaning directory!")
-            print(sys.exc_info()[0])
+# Data of a package page, as rows of the filelist, changelog, provides,
+# requires and required_by queries of BranchLoader.
+PageData = namedtuple(
+    "PageData", ["files", "changelog", "provides", "requires", "required_by"]
+)
+
+
+# Providers of the requirements of a window of packages, from the table the
+# sync materializes, or by resolving them when it is missing.
+RESOLVED_REQUIRES_QUERY = """
+    SELECT pkgKey, flags, version, release, provider_srpm, provider_name
+    FROM resolved_requires WHERE pkgKey IN ({})
+    ORDER BY pkgKey, rowid
+"""
+RESOLVE_REQUIRES_QUERY = """
+    SELECT requires.pkgKey, requires.flags, requires.version, requires.release, packages.rpm_sourcerpm_name AS provider_srpm, packages.name AS provider_name FROM requires
+    INNER JOIN provides ON requires.name=provides.name
+    INNER JOIN packages ON provides.pkgkey=packages.pkgkey
+    WHERE requires.pkgKey IN ({})
+    GROUP BY requires.pkgKey, packages.name
+    ORDER BY requires.pkgKey, packages.name
+"""
+
+# Packages requiring each package of a window, from the required_by table the
+# sync builds.
+REQUIRED_BY_QUERY = """
+    SELECT packages.pkgKey, required_by.dependent_name, required_by.dependent_srpm
+    FROM packages
+        INNER JOIN required_by ON required_by.provider_name = packages.name
+    WHERE packages.pkgKey IN ({})
+    ORDER BY packages.pkgKey, required_by.rowid
+"""
+
+
+class BranchLoader:
+    """Loads the page data of the packages of one release_branch in batches.
+
+    Rather than four queries per page, load() reads the files, changelog,
+    provides and requires of a window of packages with four queries, walking
+    each table in pkgKey order and splitting the rows as they stream in.
+
+    Requirements are read from the resolved_requires table the sync builds.
+    Databases synced before it existed are resolved with the join it
+    replaced, and have no dependents until they are synced again.
+    """
+
+    def __init__(self, primary, filelist, other):
+        self.primary = primary
+        self.filelist = filelist
+        self.other = other
+        self.resolved = has_table(primary, "resolved_requires")
+        self.reverse = has_table(primary, "required_by")
+        self.queries = 0
+        self.seconds = 0.0
+        self.dependency_seconds = 0.0
+
+    def _grouped(self, conn, query, pkg_keys):
+        placeholders = ", ".join("?" * len(pkg_keys))
+        self.queries += 1
+        rows = conn.execute(query.format(placeholders), pkg_keys)
+        return {
+            pkg_key: list(group)
+            for (pkg_key, group) in groupby(rows, key=lambda row: row["pkgKey"])
+        }
+
+    def pkg_ids(self, pkg_keys):
+        """Return {pkgKey: pkgId} of pkg_keys."""
+        placeholders = ", ".join("?" * len(pkg_keys))
+        self.queries += 1
+        rows = self.primary.execute(
+            f"SELECT pkgKey, pkgId FROM packages WHERE pkgKey IN ({placeholders})",
+            pkg_keys,
+        )
+        return {row["pkgKey"]: row["pkgId"] for row in rows}
+
+    def load(self, pkg_keys, cached=()):
+        """Return {pkgKey: PageData} for up to LOAD_WINDOW pkg_keys.
+
+        The files, changelog and provides of the pkg_keys in cached, whose
+        sections are rendered already, are not loaded.
+        """
+        start = time.perf_counter()
+        built = [pkg_key for pkg_key in pkg_keys if pkg_key not in cached]
+        files = changelog = provides = {}
+        # Rows of a package come in the order the per-package queries used
+        # to return them: insertion order, names sorted when grouped.
+        if built:
+            files = self._grouped(
+                self.filelist,
+                "SELECT * FROM filelist WHERE pkgKey IN ({}) ORDER BY pkgKey, rowid",
+                built,
+            )
+            changelog = self._grouped(
+                self.other,
+                "SELECT * FROM changelog WHERE pkgKey IN ({}) ORDER BY pkgKey, rowid",
+                built,
+            )
+            provides = self._grouped(
+                self.primary,
+                """
+                SELECT pkgKey, name FROM provides WHERE pkgKey IN ({})
+                GROUP BY pkgKey, name ORDER BY pkgKey, name
+                """,
+                built,
+            )
+        resolving = time.perf_counter()
+        requires = self._grouped(
+            self.primary,
+            RESOLVED_REQUIRES_QUERY if self.resolved else RESOLVE_REQUIRES_QUERY,
+            pkg_keys,
+        )
+        required_by = (
+            self._grouped(self.primary, REQUIRED_BY_QUERY, pkg_keys)
+            if self.reverse
+            else {}
+        )
+        self.dependency_seconds += time.perf_counter() - resolving
+        self.seconds += time.perf_counter() - start
+        return {
+            pkg_key: PageData(
+                files.get(pkg_key, []),
+                changelog.get(pkg_key, []),
+                [row["name"] for row in provides.get(pkg_key, [])],
+                requires.get(pkg_key, []),
+                required_by.get(pkg_key, []),
+            )
+            for pkg_key in pkg_keys
+        }
 
 
-def save_to(path, content):
-    with open(path, "w") as fh:
-        fh.write(content)
+class PageRenderer:
+    """Renders the pages of source packages and their subpackages.
+
+    Every process rendering pages has its own instance, with its own
+    read-only database connections and compiled templates.
+    """
+
+    changelog_mail_pattern = re.compile("<(.+@.+)>")
+
+    def __init__(self, databases, packages, output_dir, manifest, fragments):
+        self.packages = packages
+        self.output_dir = output_dir
+        self.manifest = manifest
+        self.fragments = fragments
+        self.db_conns = {
+            release_branch: {
+                "filelist": open_db_readonly(dbs["filelists"]),
+                "other": open_db_readonly(dbs["other"]),
+                "primary": open_db_readonly(dbs["primary"]),
+            }
+            for (release_branch, dbs) in databases.items()
+        }
+        self.loaders = {
+            release_branch: BranchLoader(
+                conns["primary"], conns["filelist"], conns["other"]
+            )
+            for (release_branch, conns) in self.db_conns.items()
+        }
+        env = make_env()
+        self.source_package_template = env.get_template("source-package.html.j2")
+        self.package_template = env.get_template("package.html.j2")
+        self.details_template = env.get_template("package-details.html.j2")
+        self.fragment_templates = {
+            section: env.get_template(name)
+            for (section, name) in FRAGMENT_TEMPLATES.items()
+        }
+
+    def render(self, src_pkg):
+        """Render the index pages of src_pkg and its subpackages that need an
+        update.
+
+        Returns the names of the subpackages rendered.
+        """
+        src_dir = os.path.join("pkgs", src_pkg)
+        subpackages = self.packages[src_pkg]
+        related_pkg_list = sorted(pkg.name for pkg in subpackages.values())
+
+        # Generate source pkg index page if needed
+        if any(pkg.should_update for pkg in subpackages.values()):
+            source_package_index_html = self.source_package_template.render(
+                name=src_pkg, children=subpackages, search_backend=SEARCH_BACKEND
+            )
+            os.makedirs(os.path.join(self.output_dir, src_dir), exist_ok=True)
+            self.manifest.write(
+                os.path.join(src_dir, "index.html"), source_package_index_html
+            )
+
+        # Process subpackages
+        rendered = []
+        for pkg in subpackages.values():
+            if pkg.should_update == False:
+                continue
+            pkg_dir = os.path.join(src_dir, pkg.name)
+            os.makedirs(os.path.join(self.output_dir, pkg_dir), exist_ok=True)
+
+            html_path = os.path.join(pkg_dir, "index.html")
+            html_content = self.package_template.render(
+                pkg=pkg,
+                releases=pkg.releases,
+                related_pkgs=related_pkg_list,
+                search_backend=SEARCH_BACKEND,
+            )
+            self.manifest.write(html_path, html_content)
+            rendered.append(pkg.name)
+        return rendered
+
+    def render_window(self, release_branch, window):
+        """Render the release_branch pages of the packages in window.
+
+        window is a list of (pkgKey, source package, package, release,
+        branch) sorted by pkgKey, their data is loaded in one batch.
+        Returns the number of pages rendered.
+        """
+        loader = self.loaders[release_branch]
+        pkg_keys = [item[0] for item in window]
+        pkg_ids = loader.pkg_ids(pkg_keys)
+        known = self.fragments.lookup(pkg_ids.values())
+        cached = {
+            pkg_key
+            for pkg_key in pkg_keys
+            if has_fragments(known.get(pkg_ids.get(pkg_key), {}))
+        }
+        data = loader.load(pkg_keys, cached)
+        for (pkg_key, src_pkg, name, release, branch) in window:
+            pkg = self.packages[src_pkg][name]
+            pkg_dir = os.path.join("pkgs", src_pkg, name)
+            pkg_id = pkg_ids.get(pkg_key)
+            self.render_release(
+                pkg,
+                pkg_dir,
+                release,
+                branch,
+                data[pkg_key],
+                pkg_id,
+                known.setdefault(pkg_id, {}),
+            )
+        return len(window)
+
+    def changelog_entries(self, rows):
+        """Return the changelog rows of a package as shown on its pages."""
+        changelog = []
+        for change in rows:
+            # Make addresses less obvious to spot for spam bots.
+            author = change["author"]
+            if self.changelog_mail_pattern.search(change["author"]):
+                addr = self.changelog_mail_pattern.findall(change["author"])[0]
+                obfuscated_addr = (
+                    addr.replace("@", " at ")
+                    .replace(".", " dot ")
+                    .replace("-", " dash ")
+                )
+                author = author.replace(addr, obfuscated_addr)
+
+            changelog += [
+                {
+                    "author": author,
+                    "timestamp": change["date"],
+                    "date": date.fromtimestamp(change["date"]),
+                    "change": change["changelog"],
+                }
+            ]
+        return changelog
+
+    def render_release(self, pkg, pkg_dir, release, branch, data, pkg_id, known):
+        """Render the page of pkg in one release_branch from its PageData.
+
+        pkg_dir is relative to the output directory. The sections that only
+        depend on the build pkg_id are taken from known, its fragments
+        looked up in the cache, or rendered and cached.
+        """
+        if branch == "base":
+            release_branch = release
+        else:
+            release_branch = "{}-{}".format(release, branch)
 
+        def fragment(section, render):
+            return self.fragments.fragment(pkg_id, section, known, render)
 
-def gen_file_array(dir_representation, data=None):
-    if not data:
-        data = []
-    for dir in sorted(dir_representation):
-        if type(dir_representation[dir]) is str:
-            data.append({"name": dir, "control": "file"})
+        # Generate files page for pkg. Large trees are loaded by the page
+        # when the files are shown, instead of inflating its HTML.
+        file_count = int(
+            fragment(
+                "file-count",
+                lambda: str(sum(len(entry["filetypes"]) for entry in data.files)),
+            )
+        )
+        files_url = None
+        files_html = ""
+        if file_count > LAZY_FILE_TREE:
+            files_url = release_branch + FILE_TREE_SUFFIX
+            self.manifest.write(
+                os.path.join(pkg_dir, files_url),
+                fragment("file-tree", lambda: file_tree_fragment(data.files)),
+            )
         else:
-            data.append({"name": dir, "control": "dir"})
-            data = gen_file_array(dir_representation[dir], data)
+            files_html = fragment(
+                "files",
+                lambda: self.fragment_templates["files"].render(
+                    files=build_file_tree(data.files)
+                ),
+            )
 
-    if len(data) != 0:
-        data.append({"control": "exit-list"})
-    return data
+        changelog_html = fragment(
+            "changelog",
+            lambda: self.fragment_templates["changelog"].render(
+                changelog=self.changelog_entries(data.changelog)
+            ),
+        )
+        provides_html = fragment(
+            "provides",
+            lambda: self.fragment_templates["provides"].render(provides=data.provides),
+        )
 
+        # Generate dependencies for pkg
+        requires = []
+        for require in data.requires:
+            flags = ""
+            if require["flags"] == "EQ":
+                flags = "="
+            elif require["flags"] == "GE":
+                flags = ">="
+            elif require["flags"] == "GT":
+                flags = ">"
+            elif require["flags"] == "LE":
+                flags = "<="
+            elif require["flags"] == "LT":
+                flags = "<"
+            require_srpm_name = require["provider_srpm"]
+            requires.append(
+                {
+                    "requirement": require["provider_name"],
+                    "flags": flags,
+                    "version": require["version"],
+                    "release": require["release"],
+                    "can_link": bool(
+                        self.packages[require_srpm_name].get(require["provider_name"])
+                    ),
+                    "srpm_name": require_srpm_name,
+                }
+            )
 
-def do_regex(pattern, string):
-    (result) = pattern.findall(string)[0]
-    return result
+        required_by = [
+            {
+                "name": dependent["dependent_name"],
+                "srpm_name": dependent["dependent_srpm"],
+                "can_link": bool(
+                    self.packages[dependent["dependent_srpm"]].get(
+                        dependent["dependent_name"]
+                    )
+                ),
+            }
+            for dependent in data.required_by
+        ]
+
+        html_path = os.path.join(pkg_dir, release_branch + ".html")
+        html_content = self.details_template.render(
+            pkg=pkg,
+            release=release,
+            branch=branch,
+            build=pkg.build(release, branch),
+            human_name=pkg.human_name(release),
+            changelog_html=Markup(changelog_html),
+            files_html=Markup(files_html),
+            files_url=files_url,
+            file_count=file_count,
+            provides_html=Markup(provides_html),
+            requires=requires,
+            required_by=required_by,
+            search_backend=SEARCH_BACKEND,
+        )
+        self.manifest.write(html_path, html_content)
+
+    def stats(self):
+        """Return (queries, seconds, dependency seconds) of loading so far."""
+        return (
+            sum(loader.queries for loader in self.loaders.values()),
+            sum(loader.seconds for loader in self.loaders.values()),
+            sum(loader.dependency_seconds for loader in self.loaders.values()),
+        )
+
+    def render_window_counted(self, release_branch, window):
+        """render_window, also returning what loading its data cost."""
+        before = self.stats()
+        count = self.render_window(release_branch, window)
+        after = self.stats()
+        return (count,) + tuple(b - a for (a, b) in zip(before, after))
+
+    def close(self):
+        for conns in self.db_conns.values():
+            for conn in conns.values():
+                conn.close()
+
+
+def release_windows(packages, src_pkgs):
+    """Split the release pages of src_pkgs in LOAD_WINDOW sized batches.
+
+    Yields (release_branch, window) with window a list of (pkgKey, source
+    package, package, release, branch) sorted by pkgKey.
+    """
+    pages = defaultdict(list)
+    for src_pkg in src_pkgs:
+        for pkg in packages[src_pkg].values():
+            if pkg.should_update == False:
+                continue
+            for (release, entry) in pkg.releases.items():
+                for (branch, info) in entry["branches"].items():
+                    if branch == "base":
+                        release_branch = release
+                    else:
+                        release_branch = "{}-{}".format(release, branch)
+                    pages[release_branch].append(
+                        (info["pkg_key"], src_pkg, pkg.name, release, branch)
+                    )
+
+    for release_branch in sorted(pages):
+        items = sorted(pages[release_branch])
+        for start in range(0, len(items), LOAD_WINDOW):
+            yield (release_branch, items[start : start + LOAD_WINDOW])
+
+
+# Renderer of a worker process of render_pages, set by init_worker.
+worker_renderer = None
+
+
+def init_worker(databases, packages, output_dir, manifest, fragments):
+    global worker_renderer
+    worker_renderer = PageRenderer(
+        databases, packages, output_dir, manifest, fragments
+    )
+
+
+# Workers write through their copy of the manifest and send their writes
+# back with every result, for the parent to record. So do they with the
+# fragments they rendered and reused.
+def render_in_worker(src_pkg):
+    rendered = worker_renderer.render(src_pkg)
+    return (rendered, worker_renderer.manifest.take())
+
+
+def render_window_in_worker(task):
+    result = worker_renderer.render_window_counted(*task)
+    return (
+        result,
+        worker_renderer.manifest.take(),
+        worker_renderer.fragments.take(),
+    )
+
+
+def start_workers(jobs, databases, packages, output_dir, manifest, fragments):
+    """Fork the jobs processes of render_pages, or return None for one job.
+
+    Workers are forked once the package metadata is loaded and share it.
+    This has to happen before the parent starts threads, which the forked
+    processes would inherit the locks of without the threads releasing them.
+    """
+    if jobs == 1:
+        return None
+    context = multiprocessing.get_context("fork")
+    return context.Pool(
+        jobs, init_worker, (databases, packages, output_dir, manifest, fragments)
+    )
+
+
+def render_pages(
+    pool,
+    jobs,
+    src_pkgs,
+    databases,
+    packages,
+    output_dir,
+    manifest,
+    fragments,
+    max_page_count,
+):
+    """Render the pages of src_pkgs with jobs processes.
+
+    Package index pages are rendered first, then the release pages in
+    batches of packages of the same release_branch. pool holds the workers
+    of start_workers(), every page is written by exactly one of them. Pages
+    are written through manifest, which records them. Sections of release
+    pages are cached in fragments. Returns (subpackages rendered, release
+    pages rendered, seconds).
+    """
+    start = time.perf_counter()
+    page_count = 0
+    release_count = 0
+    queries = 0
+    load_seconds = 0.0
+    dependency_seconds = 0.0
+    windows = list(release_windows(packages, src_pkgs))
+    max_release_count = sum(len(window) for (_, window) in windows)
+
+    def progress(rendered):
+        nonlocal page_count
+        for name in rendered:
+            # Simple way to display progress.
+            page_count += 1
+            if page_count % 100 == 0 or page_count == max_page_count:
+                print(
+                    f"Processed {page_count}/{max_page_count} package pages.. {name}"
+                )
+
+    def release_progress(result):
+        nonlocal release_count, queries, load_seconds, dependency_seconds
+        (count, window_queries, window_seconds, window_dependencies) = result
+        release_count += count
+        queries += window_queries
+        load_seconds += window_seconds
+        dependency_seconds += window_dependencies
+        print(f"Processed {release_count}/{max_release_count} release pages..")
+
+    if pool is None:
+        renderer = PageRenderer(databases, packages, output_dir, manifest, fragments)
+        for src_pkg in src_pkgs:
+            progress(renderer.render(src_pkg))
+            manifest.record(manifest.take())
+        for window in windows:
+            release_progress(renderer.render_window_counted(*window))
+            manifest.record(manifest.take())
+            fragments.record(fragments.take())
+        renderer.close()
+    else:
+        for (rendered, writes) in pool.imap_unordered(
+            render_in_worker, src_pkgs, chunksize=8
+        ):
+            progress(rendered)
+            manifest.record(writes)
+        # Release pages go to the directories created above, so they are
+        # only rendered once every package index page is done.
+        for (result, writes, rendered) in pool.imap_unordered(
+            render_window_in_worker, windows
+        ):
+            release_progress(result)
+            manifest.record(writes)
+            fragments.record(rendered)
+        pool.close()
+        pool.join()
+
+    elapsed = time.perf_counter() - start
+    print(
+        f"> Rendered {page_count} packages of {len(src_pkgs)} source packages"
+        f" with {jobs} process{'es' if jobs > 1 else ''} in {elapsed:.1f}s"
+        f" ({page_count / elapsed if elapsed else 0:.0f} packages/s)"
+    )
+    print(
+        f"> Loaded the data of {release_count} release pages with {queries}"
+        f" queries in {load_seconds:.1f}s"
+        f" ({queries / release_count if release_count else 0:.3f} queries/page)"
+    )
+    print(
+        f"> Resolved their dependencies in {dependency_seconds:.1f}s"
+        f" ({dependency_seconds * 1000 / release_count if release_count else 0:.3f}"
+        " ms/page)"
+    )
+    return (page_count, release_count, elapsed)
+
+
+def plan_pages(packages, scopes, output_dir):
+    """Return {release_branch: [render, delete, skip]} counts of release pages.
+
+    Pages are deleted the way OutputManifest.reconcile() does it: those of
+    the manifest within scopes, or within the directory of a package
+    rendered, that the run does not produce again.
+    """
+    counts = defaultdict(lambda: [0, 0, 0])
+    rendered = set()
+    scopes = set(scopes)
+    for (src_pkg, subpackages) in packages.items():
+        for pkg in subpackages.values():
+            if pkg.should_update:
+                scopes.add(f"pkgs/{src_pkg}/{pkg.name}/")
+            for (release, entry) in pkg.releases.items():
+                for branch in entry["branches"]:
+                    if branch == "base":
+                        release_branch = release
+                    else:
+                        release_branch = "{}-{}".format(release, branch)
+                    if pkg.should_update:
+                        counts[release_branch][0] += 1
+                        rendered.add(f"pkgs/{src_pkg}/{pkg.name}/{release_branch}.html")
+                    else:
+                        counts[release_branch][2] += 1
+
+    for path in OutputManifest(output_dir).digests:
+        parts = path.split("/")
+        if (
+            len(parts) != 4
+            or parts[0] != "pkgs"
+            or parts[3] == "index.html"
+            or not parts[3].endswith(".html")
+        ):
+            continue
+        if path not in rendered and in_scope(path, scopes):
+            counts[parts[3][: -len(".html")]][1] += 1
+    return dict(sorted(counts.items()))
+
+
+def print_plan(counts, to_render, jobs, run_stats):
+    """Print the release pages a run would render, delete and skip.
+
+    The time is estimated from run_stats, the timings of the last run: its
+    cost per release page, spread over jobs processes, and what the rest of
+    the run took.
+    """
+    width = max([len("release_branch")] + [len(name) for name in counts])
+    print(f"> Plan: {len(to_render)} source packages to render.")
+    print(f"  {'release_branch'.ljust(width)}   render   delete     skip")
+    totals = [0, 0, 0]
+    for (release_branch, row) in counts.items():
+        print(f"  {release_branch.ljust(width)} " + "".join(f"{n:9}" for n in row))
+        totals = [total + n for (total, n) in zip(totals, row)]
+    print(f"  {'total'.ljust(width)} " + "".join(f"{n:9}" for n in totals))
+
+    if not run_stats or not run_stats["release_pages"]:
+        print("> No previous run to estimate the time of this one from.")
+        return
+    page_seconds = (
+        run_stats["render_seconds"] * run_stats["jobs"] / run_stats["release_pages"]
+    )
+    other_seconds = run_stats["seconds"] - run_stats["render_seconds"]
+    estimate = other_seconds + totals[0] * page_seconds / jobs
+    print(
+        f"> Estimated time: {estimate:.0f}s with {jobs} process"
+        f"{'es' if jobs > 1 else ''}, at {page_seconds * 1000:.1f} ms per"
+        f" release page and process and {other_seconds:.0f}s for the rest, as"
+        f" the last run ({run_stats['release_pages']} release pages with"
+        f" {run_stats['jobs']} process{'es' if run_stats['jobs'] > 1 else ''}"
+        f" in {run_stats['seconds']:.0f}s)."
+    )
+
+
+def load_run_stats():
+    try:
+        with open(os.path.join(DBS_DIR, RUN_STATS_FILE)) as raw:
+            return json.load(raw)
+    except (OSError, ValueError):
+        return None
+
+
+def save_run_stats(run_stats):
+    path = os.path.join(DBS_DIR, RUN_STATS_FILE)
+    temp = f"{path}.tmp"
+    with open(temp, "w") as fh:
+        json.dump(run_stats, fh)
+    os.replace(temp, path)
 
 
 def main():
@@ -117,20 +861,42 @@ def main():
     parser.add_argument(
         "--target-dir", dest="target_dir", action="store", required=True
     )
+    parser.add_argument(
+        "--jobs",
+        dest="jobs",
+        type=int,
+        default=1,
+        help="number of processes rendering package pages (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--precompress",
+        dest="precompress",
+        action="store_true",
+        help="write .gz (and .br) siblings of the files written",
+    )
+    parser.add_argument(
+        "--changed-urls",
+        dest="changed_urls",
+        action="store",
+        help="write the URL paths written or deleted by this run to this file",
+    )
 
-    args = parser.parse_args()
+    parser.add_argument(
+        "--plan",
+        dest="plan",
+        action="store_true",
+        help="print the pages a run would render and delete, and an estimate of"
+        " its time, without writing anything",
+    )
 
-    # Make sure output directory exists.
+    args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    start = time.perf_counter()
     output_dir = Path(args.target_dir)
-    os.makedirs(output_dir, exist_ok=True)
 
     # Initialize templating system.
-    env = Environment(
-        loader=FileSystemLoader(TEMPLATE_DIR),
-        autoescape=True,
-        trim_blocks=True,
-        lstrip_blocks=True
-    )
+    env = make_env()
 
     # Load maintainer mapping (imported from dist-git).
     # TODO: check that mapping exist / error.
@@ -143,140 +909,70 @@ def main():
     with open(PRODUCT_VERSION_MAPPING) as raw:
         release_mapping = json.load(raw)
 
-    # Group databases files.
-    databases = defaultdict(dict)
-    db_pattern = re.compile(
-        "^(fedora|epel)-([\w|-]+)_(primary|filelists|other).sqlite$"
-    )
-    for db in os.listdir(DBS_DIR):
-        if not db_pattern.match(db):
-            sys.exit("Invalid object in {}: {}".format(DBS_DIR, db))
-
-        (product, branch, db_type) = db_pattern.findall(db)[0]
-        release_branch = "{}-{}".format(product, branch)
-        if release_branch in release_mapping:
-            databases[release_branch][db_type] = db
+    databases = catalog.group_databases(DBS_DIR, release_mapping)
 
-    # Build internal package metadata structure / cache.
-    # { "src_pkg": { "subpackage": pkg, ... } }
-    db_conns = {}
-    packages = {}
-    partial_update = False
+    # Replay the change journal written by fetch-repository-dbs.py since our
+    # last successful run. Without a cursor every page is regenerated.
+    journal = Journal(DBS_DIR, readonly=args.plan)
+    (journal_seq, entries) = journal.pending(JOURNAL_CONSUMER)
+    full_update = entries is None
+    full_update_branches = set()
+    changed_packages = set()
     removed_packages = set()
-    changelog_mail_pattern = re.compile("<(.+@.+)>")
-    release_branch_pattern = re.compile("^([fedora|epel]+-[\w|\d]+)-?([a-z|-]+)?$")
-    for release_branch in databases.keys():
-        print("> Processing database files for {}.".format(release_branch))
-
-        for db_type in ["primary", "filelists", "other"]:
-            if db_type not in databases[release_branch]:
-                sys.exit("No {} database for {}.".format(db_type, release_branch))
-
-        (_, primary) = open_db(databases[release_branch]["primary"])
-        (_, filelist) = open_db(databases[release_branch]["filelists"])
-        (_, other) = open_db(databases[release_branch]["other"])
-
-        db_conns[release_branch] = {
-            "filelist": filelist,
-            "other": other,
-            "primary": primary,
-        }
-
-        # Check if this db has a changes table
-        primary.execute(
-            "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'changes'"
-        )
-        partial_update = primary.fetchone() is not None
-
-        partial_update_packages = []
-        if partial_update:
-            primary.execute("SELECT name, rpm_sourcerpm_name FROM changes")
-            for row in primary.fetchall():
-                partial_update_packages.append((row["rpm_sourcerpm_name"], row["name"]))
-
-        for raw in primary.execute("SELECT * FROM packages"):
-            # Get source rpm name
-            srpm_name = raw["rpm_sourcerpm_name"]
-
-            # Check if package is already data structure
-            src_pkg = packages.get(srpm_name)
-            if src_pkg:
-                pkg = src_pkg.get(raw["name"])
+    for entry in entries or []:
+        if entry.change == "full":
+            if entry.release_branch is None:
+                full_update = True
             else:
-                pkg = None
-            revision = "{}-{}".format(raw["version"], raw["release"])
-            first_pkg_encounter = False
-
-            # Register unknown packages.
-            if pkg == None:
-                pkg = Package(raw["name"])
-                if not srpm_name in packages:
-                    packages[srpm_name] = {}
-                packages[srpm_name][pkg.name] = pkg
-                first_pkg_encounter = True
-                pkg.source = srpm_name
-
-            # Override package metadata with rawhide (= lastest) values.
-            if first_pkg_encounter or release_branch == "fedora-rawhide":
-                pkg.summary = raw["summary"]
-                pkg.description = raw["description"]
-                pkg.upstream = raw["url"]
-                pkg.license = raw["rpm_license"]
-                pkg.maintainers = maintainer_mapping["rpms"].get(srpm_name, [])
-
-            # Check if package should be updated during a partial update
-            if partial_update and (srpm_name, pkg.name) in partial_update_packages:
-                pkg.should_update = True
-            elif first_pkg_encounter and partial_update:
-                pkg.should_update = False
-
-            # If a changes table does not exist, then the package should
-            # always be updated.
-            if not partial_update:
-                pkg.should_update = True
-
-            # XXX: we do not resolve files and changelog here because storing
-            # them in the packages hash would require multiple GBs of RAM
-            # (roughly 1GB per repository).
-
-            # Always register branch-specific metadata.
-            (release, branch) = release_branch_pattern.findall(release_branch)[0]
-            if branch == "":
-                branch = "base"
-
-            pkg.set_release(
-                release,
-                raw["pkgKey"],
-                branch,
-                raw["arch"],
-                revision,
-                release_mapping.get(release),
-            )
+                full_update_branches.add(entry.release_branch)
+            continue
+
+        changed_packages.add((entry.rpm_sourcerpm_name, entry.name))
+        if entry.change == "removed":
+            removed_packages.add((entry.rpm_sourcerpm_name, entry.name))
 
-        # Get removed packages to determine if folder needs to be deleted later
-        if partial_update:
-            for removed in primary.execute(
-                "SELECT name, rpm_sourcerpm_name FROM changes WHERE change = 'removed'"
-            ):
-                removed_packages.add((removed["rpm_sourcerpm_name"], removed["name"]))
+    if full_update:
+        print("> Regenerating all package pages.")
+    else:
+        print("> Replaying {} journal entries.".format(len(entries)))
+
+    # Build internal package metadata structure / cache.
+    # { "src_pkg": { "subpackage": pkg, ... } }
+    package_catalog = catalog.load(DBS_DIR, databases, journal, save=not args.plan)
+    packages = package_catalog.packages(release_mapping, maintainer_mapping)
+
+    # Pages linking to a package that was added, removed or moved to another
+    # source package change with it, find them from the dependency links.
+    dependency_index = DependencyIndex(DBS_DIR, readonly=args.plan)
+    linked_packages = dependency_index.update(databases)
+
+    # Check if package should be updated during a partial update
+    for release_branch in full_update_branches:
+        changed_packages.update(package_catalog.names(release_branch))
+    changed_packages.update(linked_packages)
+    for (src_pkg, subpackages) in packages.items():
+        for pkg in subpackages.values():
+            pkg.should_update = full_update or (src_pkg, pkg.name) in changed_packages
+
+    # Parts of the output tree regenerated by this run. Files of the
+    # manifest in there that are not written again are deleted at the end.
+    if full_update:
+        scopes = list(GENERATED)
+    else:
+        scopes = [part for part in GENERATED if part != "pkgs/"]
 
-    # If a package was removed and it was not in any repository, attempt to
-    # delete the folder from the target directory
+    # If a package was removed and it was not in any repository, delete its
+    # folder from the target directory
     for removed_package in removed_packages:
         # If the source package is gone, delete all data
         if removed_package[0] not in packages:
-            shutil.rmtree(os.path.join(output_dir, "pkgs", removed_package[0]), True)
+            scopes.append(f"pkgs/{removed_package[0]}/")
         # If only a subpackage of the source package is gone, then just delete that.
         elif (
             removed_package[0] in packages
             and removed_package[1] not in packages[removed_package[0]]
         ):
-            shutil.rmtree(
-                os.path.join(
-                    output_dir, "pkgs", removed_package[0], removed_package[1]
-                ),
-                True,
-            )
+            scopes.append(f"pkgs/{removed_package[0]}/{removed_package[1]}/")
         # Otherwise, a branch was removed but it's still in others so just update the package.
         # This isn't caught by above logic because release with changed data will not process a package that doesn't exist.
         elif packages[removed_package[0]][removed_package[1]].should_update == False:
@@ -284,6 +980,33 @@ def main():
 
     print(">>> {} packages have been extracted.".format(len(packages)))
 
+    to_render = [
+        src_pkg
+        for src_pkg in packages
+        if any(pkg.should_update for pkg in packages[src_pkg].values())
+    ]
+    if args.plan:
+        print_plan(
+            plan_pages(packages, scopes, output_dir),
+            to_render,
+            args.jobs,
+            load_run_stats(),
+        )
+        journal.close()
+        dependency_index.close()
+        return
+
+    # Make sure output directory exists.
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = OutputManifest(output_dir)
+    fragments = FragmentCache(DBS_DIR, fragment_version(), FRAGMENT_CACHE_SIZE)
+    pool = start_workers(
+        args.jobs, databases, packages, output_dir, manifest, fragments
+    )
+    # Compressing threads are only started once the workers are forked.
+    precompressor = Precompressor(args.jobs) if args.precompress else None
+    manifest.precompressor = precompressor
+
     # Generate main user entrypoint.
     print("Generating index pages...")
     main_is_static = True if SEARCH_BACKEND is False else False
@@ -324,25 +1047,22 @@ def main():
     )
 
     if main_is_static:
-        save_to(output_dir / "index.html", static_index_html)
+        manifest.write("index.html", static_index_html)
     else:
-        save_to(output_dir / "index-static.html", static_index_html)
-        save_to(output_dir / "index.html", search_html)
+        manifest.write("index-static.html", static_index_html)
+        manifest.write("index.html", search_html)
 
     index_tpl = env.get_template("index-prefix.html.j2")
-    index_dir = os.path.join(output_dir, "index")
-    os.makedirs(index_dir, exist_ok=True)
+    os.makedirs(output_dir / "index", exist_ok=True)
     for prefix, names in prefix_index.items():
         html = index_tpl.render(
             prefix=prefix, packages=names, main_is_static=main_is_static
         )
-        save_to(os.path.join(index_dir, f"{prefix}.html"), html)
+        manifest.write(os.path.join("index", f"{prefix}.html"), html)
 
     # Generate sitemaps
     sitemap_list = []
-    sitemap_dir = os.path.join(output_dir, "sitemaps")
-    shutil.rmtree(sitemap_dir, ignore_errors=True)
-    os.makedirs(sitemap_dir, exist_ok=True)
+    os.makedirs(output_dir / "sitemaps", exist_ok=True)
     i = 0
     # Number of pkgs in one sitemap. Should not be above 50,000
     # https://www.sitemaps.org/protocol.html#index
@@ -353,8 +1073,8 @@ def main():
         crawler_sitemap_xml = crawler_sitemap.render(
             packages=sitemap_pkgs, url=SITEMAP_URL
         )
-        save_to(
-            os.path.join(sitemap_dir, "sitemap{}.xml".format(i)), crawler_sitemap_xml
+        manifest.write(
+            os.path.join("sitemaps", "sitemap{}.xml".format(i)), crawler_sitemap_xml
         )
         sitemap_list.append("/sitemaps/sitemap{}.xml".format(i))
         i = i + 1
@@ -362,198 +1082,63 @@ def main():
 
     sitemap_sitemap = env.get_template("sitemap-index.xml.j2")
     sitemap_sitemap_xml = sitemap_sitemap.render(sitemaps=sitemap_list, url=SITEMAP_URL)
-    save_to(os.path.join(output_dir, "sitemap.xml"), sitemap_sitemap_xml)
+    manifest.write("sitemap.xml", sitemap_sitemap_xml)
+    manifest.record(manifest.take())
 
     # Generate package pages from Rawhide.
     print("> Generating package pages...")
 
-    page_count = 0
-
-    # Generate package index and version pages
-    for src_pkg in packages:
-        src_dir = os.path.join(output_dir, "pkgs", src_pkg)
-        related_pkg_list = []
-        should_update_src = False
-        for pkg in packages[src_pkg]:
-            if not should_update_src and packages[src_pkg][pkg].should_update == True:
-                should_update_src = True
-            related_pkg_list.append(packages[src_pkg][pkg].name)
-        related_pkg_list = sorted(related_pkg_list)
-
-        # Generate source pkg index page if needed
-        if should_update_src:
-            os.makedirs(src_dir, exist_ok=True)
-
-            source_package_index = env.get_template("source-package.html.j2")
-            source_package_index_html = source_package_index.render(
-                name=src_pkg, children=packages[src_pkg], search_backend=SEARCH_BACKEND
-            )
-            save_to(os.path.join(src_dir, "index.html"), source_package_index_html)
-
-        # Process subpackages
-        for pkg in packages[src_pkg].values():
-            if pkg.should_update == False:
-                continue
-            pkg_dir = os.path.join(src_dir, pkg.name)
-            clean_dir(pkg_dir)
-            os.makedirs(pkg_dir, exist_ok=True)
-
-            html_path = os.path.join(pkg_dir, "index.html")
-            html_template = env.get_template("package.html.j2")
-            html_content = html_template.render(
-                pkg=pkg, related_pkgs=related_pkg_list, search_backend=SEARCH_BACKEND
-            )
-            save_to(html_path, html_content)
-
-            # Simple way to display progress.
-            page_count += 1
-            if page_count % 100 == 0 or page_count == max_page_count:
-                print(
-                    f"Processed {page_count}/{max_page_count} package pages.. {pkg.name}"
-                )
-
-            for release in pkg.releases.keys():
-                for branch in pkg.get_release(release).keys():
-                    if branch == "base":
-                        release_branch = release
-                    else:
-                        release_branch = "{}-{}".format(release, branch)
-
-                    pkg_key = pkg.get_release(release)[branch]["pkg_key"]
-                    revision = pkg.get_release(release)[branch]["revision"]
-
-                    filelist = db_conns[release_branch]["filelist"]
-                    other = db_conns[release_branch]["other"]
-                    primary = db_conns[release_branch]["primary"]
-
-                    # Generate files page for pkg.
-                    # Create a nested object to represent the file tree
-                    files = {}
-                    for entry in filelist.execute(
-                        "SELECT * FROM filelist WHERE pkgKey = ?", (pkg_key,)
-                    ):
-                        filenames = entry["filenames"].split("/")
-                        filetype_index = 0
-                        for filename in filenames:
-                            try:
-                                filetype = entry["filetypes"][filetype_index]
-                            except Exception:
-                                filetype = "?"
-
-                            current = files
-                            for dir in entry["dirname"].split("/"):
-                                if dir != "":
-                                    if dir not in current or type(current[dir]) == str:
-                                        current[dir] = {}
-                                    current = current[dir]
-
-                            if filetype == "d" and not filename in current:
-                                current[filename] = {}
-                            elif filetype != "d":
-                                current[filename] = filetype
-                            filetype_index += 1
-                    # Flatten and sort the files structure for jinja
-                    files = gen_file_array(files)
-
-                    # Generate changelog page for pkg.
-                    changelog = []
-                    for change in other.execute(
-                        "SELECT * FROM changelog WHERE pkgKey = ?", (pkg_key,)
-                    ):
-                        # Make addresses less obvious to spot for spam bots.
-                        author = change["author"]
-                        if changelog_mail_pattern.search(change["author"]):
-                            addr = changelog_mail_pattern.findall(change["author"])[0]
-                            obfuscated_addr = (
-                                addr.replace("@", " at ")
-                                .replace(".", " dot ")
-                                .replace("-", " dash ")
-                            )
-                            author = author.replace(addr, obfuscated_addr)
-
-                        changelog += [
-                            {
-                                "author": author,
-                                "timestamp": change["date"],
-                                "date": date.fromtimestamp(change["date"]),
-                                "change": change["changelog"],
-                            }
-                        ]
-
-                    # Generate provides list for pkg.
-                    provides = []
-                    try:
-                        for provide in primary.execute(
-                            "SELECT name FROM provides where pkgkey = ? GROUP BY name",
-                            (pkg_key,),
-                        ):
-                            provides.append(provide["name"])
-                    except Exception as e:
-                        print(e)
-                        print(databases[release_branch]["primary"])
-
-                        primary.execute("PRAGMA database_list")
-                        rows = primary.fetchall()
-
-                        for row in rows:
-                            print(row[0], row[1], row[2])
-
-                        primary.execute(
-                            "SELECT name FROM sqlite_master WHERE type='table';"
-                        )
-                        print(primary.fetchall())
-                        sys.exit(1)
-
-                    # Generate dependencies for pkg
-                    requires = []
-                    for require in primary.execute(
-                        """
-                        SELECT requires.flags, requires.version, requires.release, packages.rpm_sourcerpm_name, packages.name AS provides FROM requires
-                        INNER JOIN provides ON requires.name=provides.name
-                        INNER JOIN packages ON provides.pkgkey=packages.pkgkey
-                        WHERE requires.pkgkey = ?
-                        GROUP BY packages.name
-                        """,
-                        (pkg_key,),
-                    ):
-                        flags = ""
-                        if require["flags"] == "EQ":
-                            flags = "="
-                        elif require["flags"] == "GE":
-                            flags = ">="
-                        elif require["flags"] == "GT":
-                            flags = ">"
-                        elif require["flags"] == "LE":
-                            flags = "<="
-                        elif require["flags"] == "LT":
-                            flags = "<"
-                        require_srpm_name = require["rpm_sourcerpm_name"]
-                        requires.append(
-                            {
-                                "requirement": require["provides"],
-                                "flags": flags,
-                                "version": require["version"],
-                                "release": require["release"],
-                                "can_link": bool(
-                                    packages[require_srpm_name].get(require["provides"])
-                                ),
-                                "srpm_name": require_srpm_name,
-                            }
-                        )
-
-                    html_path = os.path.join(pkg_dir, release_branch + ".html")
-                    html_template = env.get_template("package-details.html.j2")
-                    html_content = html_template.render(
-                        pkg=pkg,
-                        release=release,
-                        branch=branch,
-                        changelog=changelog,
-                        files=files,
-                        provides=provides,
-                        requires=requires,
-                        search_backend=SEARCH_BACKEND,
-                    )
-                    save_to(html_path, html_content)
+    (page_count, release_count, render_seconds) = render_pages(
+        pool,
+        args.jobs,
+        to_render,
+        databases,
+        packages,
+        output_dir,
+        manifest,
+        fragments,
+        max_page_count,
+    )
+    fragments.close()
+
+    # The pages of every package rendered were all written again, whatever
+    # else is in their directory is outdated.
+    if not full_update:
+        scopes += [
+            f"pkgs/{src_pkg}/{pkg.name}/"
+            for src_pkg in to_render
+            for pkg in packages[src_pkg].values()
+            if pkg.should_update
+        ]
+    manifest.reconcile(scopes)
+    if precompressor is not None:
+        precompressor.close()
+    manifest.save()
+    print(
+        f"> Output: {manifest.written} files written, {manifest.unchanged}"
+        f" unchanged, {manifest.deleted} deleted."
+    )
+    if args.changed_urls:
+        urls = manifest.changed_urls()
+        with open(args.changed_urls, "w") as fh:
+            fh.writelines(f"{url}\n" for url in urls)
+        print(f"> Listed {len(urls)} changed URLs in {args.changed_urls}.")
+
+    # Everything journaled up to here is now rendered, and so are the
+    # dependency links read for it.
+    journal.advance(JOURNAL_CONSUMER, journal_seq)
+    journal.close()
+    dependency_index.commit()
+    dependency_index.close()
+    if release_count:
+        save_run_stats(
+            {
+                "jobs": args.jobs,
+                "release_pages": release_count,
+                "render_seconds": render_seconds,
+                "seconds": time.perf_counter() - start,
+            }
+        )
 
     print("DONE.")
     print("> {} packages processed.".format(page_count))
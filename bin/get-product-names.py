@@ -3,14 +3,18 @@
 # Used to generate a file mapping branches to product names
 # E.g. fedroa-rawhide -> Fedora Rawhide, fedora-33 -> Fedora 33
 import os
-from typing import final
+import argparse
 import requests
 import json
 
+from httpcache import LocalAdapter, ResponseCache, mirror_url
+
 PRODUCT_VERSION_MAPPING = (
     os.environ.get("PRODUCT_VERSION_MAPPING") or "product_version_mapping.json"
 )
 PDC_URI = "https://pdc.fedoraproject.org/rest_api/v1/product-versions"
+# Shared with fetch-repository-dbs.py, which keeps its state in the same place.
+HTTP_CACHE_DIR = os.path.join(os.environ.get("DB_DIR") or "repositories", ".sync", "http")
 
 
 def get_name(name):
@@ -19,22 +23,41 @@ def get_name(name):
     return name
 
 
-def get_data(URI, previous_data=None):
+def get_data(URI, session, cache, previous_data=None):
     formatted_data = previous_data or {}
-    raw_data = requests.get(URI).json()
+    response = cache.get(session, URI)
+    response.raise_for_status()
+    raw_data = response.json()
 
     for result in raw_data["results"]:
         formatted_data[result["product_version_id"]] = get_name(result["name"])
 
     # Recurise function to do pagination
     if raw_data["next"]:
-        return get_data(raw_data["next"], formatted_data)
+        return get_data(raw_data["next"], session, cache, formatted_data)
     else:
         return formatted_data
 
 
 def main():
-    final_data = get_data(PDC_URI)
+    parser = argparse.ArgumentParser(
+        description="Map Fedora/EPEL release branches to product names"
+    )
+    parser.add_argument(
+        "--mirror",
+        dest="mirror",
+        action="store",
+        help="read the PDC listing from this URL or local directory",
+    )
+    args = parser.parse_args()
+
+    uri = PDC_URI
+    if args.mirror:
+        uri = f"{mirror_url(args.mirror)}/pdc/rest_api/v1/product-versions"
+
+    session = requests.Session()
+    session.mount("file://", LocalAdapter())
+    final_data = get_data(uri, session, ResponseCache(HTTP_CACHE_DIR))
     with open(PRODUCT_VERSION_MAPPING, "w") as outfile:
         json.dump(final_data, outfile, indent=2)
 
@@ -0,0 +1,139 @@
+#
+# HTTP helpers shared by the scripts fetching data from the mirrors and PDC.
+#
+#   * ResponseCache keeps a local copy of small documents (repomd.xml, PDC
+#     listings) and revalidates it with ETag / Last-Modified, so unchanged
+#     documents cost a 304 instead of a full download.
+#   * LocalAdapter lets a requests.Session read file:// URLs, which is what
+#     the --mirror option of the scripts uses for air-gapped runs.
+import email.utils
+import hashlib
+import io
+import json
+import os
+
+from urllib.parse import unquote, urlparse
+
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+
+class LocalAdapter(BaseAdapter):
+    """Transport adapter serving file:// URLs from the local filesystem.
+
+    A directory is served through its index.json and query strings are
+    ignored, so a mirror can be laid out as plain files.
+    """
+
+    def send(self, request, **kwargs):
+        path = unquote(urlparse(request.url).path)
+        if os.path.isdir(path):
+            path = os.path.join(path, "index.json")
+
+        response = requests.Response()
+        response.url = request.url
+        response.request = request
+        response.headers = CaseInsensitiveDict()
+        if not os.path.isfile(path):
+            response.status_code = 404
+            response.reason = "Not Found"
+            response.raw = io.BytesIO(b"")
+            return response
+
+        stat = os.stat(path)
+        last_modified = email.utils.formatdate(stat.st_mtime, usegmt=True)
+        response.headers["Last-Modified"] = last_modified
+        response.headers["Content-Length"] = str(stat.st_size)
+        if request.headers.get("If-Modified-Since") == last_modified:
+            response.status_code = 304
+            response.reason = "Not Modified"
+            response.raw = io.BytesIO(b"")
+        else:
+            response.status_code = 200
+            response.reason = "OK"
+            if request.method == "HEAD":
+                response.raw = io.BytesIO(b"")
+            else:
+                response.raw = open(path, "rb")
+        return response
+
+    def close(self):
+        pass
+
+
+def mirror_url(location):
+    """Return the base URL of a mirror given as URL or local directory."""
+    if os.path.isdir(location):
+        return "file://" + os.path.abspath(location)
+    return location.rstrip("/")
+
+
+class ResponseCache:
+    """Conditional GETs backed by local copies of the responses."""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get(self, session, url, params=None, **kwargs):
+        """GET url, revalidating a cached copy if there is one.
+
+        Returns a requests.Response. When the server answers 304 the cached
+        body is returned with status 200 and response.from_cache set.
+        """
+        prepared = requests.Request("GET", url, params=params).prepare()
+        key = hashlib.sha256(prepared.url.encode()).hexdigest()
+        meta_path = os.path.join(self.cache_dir, f"{key}.json")
+        body_path = os.path.join(self.cache_dir, f"{key}.body")
+
+        meta = None
+        headers = {}
+        if os.path.isfile(meta_path) and os.path.isfile(body_path):
+            with open(meta_path) as raw:
+                meta = json.load(raw)
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+        response = session.get(prepared.url, headers=headers, **kwargs)
+        if response.status_code == 304 and meta is not None:
+            cached = requests.Response()
+            cached.status_code = 200
+            cached.reason = "OK (cached)"
+            cached.url = prepared.url
+            cached.encoding = meta.get("encoding")
+            cached.headers = CaseInsensitiveDict(meta.get("headers", {}))
+            with open(body_path, "rb") as raw:
+                cached._content = raw.read()
+            cached.from_cache = True
+            return cached
+
+        response.from_cache = False
+        if response.ok and (
+            response.headers.get("ETag") or response.headers.get("Last-Modified")
+        ):
+            self._store(body_path, response.content)
+            self._store(
+                meta_path,
+                json.dumps(
+                    {
+                        "url": prepared.url,
+                        "etag": response.headers.get("ETag"),
+                        "last_modified": response.headers.get("Last-Modified"),
+                        "encoding": response.encoding,
+                        "headers": {
+                            "Content-Type": response.headers.get("Content-Type", "")
+                        },
+                    }
+                ).encode(),
+            )
+        return response
+
+    @staticmethod
+    def _store(path, content):
+        temp = f"{path}.tmp"
+        with open(temp, "wb") as fh:
+            fh.write(content)
+        os.replace(temp, path)
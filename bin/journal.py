@@ -0,0 +1,182 @@
+#
+# Persistent log of package changes found by fetch-repository-dbs.py.
+#
+# Every sync appends the changes of each repository with an increasing
+# sequence number. Consumers (generate-html.py, update-solr.py and the package
+# catalog they share) keep their own cursor and replay the entries recorded
+# since their last successful run, so a skipped or failed run is caught up by
+# the next one instead of being lost.
+import os
+import sqlite3
+import time
+
+from collections import namedtuple
+from pathlib import Path
+
+JOURNAL_FILE = os.path.join(".sync", "journal.sqlite")
+
+# change is 'added', 'removed' or 'updated' like in the changes tables of
+# the primary databases, or 'full' when every package of release_branch has
+# to be regenerated. A 'full' entry without release_branch covers everything.
+Entry = namedtuple(
+    "Entry", ["seq", "release_branch", "name", "arch", "rpm_sourcerpm_name", "change"]
+)
+
+
+class Journal:
+    def __init__(self, dbs_dir, readonly=False):
+        """Open the journal of dbs_dir.
+
+        With readonly, the journal is only read, and a missing one is
+        treated as empty instead of being created: every consumer is then
+        pending a full rebuild.
+        """
+        path = os.path.join(dbs_dir, JOURNAL_FILE)
+        if not readonly:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.conn = sqlite3.connect(path)
+        elif os.path.isfile(path):
+            uri = Path(path).resolve().as_uri() + "?mode=ro"
+            self.conn = sqlite3.connect(uri, uri=True)
+            return
+        else:
+            self.conn = sqlite3.connect(":memory:")
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS entries (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                recorded INTEGER NOT NULL,
+                release_branch TEXT,
+                name TEXT,
+                arch TEXT,
+                rpm_sourcerpm_name TEXT,
+                version TEXT,
+                change TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS cursors (
+                consumer TEXT PRIMARY KEY,
+                seq INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS inputs (
+                consumer TEXT PRIMARY KEY,
+                digest TEXT NOT NULL
+            );
+            """
+        )
+
+    def append_changes(self, release_branch, primary_db):
+        """Append the rows of the changes table of primary_db."""
+        self.conn.execute("ATTACH DATABASE ? AS repo", (primary_db,))
+        count = self.conn.execute(
+            """
+            INSERT INTO entries (recorded, release_branch, name, arch,
+                rpm_sourcerpm_name, version, change)
+            SELECT ?, ?, name, arch, rpm_sourcerpm_name, version, change
+            FROM repo.changes
+            """,
+            (int(time.time()), release_branch),
+        ).rowcount
+        self.conn.commit()
+        self.conn.execute("DETACH DATABASE repo")
+        return count
+
+    def append_removed_branch(self, release_branch, primary_db):
+        """Journal every package of primary_db as removed from release_branch.
+
+        Used before the databases of an end-of-life release are deleted.
+        """
+        self.conn.execute("ATTACH DATABASE ? AS repo", (primary_db,))
+        count = self.conn.execute(
+            """
+            INSERT INTO entries (recorded, release_branch, name, arch,
+                rpm_sourcerpm_name, version, change)
+            SELECT ?, ?, name, arch, rpm_sourcerpm_name,
+                IIF(epoch IS NOT NULL, epoch || ':', '') || version || '-' || release,
+                'removed'
+            FROM repo.packages
+            """,
+            (int(time.time()), release_branch),
+        ).rowcount
+        self.conn.commit()
+        self.conn.execute("DETACH DATABASE repo")
+        return count
+
+    def append_full(self, release_branch=None):
+        """Ask consumers to regenerate release_branch, or everything if None."""
+        self.conn.execute(
+            "INSERT INTO entries (recorded, release_branch, change) VALUES (?, ?, 'full')",
+            (int(time.time()), release_branch),
+        )
+        self.conn.commit()
+
+    def cursor(self, consumer):
+        """Sequence number of the last entry consumer processed, or None."""
+        row = self.conn.execute(
+            "SELECT seq FROM cursors WHERE consumer = ?", (consumer,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def pending(self, consumer):
+        """Return (last_seq, entries) recorded since consumer's cursor.
+
+        entries is None if consumer never ran, meaning everything is pending.
+        Pass last_seq to advance() once the entries have been processed.
+        """
+        (last_seq,) = self.conn.execute(
+            "SELECT COALESCE(MAX(seq), 0) FROM entries"
+        ).fetchone()
+        cursor = self.cursor(consumer)
+        if cursor is None:
+            # Entries may have been pruned before this consumer first ran.
+            return (last_seq, None)
+
+        entries = self.conn.execute(
+            """
+            SELECT seq, release_branch, name, arch, rpm_sourcerpm_name, change
+            FROM entries WHERE seq > ? AND seq <= ? ORDER BY seq
+            """,
+            (cursor, last_seq),
+        )
+        return (last_seq, [Entry(*row) for row in entries])
+
+    def inputs(self, consumer):
+        """Digest of the other inputs consumer last processed, or None."""
+        row = self.conn.execute(
+            "SELECT digest FROM inputs WHERE consumer = ?", (consumer,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def advance(self, consumer, seq, inputs=None):
+        """Move the cursor of consumer to seq.
+
+        inputs is a digest of what else consumer's output depends on, kept
+        along with the cursor and returned by inputs().
+        """
+        self.conn.execute(
+            "INSERT OR REPLACE INTO cursors (consumer, seq) VALUES (?, ?)",
+            (consumer, seq),
+        )
+        if inputs is not None:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO inputs (consumer, digest) VALUES (?, ?)",
+                (consumer, inputs),
+            )
+        self.conn.commit()
+
+    def prune(self):
+        """Drop the entries every consumer has already processed.
+
+        Consumers that never ran do not hold entries back, they rebuild
+        everything on their first run.
+        """
+        (oldest,) = self.conn.execute("SELECT MIN(seq) FROM cursors").fetchone()
+        if oldest is None:
+            query = ("DELETE FROM entries", ())
+        else:
+            query = ("DELETE FROM entries WHERE seq <= ?", (oldest,))
+        count = self.conn.execute(*query).rowcount
+        self.conn.commit()
+        return count
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,189 @@
+#
+# Content manifest of the output directory of generate-html.py.
+#
+# Every generated file is written through OutputManifest, which records the
+# sha256 of its content. A file whose content did not change is not written
+# again, so its mtime and inode stay the same and rsync or a CDN have nothing
+# to transfer. Files that were generated before but not by the current run
+# are found by diffing the manifest, in the parts of the tree the run
+# regenerated, and deleted.
+#
+# The paths written or deleted by a run are what a cache in front of the
+# site has to purge, see changed_urls().
+import hashlib
+import json
+import os
+
+from precompress import is_compressed, remove_siblings
+
+MANIFEST_FILE = ".manifest.json"
+
+# Parts of the output directory written by generate-html.py, directories
+# ending with "/". Everything else (assets, favicon) is left alone.
+GENERATED = [
+    "pkgs/",
+    "index/",
+    "sitemaps/",
+    "index.html",
+    "index-static.html",
+    "sitemap.xml",
+]
+
+
+def in_scope(path, scopes):
+    """Return True if path is one of scopes or inside a directory of them."""
+    if path in scopes:
+        return True
+    end = path.find("/")
+    while end != -1:
+        if path[: end + 1] in scopes:
+            return True
+        end = path.find("/", end + 1)
+    return False
+
+
+class OutputManifest:
+    def __init__(self, output_dir, precompressor=None):
+        self.output_dir = str(output_dir)
+        # Precompressor the files written are passed to, if any.
+        self.precompressor = precompressor
+        self.path = os.path.join(self.output_dir, MANIFEST_FILE)
+        # Path relative to output_dir -> sha256 hexdigest of the content, or
+        # None for files found on disk without a manifest.
+        self.digests = {}
+        if os.path.isfile(self.path):
+            with open(self.path) as raw:
+                self.digests = json.load(raw)
+        else:
+            self.digests = dict.fromkeys(self._walk())
+
+        # Writes not yet passed to record(), as (path, digest, written).
+        self.pending = []
+        # Files produced by this run.
+        self.produced = {}
+        # Files written or deleted by this run.
+        self.changed = []
+        self.written = 0
+        self.unchanged = 0
+        self.deleted = 0
+
+    def _walk(self):
+        """Yield the generated files found in output_dir.
+
+        Compressed siblings of other files are not part of the manifest.
+        """
+        for part in GENERATED:
+            path = os.path.join(self.output_dir, part)
+            if not part.endswith("/"):
+                if os.path.isfile(path):
+                    yield part
+                continue
+            for (dirpath, _, filenames) in os.walk(path):
+                names = set(filenames)
+                for filename in filenames:
+                    if is_compressed(filename) and filename[:-3] in names:
+                        continue
+                    yield os.path.relpath(
+                        os.path.join(dirpath, filename), self.output_dir
+                    )
+
+    def write(self, path, content):
+        """Write content (str or bytes) to path, relative to output_dir.
+
+        The file is only written if its content differs from the manifest.
+        Returns True if it was written.
+        """
+        if isinstance(content, str):
+            content = content.encode()
+        digest = hashlib.sha256(content).hexdigest()
+        full_path = os.path.join(self.output_dir, path)
+
+        known = self.digests.get(path, False)
+        if known is None and os.path.isfile(full_path):
+            with open(full_path, "rb") as fh:
+                known = hashlib.sha256(fh.read()).hexdigest()
+        written = known != digest or not os.path.isfile(full_path)
+        if written:
+            # Never leave siblings of the previous content next to the new
+            # one, nginx would go on serving them.
+            if not is_compressed(path):
+                remove_siblings(full_path)
+            temp = f"{full_path}.tmp"
+            with open(temp, "wb") as fh:
+                fh.write(content)
+            os.replace(temp, full_path)
+        self.pending.append((path, digest, written))
+        return written
+
+    def take(self):
+        """Return the writes made since the last call and forget them.
+
+        Processes writing through a copy of the manifest send these to the
+        parent, which passes them to record().
+        """
+        (pending, self.pending) = (self.pending, [])
+        return pending
+
+    def record(self, writes):
+        for (path, digest, written) in writes:
+            self.produced[path] = digest
+            if written:
+                self.written += 1
+                self.changed.append(path)
+            else:
+                self.unchanged += 1
+            if self.precompressor is None or is_compressed(path):
+                continue
+            full_path = os.path.join(self.output_dir, path)
+            if written or self.precompressor.missing(full_path):
+                self.precompressor.submit(full_path)
+
+    def reconcile(self, scopes):
+        """Delete the files of the manifest this run did not produce.
+
+        Only files within scopes are considered: paths relative to
+        output_dir, directories ending with "/". Empty directories left
+        behind are removed.
+        """
+        scopes = set(scopes)
+        for path in list(self.digests):
+            if path in self.produced or not in_scope(path, scopes):
+                continue
+
+            del self.digests[path]
+            full_path = os.path.join(self.output_dir, path)
+            if not is_compressed(path):
+                remove_siblings(full_path)
+            try:
+                os.remove(full_path)
+            except FileNotFoundError:
+                continue
+            self.deleted += 1
+            self.changed.append(path)
+
+            directory = os.path.dirname(full_path)
+            while os.path.abspath(directory) != os.path.abspath(self.output_dir):
+                try:
+                    os.rmdir(directory)
+                except OSError:
+                    break
+                directory = os.path.dirname(directory)
+
+    def changed_urls(self):
+        """Return the sorted URL paths whose response changed in this run.
+
+        A directory index is listed under the URL of its directory too.
+        """
+        urls = set()
+        for path in self.changed:
+            urls.add(f"/{path}")
+            if os.path.basename(path) == "index.html":
+                urls.add(f"/{path[: -len('index.html')]}")
+        return sorted(urls)
+
+    def save(self):
+        self.digests.update(self.produced)
+        temp = f"{self.path}.tmp"
+        with open(temp, "w") as fh:
+            json.dump(self.digests, fh, separators=(",", ":"), sort_keys=True)
+        os.replace(temp, self.path)
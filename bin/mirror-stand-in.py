@@ -0,0 +1,139 @@
+#!/usr/bin/python3
+#
+# Serve a local copy of the mirror layout over HTTP, as a stand-in for
+# dl.fedoraproject.org, kojipkgs and PDC on hosts without network access:
+#
+#   bin/mirror-stand-in.py --root /srv/mirror --port 8000 &
+#   bin/fetch-repository-dbs.py --target-dir repositories --mirror http://localhost:8000
+#
+# The layout under --root mirrors the public servers (see README). Query
+# strings are ignored and a directory is served through its index.json.
+# Responses carry ETag and Last-Modified, honour conditional and Range
+# requests, and can be made to fail at random to exercise the retry logic:
+#
+#   --fail-rate 0.2       answer 20% of the requests with 503
+#   --truncate-rate 0.3   drop the connection halfway through 30% of the bodies
+import argparse
+import email.utils
+import os
+import random
+import re
+
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlparse
+
+
+class MirrorHandler(SimpleHTTPRequestHandler):
+    fail_rate = 0.0
+    truncate_rate = 0.0
+    # Byte range of the current response, set by send_head
+    span = None
+
+    def translate_path(self, path):
+        path = os.path.join(self.directory, unquote(urlparse(path).path).lstrip("/"))
+        if os.path.isdir(path):
+            path = os.path.join(path, "index.json")
+        return path
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404, "File not found")
+            return None
+
+        if random.random() < self.fail_rate:
+            self.send_error(503, "Injected failure")
+            return None
+
+        stat = os.stat(path)
+        etag = f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+        last_modified = email.utils.formatdate(stat.st_mtime, usegmt=True)
+        if self.headers.get("If-None-Match") == etag or (
+            "If-None-Match" not in self.headers
+            and self.headers.get("If-Modified-Since") == last_modified
+        ):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return None
+
+        (first, last) = (0, stat.st_size - 1)
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if match and stat.st_size:
+            first = int(match.group(1))
+            if match.group(2):
+                last = min(int(match.group(2)), last)
+            if first > last:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{stat.st_size}")
+                self.end_headers()
+                return None
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {first}-{last}/{stat.st_size}")
+        else:
+            self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Type", self.guess_type(path))
+        self.send_header("Content-Length", str(last - first + 1))
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", last_modified)
+        self.end_headers()
+        self.span = (first, last)
+        return open(path, "rb")
+
+    def copyfile(self, source, outputfile):
+        (first, last) = self.span
+        length = last - first + 1
+        truncated = random.random() < self.truncate_rate
+        if truncated:
+            length //= 2
+        source.seek(first)
+        while length > 0:
+            chunk = source.read(min(64 * 1024, length))
+            if not chunk:
+                break
+            outputfile.write(chunk)
+            length -= len(chunk)
+        if truncated:
+            # Leave the client with a short body and a dead connection.
+            self.close_connection = True
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve a local mirror directory as an HTTP stand-in"
+    )
+    parser.add_argument("--root", dest="root", action="store", required=True)
+    parser.add_argument("--port", dest="port", type=int, default=8000)
+    parser.add_argument("--bind", dest="bind", action="store", default="127.0.0.1")
+    parser.add_argument(
+        "--fail-rate",
+        dest="fail_rate",
+        type=float,
+        default=0.0,
+        help="fraction of requests answered with 503",
+    )
+    parser.add_argument(
+        "--truncate-rate",
+        dest="truncate_rate",
+        type=float,
+        default=0.0,
+        help="fraction of responses cut off halfway through the body",
+    )
+    parser.add_argument(
+        "--seed", dest="seed", type=int, help="seed of the injected faults"
+    )
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    MirrorHandler.fail_rate = args.fail_rate
+    MirrorHandler.truncate_rate = args.truncate_rate
+    handler = partial(MirrorHandler, directory=os.path.abspath(args.root))
+    server = ThreadingHTTPServer((args.bind, args.port), handler)
+    print(f"Serving {args.root} on http://{args.bind}:{args.port}/")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
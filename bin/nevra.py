@@ -0,0 +1,131 @@
+#
+# Pure Python parsing of RPM name-[epoch:]version-release.arch strings.
+#
+# This mirrors the HY_FORM_NEVRA pattern used by libdnf (hawkey), so the bin/
+# scripts agree with what dnf would report without importing the DNF stack.
+import re
+import sys
+
+from collections import namedtuple
+
+NEVRA = namedtuple("NEVRA", ["name", "epoch", "version", "release", "arch"])
+
+# Same character classes as libdnf's nevra.cpp: the name is greedy and may
+# contain dashes, version and release may not, the arch has no dots either.
+NEVRA_PATTERN = re.compile(
+    r"^([^:(/=<> ]+)-(?:([0-9]+):)?([^-:(/=<> ]+)-([^-:(/=<> ]+)\.([^-.:(/=<> ]+)$"
+)
+
+# Source RPM file names with the shapes that trip up naive parsing, and the
+# name dnf gives them by parsing them as HY_FORM_NEVRA. check() compares
+# srpm_name with these, and bin/benchmark.py nevra with hawkey itself when
+# python3-dnf is installed.
+SOURCE_RPMS = {
+    "bash-5.2.15-5.fc39.src.rpm": "bash",
+    "python-requests-2.28.2-5.fc39.src.rpm": "python-requests",
+    "gcc-c++-13.2.1-4.fc39.src.rpm": "gcc-c++",
+    "389-ds-base-2.4.3-1.fc39.src.rpm": "389-ds-base",
+    "python3.12-3.12.0-1.fc39.src.rpm": "python3.12",
+    "R-Rcpp-1.0.11-1.fc39.src.rpm": "R-Rcpp",
+    "texlive-base-20230311-85.fc39.src.rpm": "texlive-base",
+    "kernel-6.5.6-300.fc39.src.rpm": "kernel",
+    "golang-github-foo-bar-0-0.1.20230101git1234abc.fc39.src.rpm": "golang-github-foo-bar",
+    "firefox-118.0~b9-1.fc39.src.rpm": "firefox",
+    "vim-9.0.1927-1.fc39.src.rpm": "vim",
+    "nodejs-18.18.0^2-1.fc39.src.rpm": "nodejs",
+    "perl-Test-Simple-1.302195-2.fc39.src.rpm": "perl-Test-Simple",
+    "xorg-x11-drv-intel-2.99.917-56.20210115.fc39.src.rpm": "xorg-x11-drv-intel",
+    "epel-release-9-7.el9.src.rpm": "epel-release",
+    "glibc-2.38-7.fc39.src.rpm": "glibc",
+    "libreoffice-7.6.2.1-1.fc39.src.rpm": "libreoffice",
+    "ghc-tar-conduit-0.3.2-10.fc39.src.rpm": "ghc-tar-conduit",
+    "mingw-gcc-13.2.1-1.fc39.src.rpm": "mingw-gcc",
+    "pkgconf-1.9.5-2.fc39.src.rpm": "pkgconf",
+    # Names with -<digit> segments.
+    "java-1.8.0-openjdk-1.8.0.392.b08-4.fc39.src.rpm": "java-1.8.0-openjdk",
+    "lib3-1-2-1.0-1.fc39.src.rpm": "lib3-1-2",
+    "python-2to3-1-1.0-1.fc39.src.rpm": "python-2to3-1",
+    # ~ and ^ in the release.
+    "gnome-shell-45.0-0.1~rc.fc39.src.rpm": "gnome-shell",
+    "mesa-23.3.0-0.2^20231010git.fc39.src.rpm": "mesa",
+    # Dotted and underscored release tags of EPEL, RHEL and modules.
+    "kernel-5.14.0-362.8.1.el9_3.src.rpm": "kernel",
+    "openssl-3.0.7-24.el9_3.1.src.rpm": "openssl",
+    "nodejs-18.18.2-1.module+el8.9.0+20473+c4e3d7e4.src.rpm": "nodejs",
+    "perl-DBD-Pg-3.7.4-4.module_el8.6.0+3178+d4ceadd0.src.rpm": "perl-DBD-Pg",
+}
+
+# Full parses of NEVRA strings, epochs included.
+NEVRAS = {
+    "bash-0:5.2.15-5.fc39.x86_64": NEVRA("bash", 0, "5.2.15", "5.fc39", "x86_64"),
+    "perl-Errno-4:1.37-502.fc39.noarch": NEVRA(
+        "perl-Errno", 4, "1.37", "502.fc39", "noarch"
+    ),
+    "java-17-openjdk-1:17.0.9.0.9-1.fc39.src": NEVRA(
+        "java-17-openjdk", 1, "17.0.9.0.9", "1.fc39", "src"
+    ),
+    "firefox-118.0~b9-1.fc39.x86_64": NEVRA(
+        "firefox", None, "118.0~b9", "1.fc39", "x86_64"
+    ),
+    "mesa-2:23.3.0^20231010-0.2~rc1.el9_3.aarch64": NEVRA(
+        "mesa", 2, "23.3.0^20231010", "0.2~rc1.el9_3", "aarch64"
+    ),
+}
+
+# Strings that are not NEVRAs, parse_nevra raises ValueError for them.
+MALFORMED = [
+    "bash",
+    "bash-5.2.15.src",
+    "bash-5.2.15-5_fc39",
+    "bash-x:5.2.15-5.fc39.src",
+    "bash 5.2.15-5.fc39.src",
+]
+
+
+def parse_nevra(string):
+    """Split a NEVRA string into its parts. The epoch is None if missing.
+
+    Raises ValueError if string is not a NEVRA.
+    """
+    match = NEVRA_PATTERN.match(string)
+    if match is None:
+        raise ValueError(f"Not a NEVRA: {string!r}")
+
+    (name, epoch, version, release, arch) = match.groups()
+    return NEVRA(name, int(epoch) if epoch else None, version, release, arch)
+
+
+def srpm_name(sourcerpm):
+    """Return the name of a source RPM from its file name.
+
+    "python-foo-1.0-1.fc39.src.rpm" -> "python-foo"
+    """
+    if sourcerpm.endswith(".rpm"):
+        sourcerpm = sourcerpm[: -len(".rpm")]
+    return parse_nevra(sourcerpm).name
+
+
+def check():
+    """Check the parser against SOURCE_RPMS, NEVRAS and MALFORMED.
+
+    Returns the number of strings it got wrong. Run with python3 bin/nevra.py
+    (make check), it does not need dnf.
+    """
+    cases = [(string, srpm_name, name) for (string, name) in SOURCE_RPMS.items()]
+    cases += [(string, parse_nevra, nevra) for (string, nevra) in NEVRAS.items()]
+    cases += [(string, parse_nevra, ValueError) for string in MALFORMED]
+    mismatches = 0
+    for (string, parse, expected) in cases:
+        try:
+            result = parse(string)
+        except ValueError:
+            result = ValueError
+        if result != expected:
+            print(f"!! {string}: {result!r} != {expected!r}")
+            mismatches += 1
+    print(f"{len(cases) - mismatches}/{len(cases)} strings parsed as expected")
+    return mismatches
+
+
+if __name__ == "__main__":
+    sys.exit(1 if check() else 0)
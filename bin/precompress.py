@@ -0,0 +1,101 @@
+#
+# Compressed siblings of the files generate-html.py writes.
+#
+# With --precompress, every page written gets a .gz sibling, and a .br one
+# if python3-brotli is installed, which nginx serves as is with gzip_static
+# (and brotli_static) instead of compressing the page on every request.
+# Siblings are compressed by a pool of threads while the pages are still
+# being rendered; zlib and brotli release the GIL while they compress.
+import gzip
+import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Suffixes of the compressed siblings, whether or not they are written.
+SUFFIXES = (".gz", ".br")
+
+
+def siblings(path):
+    return [f"{path}{suffix}" for suffix in SUFFIXES]
+
+
+def is_compressed(path):
+    return path.endswith(SUFFIXES)
+
+
+def remove_siblings(path):
+    """Remove the compressed siblings of path, now outdated."""
+    for sibling in siblings(path):
+        try:
+            os.remove(sibling)
+        except FileNotFoundError:
+            pass
+
+
+def write_atomic(path, content):
+    temp = f"{path}.tmp"
+    with open(temp, "wb") as fh:
+        fh.write(content)
+    os.replace(temp, path)
+
+
+def compress_file(path):
+    """Write the compressed siblings of path.
+
+    Returns (size, compressed sizes, seconds spent compressing).
+    """
+    start = time.perf_counter()
+    with open(path, "rb") as fh:
+        content = fh.read()
+    # mtime=0 keeps the .gz of the same content identical between runs.
+    compressed = [(".gz", gzip.compress(content, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        compressed.append((".br", brotli.compress(content, mode=brotli.MODE_TEXT)))
+    for (suffix, data) in compressed:
+        write_atomic(f"{path}{suffix}", data)
+    return (
+        len(content),
+        [len(data) for (_, data) in compressed],
+        time.perf_counter() - start,
+    )
+
+
+class Precompressor:
+    """Compress the files passed to submit() in the background."""
+
+    def __init__(self, jobs):
+        self.pool = ThreadPoolExecutor(jobs, thread_name_prefix="precompress")
+        self.futures = []
+
+    def submit(self, path):
+        self.futures.append(self.pool.submit(compress_file, path))
+
+    def missing(self, path):
+        """Return True if path lacks one of the siblings written for it."""
+        return not os.path.isfile(f"{path}.gz") or (
+            brotli is not None and not os.path.isfile(f"{path}.br")
+        )
+
+    def close(self):
+        """Wait for every file to be compressed and print a summary."""
+        self.pool.shutdown()
+        size = 0
+        compressed = 0
+        seconds = 0.0
+        for future in self.futures:
+            (file_size, sizes, file_seconds) = future.result()
+            size += file_size
+            compressed += min(sizes)
+            seconds += file_seconds
+        formats = "gzip and brotli" if brotli is not None else "gzip"
+        print(
+            f"> Precompressed {len(self.futures)} files with {formats}"
+            f" ({size / 2**20:.1f} MiB to {compressed / 2**20:.1f} MiB)"
+            f" in {seconds:.1f}s of compression"
+        )
@@ -0,0 +1,268 @@
+#
+# Build createrepo sqlite databases from repository XML metadata.
+#
+# Used by the zchunk sync mode of fetch-repository-dbs.py, where repositories
+# only provide primary, filelists and other as XML. The databases have the
+# schema createrepo_c gives its sqlite metadata, so the scripts reading them
+# do not need to know where they came from.
+#
+# createrepo_c writes the packages of the three documents in the same order
+# and numbers pkgKey in that order, which is what is done here too: the
+# pkgKey of a package is the same in all three databases.
+import sqlite3
+
+import defusedxml.ElementTree as ET
+
+COMMON_NS = "{http://linux.duke.edu/metadata/common}"
+RPM_NS = "{http://linux.duke.edu/metadata/rpm}"
+FILELISTS_NS = "{http://linux.duke.edu/metadata/filelists}"
+OTHER_NS = "{http://linux.duke.edu/metadata/other}"
+
+DB_VERSION = 10
+
+# Dependency tables of primary, one per rpm:<name> element of <format>.
+DEPENDENCIES = [
+    "provides",
+    "requires",
+    "conflicts",
+    "obsoletes",
+    "suggests",
+    "enhances",
+    "recommends",
+    "supplements",
+]
+
+SCHEMAS = {
+    "primary": """
+        CREATE TABLE db_info (dbversion INTEGER, checksum TEXT);
+        CREATE TABLE packages (
+            pkgKey INTEGER PRIMARY KEY, pkgId TEXT, name TEXT, arch TEXT,
+            version TEXT, epoch TEXT, release TEXT, summary TEXT,
+            description TEXT, url TEXT, time_file INTEGER, time_build INTEGER,
+            rpm_license TEXT, rpm_vendor TEXT, rpm_group TEXT,
+            rpm_buildhost TEXT, rpm_sourcerpm TEXT, rpm_header_start INTEGER,
+            rpm_header_end INTEGER, rpm_packager TEXT, size_package INTEGER,
+            size_installed INTEGER, size_archive INTEGER, location_href TEXT,
+            location_base TEXT, checksum_type TEXT
+        );
+        CREATE TABLE files (name TEXT, type TEXT, pkgKey INTEGER);
+        CREATE TABLE requires (
+            name TEXT, flags TEXT, epoch TEXT, version TEXT, release TEXT,
+            pkgKey INTEGER, pre BOOLEAN DEFAULT FALSE
+        );
+    """
+    + "".join(
+        f"""
+        CREATE TABLE {table} (
+            name TEXT, flags TEXT, epoch TEXT, version TEXT, release TEXT,
+            pkgKey INTEGER
+        );
+        """
+        for table in DEPENDENCIES
+        if table != "requires"
+    ),
+    "filelists": """
+        CREATE TABLE db_info (dbversion INTEGER, checksum TEXT);
+        CREATE TABLE packages (pkgKey INTEGER PRIMARY KEY, pkgId TEXT);
+        CREATE TABLE filelist (
+            pkgKey INTEGER, dirname TEXT, filenames TEXT, filetypes TEXT
+        );
+    """,
+    "other": """
+        CREATE TABLE db_info (dbversion INTEGER, checksum TEXT);
+        CREATE TABLE packages (pkgKey INTEGER PRIMARY KEY, pkgId TEXT);
+        CREATE TABLE changelog (
+            pkgKey INTEGER, author TEXT, date INTEGER, changelog TEXT
+        );
+    """,
+}
+
+# Indexes createrepo_c creates, fetch-repository-dbs.py adds its own on top.
+INDEXES = {
+    "primary": """
+        CREATE INDEX packagename ON packages (name);
+        CREATE INDEX packageId ON packages (pkgId);
+        CREATE INDEX filenames ON files (name);
+        CREATE INDEX pkgfiles ON files (pkgKey);
+        CREATE INDEX pkgprovides ON provides (pkgKey);
+        CREATE INDEX providesname ON provides (name);
+        CREATE INDEX pkgrequires ON requires (pkgKey);
+        CREATE INDEX requiresname ON requires (name);
+        CREATE INDEX pkgconflicts ON conflicts (pkgKey);
+        CREATE INDEX pkgobsoletes ON obsoletes (pkgKey);
+    """,
+    "filelists": """
+        CREATE INDEX keyfile ON filelist (pkgKey);
+        CREATE INDEX pkgId ON packages (pkgId);
+        CREATE INDEX dirnames ON filelist (dirname);
+    """,
+    "other": """
+        CREATE INDEX keychange ON changelog (pkgKey);
+        CREATE INDEX pkgId ON packages (pkgId);
+    """,
+}
+
+FILE_TYPES = {"file": "f", "dir": "d", "ghost": "g"}
+
+
+def iter_packages(xml_file, namespace):
+    """Yield the <package> elements of xml_file, freeing each once used."""
+    context = ET.iterparse(xml_file, events=("start", "end"))
+    (_, root) = next(context)
+    for (event, element) in context:
+        if event == "end" and element.tag == f"{namespace}package":
+            yield element
+            root.clear()
+
+
+def primary_rows(package, pkg_key, rows):
+    """Append the rows of a primary <package> to the lists in rows."""
+    version = package.find(f"{COMMON_NS}version")
+    checksum = package.find(f"{COMMON_NS}checksum")
+    time = package.find(f"{COMMON_NS}time")
+    size = package.find(f"{COMMON_NS}size")
+    location = package.find(f"{COMMON_NS}location")
+    form = package.find(f"{COMMON_NS}format")
+    header_range = form.find(f"{RPM_NS}header-range")
+
+    def text(parent, tag):
+        element = parent.find(tag)
+        return element.text if element is not None else None
+
+    def integer(element, attribute):
+        if element is None or element.get(attribute) is None:
+            return None
+        return int(element.get(attribute))
+
+    rows["packages"].append(
+        (
+            pkg_key,
+            checksum.text,
+            text(package, f"{COMMON_NS}name"),
+            text(package, f"{COMMON_NS}arch"),
+            version.get("ver"),
+            version.get("epoch"),
+            version.get("rel"),
+            text(package, f"{COMMON_NS}summary"),
+            text(package, f"{COMMON_NS}description"),
+            text(package, f"{COMMON_NS}url"),
+            integer(time, "file"),
+            integer(time, "build"),
+            text(form, f"{RPM_NS}license"),
+            text(form, f"{RPM_NS}vendor"),
+            text(form, f"{RPM_NS}group"),
+            text(form, f"{RPM_NS}buildhost"),
+            text(form, f"{RPM_NS}sourcerpm"),
+            integer(header_range, "start"),
+            integer(header_range, "end"),
+            text(package, f"{COMMON_NS}packager"),
+            integer(size, "package"),
+            integer(size, "installed"),
+            integer(size, "archive"),
+            location.get("href") if location is not None else None,
+            location.get("{http://www.w3.org/XML/1998/namespace}base")
+            if location is not None
+            else None,
+            checksum.get("type"),
+        )
+    )
+
+    for table in DEPENDENCIES:
+        entries = form.find(f"{RPM_NS}{table}")
+        if entries is None:
+            continue
+        for entry in entries:
+            row = (
+                entry.get("name"),
+                entry.get("flags"),
+                entry.get("epoch"),
+                entry.get("ver"),
+                entry.get("rel"),
+                pkg_key,
+            )
+            if table == "requires":
+                row += ("TRUE" if entry.get("pre") in ("1", "true") else "FALSE",)
+            rows[table].append(row)
+
+    for entry in form.iter(f"{COMMON_NS}file"):
+        rows["files"].append((entry.text, entry.get("type", "file"), pkg_key))
+
+
+def filelists_rows(package, pkg_key, rows):
+    """Append the rows of a filelists <package> to the lists in rows.
+
+    Files are grouped by directory like createrepo_c does: one row per
+    directory, file names joined with "/" and one type letter per file.
+    """
+    rows["packages"].append((pkg_key, package.get("pkgid")))
+    directories = {}
+    for entry in package.iter(f"{FILELISTS_NS}file"):
+        (dirname, _, filename) = entry.text.rpartition("/")
+        (filenames, filetypes) = directories.setdefault(dirname, ([], []))
+        filenames.append(filename)
+        filetypes.append(FILE_TYPES.get(entry.get("type", "file"), "f"))
+
+    for (dirname, (filenames, filetypes)) in directories.items():
+        rows["filelist"].append(
+            (pkg_key, dirname, "/".join(filenames), "".join(filetypes))
+        )
+
+
+def other_rows(package, pkg_key, rows):
+    """Append the rows of an other <package> to the lists in rows."""
+    rows["packages"].append((pkg_key, package.get("pkgid")))
+    for entry in package.iter(f"{OTHER_NS}changelog"):
+        rows["changelog"].append(
+            (pkg_key, entry.get("author"), int(entry.get("date")), entry.text)
+        )
+
+
+PARSERS = {
+    "primary": (COMMON_NS, primary_rows),
+    "filelists": (FILELISTS_NS, filelists_rows),
+    "other": (OTHER_NS, other_rows),
+}
+
+
+def build_db(xml_file, db_file, db_type, checksum=None, batch=2000):
+    """Create the db_type sqlite database db_file from its XML document.
+
+    checksum is stored in db_info like createrepo_c does. Returns the number
+    of packages.
+    """
+    (namespace, to_rows) = PARSERS[db_type]
+    conn = sqlite3.connect(db_file)
+    conn.executescript(SCHEMAS[db_type])
+    conn.execute("INSERT INTO db_info VALUES (?, ?)", (DB_VERSION, checksum))
+
+    tables = {
+        name: len(columns)
+        for (name, columns) in (
+            (row[0], conn.execute(f"PRAGMA table_info({row[0]})").fetchall())
+            for row in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'"
+                " AND name != 'db_info'"
+            ).fetchall()
+        )
+    }
+    rows = {table: [] for table in tables}
+
+    def flush():
+        for (table, values) in rows.items():
+            if values:
+                placeholders = ", ".join("?" * tables[table])
+                conn.executemany(f"INSERT INTO {table} VALUES ({placeholders})", values)
+                values.clear()
+
+    count = 0
+    for package in iter_packages(xml_file, namespace):
+        count += 1
+        to_rows(package, count, rows)
+        if count % batch == 0:
+            flush()
+    flush()
+
+    conn.executescript(INDEXES[db_type])
+    conn.commit()
+    conn.close()
+    return count
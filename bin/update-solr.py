@@ -6,14 +6,15 @@
 #   * branch: base (= none), updates, updates-testing
 #   * release_branch: fedora-31, fedora-31-updates, fedora-31-updates-testing, ...
 import os
-import re
-import sys
 import json
-import sqlite3
+import hashlib
 import requests
 import defusedxml
 import time
 
+import catalog
+from journal import Journal
+
 # This is used to encode xml, not parse it. Security warning is irrelevant.
 # defusedxml does not have an Element import and defuse_stdlib() is called anyway for caution's sake.
 from xml.etree.ElementTree import Element, tostring  # nosec
@@ -28,146 +29,50 @@ SCM_MAINTAINER_MAPPING = (
 PRODUCT_VERSION_MAPPING = (
     os.environ.get("PRODUCT_VERSION_MAPPING") or "product_version_mapping.json"
 )
+JOURNAL_CONSUMER = "solr"
 
 
-class Package:
-    def __init__(self, name):
-        self.name = name
-        self.summary = "No summary specified."
-        self.description = "No description specified."
-
-        self.license = "unknown"
-        self.upstream = ""
-        self.maintainers = []
-        self.releases = {}
-        self.source = ""
-
-    def set_release(self, name, pkgKey, branch, arch, revision, human_name=None):
-        if name not in self.releases:
-            self.releases[name] = {}
-
-        if "branches" not in self.releases[name]:
-            self.releases[name]["branches"] = {}
-
-        if branch not in self.releases[name]:
-            self.releases[name]["branches"][branch] = {}
-
-        self.releases[name]["branches"][branch]["revision"] = revision
-        self.releases[name]["branches"][branch]["pkg_key"] = pkgKey
-        self.releases[name]["branches"][branch]["arch"] = arch
-        self.releases[name]["human_name"] = human_name or name
-
-    def get_release(self, name):
-        return self.releases[name]["branches"]
-
-
-def open_db(db):
-    conn = sqlite3.connect(os.path.join(DBS_DIR, db))
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-
-    return (conn, c)
-
-
-def do_regex(pattern, string):
-    (result) = pattern.findall(string)[0]
-    return result
+def main():
+    journal = Journal(DBS_DIR)
+    try:
+        update_index(journal)
+    finally:
+        journal.close()
 
 
-def main():
+def update_index(journal):
     # Load maintainer mapping (imported from dist-git).
     # TODO: check that mapping exist / error.
     print("Loading maintainer mapping...")
-    with open(SCM_MAINTAINER_MAPPING) as raw:
-        maintainer_mapping = json.load(raw)
+    with open(SCM_MAINTAINER_MAPPING, "rb") as raw:
+        maintainer_data = raw.read()
+    maintainer_mapping = json.loads(maintainer_data)
 
     # Load product release->name mapping
     print("Loading release name mapping...")
-    with open(PRODUCT_VERSION_MAPPING) as raw:
-        release_mapping = json.load(raw)
-
-    # Group databases files.
-    databases = {}
-    db_pattern = re.compile(
-        "^(fedora|epel)-([\w|-]+)_(primary|filelists|other).sqlite$"
-    )
-    for db in os.listdir(DBS_DIR):
-        if not db_pattern.match(db):
-            sys.exit("Invalid object in {}: {}".format(DBS_DIR, db))
-
-        (product, branch, db_type) = db_pattern.findall(db)[0]
-        release_branch = "{}-{}".format(product, branch)
-        if release_branch in databases:
-            databases[release_branch][db_type] = db
-        else:
-            databases[release_branch] = {db_type: db}
+    with open(PRODUCT_VERSION_MAPPING, "rb") as raw:
+        release_data = raw.read()
+    release_mapping = json.loads(release_data)
+
+    # The index is rebuilt from scratch, so the journal and the digest of the
+    # mappings kept with our cursor only tell whether anything changed since
+    # our last successful run.
+    inputs = hashlib.sha256()
+    for data in (maintainer_data, release_data):
+        inputs.update(hashlib.sha256(data).digest())
+    inputs = inputs.hexdigest()
+    (journal_seq, entries) = journal.pending(JOURNAL_CONSUMER)
+    unchanged = journal.inputs(JOURNAL_CONSUMER) == inputs
+    if entries is not None and len(entries) == 0 and unchanged:
+        print("No package or mapping changes since the last Solr update.")
+        return
 
     # Build internal package metadata structure / cache.
     # { "src_pkg": { "subpackage": pkg, ... } }
-    packages = {}
-    packages_count = 0
-    srpm_pattern = re.compile("^(.+)-.+-.+.src.rpm$")
-    changelog_mail_pattern = re.compile("<(.+@.+)>")
-    release_branch_pattern = re.compile("^([fedora|epel]+-[\w|\d]+)-?([a-z|-]+)?$")
-    for release_branch in databases.keys():
-        print("> Processing database files for {}.".format(release_branch))
-
-        for db_type in ["primary", "filelists", "other"]:
-            if db_type not in databases[release_branch]:
-                sys.exit("No {} database for {}.".format(db_type, release_branch))
-
-        (_, primary) = open_db(databases[release_branch]["primary"])
-        (_, filelist) = open_db(databases[release_branch]["filelists"])
-        (_, other) = open_db(databases[release_branch]["other"])
-
-        for raw in primary.execute("SELECT * FROM packages"):
-            # Get source rpm name
-            srpm_name = do_regex(srpm_pattern, raw["rpm_sourcerpm"])
-
-            # Check if package is already data structure
-            src_pkg = packages.get(srpm_name)
-            if src_pkg:
-                pkg = src_pkg.get(raw["name"])
-            else:
-                pkg = None
-            revision = "{}-{}".format(raw["version"], raw["release"])
-            first_pkg_encounter = False
-
-            # Register unknown packages.
-            if pkg == None:
-                pkg = Package(raw["name"])
-                if not srpm_name in packages:
-                    packages[srpm_name] = {}
-                packages[srpm_name][pkg.name] = pkg
-                first_pkg_encounter = True
-                pkg.source = srpm_name
-                packages_count += 1
-
-            # Override package metadata with rawhide (= lastest) values.
-            if first_pkg_encounter or release_branch == "rawhide":
-                pkg.summary = raw["summary"]
-                pkg.description = raw["description"]
-                pkg.upstream = raw["url"]
-                pkg.license = raw["rpm_license"]
-                pkg.maintainers = maintainer_mapping["rpms"].get(srpm_name, [])
-
-            # XXX: we do not resolve files and changelog here because storing
-            # them in the packages hash would require multiple GBs of RAM
-            # (roughly 1GB per repository).
-
-            # Always register branch-specific metadata.
-            (release, branch) = release_branch_pattern.findall(release_branch)[0]
-            if branch == "":
-                branch = "base"
-
-            pkg.set_release(
-                release,
-                raw["pkgKey"],
-                branch,
-                raw["arch"],
-                revision,
-                release_mapping.get(release),
-            )
+    databases = catalog.group_databases(DBS_DIR, release_mapping)
+    package_catalog = catalog.load(DBS_DIR, databases, journal)
+    packages = package_catalog.packages(release_mapping, maintainer_mapping)
+    packages_count = sum(len(subpackages) for subpackages in packages.values())
 
     print(">>> {} packages have been extracted.".format(packages_count))
 
@@ -240,6 +145,8 @@ def main():
     )
     req.raise_for_status()
 
+    journal.advance(JOURNAL_CONSUMER, journal_seq, inputs)
+
     print("DONE.")
     print("> {} packages submitted to solr.".format(packages_count))
 
@@ -0,0 +1,199 @@
+#
+# Minimal reader of the zchunk format Fedora publishes repository metadata in.
+#
+# Only what a delta download needs: parsing and verifying the header, listing
+# the chunks with their checksums and decompressing them. The format is
+# described in zchunk_format.txt of https://github.com/zchunk/zchunk.
+import hashlib
+
+from collections import namedtuple
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MAGIC = b"\0ZCK1"
+
+# Checksum types as (hashlib name, digest length). sha512_128 is a sha512
+# digest truncated to 16 bytes.
+HASH_TYPES = {
+    0: ("sha1", 20),
+    1: ("sha256", 32),
+    2: ("sha512", 64),
+    3: ("sha512", 16),
+}
+
+COMPRESSION_NONE = 0
+COMPRESSION_ZSTD = 2
+
+FLAG_STREAMS = 1
+FLAG_OPTIONAL_ELEMENTS = 2
+FLAG_UNCOMPRESSED_CHECKSUMS = 4
+
+# Longest possible lead: magic, two compressed integers and a sha512 digest.
+MAX_LEAD_SIZE = len(MAGIC) + 10 + 10 + 64
+
+# A chunk of a zchunk file. offset and length locate its compressed data in
+# the file, size is its uncompressed size and digest the checksum of the
+# compressed data.
+Chunk = namedtuple("Chunk", ["digest", "offset", "length", "size"])
+
+# Parsed zchunk header. size is the length of the whole header, which is
+# where the first chunk starts. chunks[0] is the compression dictionary,
+# possibly empty.
+Header = namedtuple(
+    "Header",
+    ["hash_type", "digest", "size", "compression", "chunk_hash_type", "chunks"],
+)
+
+
+class ZchunkError(Exception):
+    """Data is not a valid zchunk file."""
+
+
+def read_int(data, pos):
+    """Decode the compressed integer at data[pos], return (value, next pos).
+
+    Compressed integers are little endian, 7 bits per byte, and the high
+    bit marks the last byte.
+    """
+    value = 0
+    shift = 0
+    while True:
+        if pos >= len(data):
+            raise ZchunkError("Truncated integer")
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            return (value, pos)
+        shift += 7
+
+
+def hash_type(code):
+    try:
+        return HASH_TYPES[code]
+    except KeyError:
+        raise ZchunkError(f"Unknown checksum type {code}") from None
+
+
+def new_hash(code):
+    return hashlib.new(hash_type(code)[0])
+
+
+def chunk_digest(code, data):
+    """Checksum of data with the given zchunk checksum type."""
+    checksum = new_hash(code)
+    checksum.update(data)
+    return checksum.digest()[: hash_type(code)[1]]
+
+
+def header_size(lead):
+    """Return the size of the header from the first bytes of a file.
+
+    lead must hold at least min(MAX_LEAD_SIZE, file size) bytes.
+    """
+    (_, size, _, _) = parse_lead(lead)
+    return size
+
+
+def parse_lead(data):
+    """Return (hash type, header size, digest, digest offset) of the lead."""
+    if not data.startswith(MAGIC):
+        raise ZchunkError("Not a zchunk file")
+
+    (code, pos) = read_int(data, len(MAGIC))
+    (length, pos) = read_int(data, pos)
+    digest_size = hash_type(code)[1]
+    if len(data) < pos + digest_size:
+        raise ZchunkError("Truncated lead")
+    return (code, pos + digest_size + length, data[pos : pos + digest_size], pos)
+
+
+def parse_header(data):
+    """Parse and verify the header at the start of data.
+
+    Raises ZchunkError if data is not a zchunk header or does not match its
+    checksum.
+    """
+    (code, size, header_digest, digest_pos) = parse_lead(data)
+    if len(data) < size:
+        raise ZchunkError(f"Truncated header ({len(data)} of {size} bytes)")
+
+    digest_size = hash_type(code)[1]
+    checksum = new_hash(code)
+    checksum.update(data[:digest_pos])
+    checksum.update(data[digest_pos + digest_size : size])
+    if checksum.digest()[:digest_size] != header_digest:
+        raise ZchunkError("Header checksum mismatch")
+
+    # Preface: data checksum, flags, compression, optional elements.
+    pos = digest_pos + digest_size + digest_size
+    (flags, pos) = read_int(data, pos)
+    (compression, pos) = read_int(data, pos)
+    if flags & FLAG_OPTIONAL_ELEMENTS:
+        (count, pos) = read_int(data, pos)
+        for _ in range(count):
+            (_, pos) = read_int(data, pos)
+            (length, pos) = read_int(data, pos)
+            pos += length
+
+    # Index: every chunk, the dictionary first, in file order.
+    (_, pos) = read_int(data, pos)
+    (chunk_hash_type, pos) = read_int(data, pos)
+    (count, pos) = read_int(data, pos)
+    chunk_digest_size = hash_type(chunk_hash_type)[1]
+    chunks = []
+    offset = size
+    for _ in range(count):
+        if flags & FLAG_STREAMS:
+            (_, pos) = read_int(data, pos)
+        checksum = data[pos : pos + chunk_digest_size]
+        pos += chunk_digest_size
+        if flags & FLAG_UNCOMPRESSED_CHECKSUMS:
+            pos += chunk_digest_size
+        (length, pos) = read_int(data, pos)
+        (uncompressed, pos) = read_int(data, pos)
+        chunks.append(Chunk(checksum, offset, length, uncompressed))
+        offset += length
+
+    if not chunks:
+        raise ZchunkError("No dictionary chunk")
+    return Header(code, header_digest, size, compression, chunk_hash_type, chunks)
+
+
+def read_header(path):
+    """Parse the header of the zchunk file at path."""
+    with open(path, "rb") as fh:
+        lead = fh.read(MAX_LEAD_SIZE)
+        size = header_size(lead)
+        return parse_header(lead + fh.read(max(size - len(lead), 0)))
+
+
+class Decompressor:
+    """Decompress the chunks of a file described by header, in any order."""
+
+    def __init__(self, header, dictionary):
+        self.compression = header.compression
+        if self.compression == COMPRESSION_NONE:
+            return
+        if self.compression != COMPRESSION_ZSTD:
+            raise ZchunkError(f"Unknown compression type {self.compression}")
+        if zstandard is None:
+            raise NotImplementedError("zchunk (python3-zstandard is missing)")
+
+        if dictionary:
+            dictionary = zstandard.ZstdDecompressor().decompressobj().decompress(
+                dictionary
+            )
+            self.context = zstandard.ZstdDecompressor(
+                dict_data=zstandard.ZstdCompressionDict(dictionary)
+            )
+        else:
+            self.context = zstandard.ZstdDecompressor()
+
+    def decompress(self, data):
+        if self.compression == COMPRESSION_NONE or not data:
+            return data
+        return self.context.decompressobj().decompress(data)
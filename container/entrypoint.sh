@@ -5,5 +5,11 @@ INIT_FILE=.init_complete
 if [[ ! -f "$INIT_FILE" ]]; then
   mkdir -p /var/run/supervisor
 fi
+CACHE_CONF=/etc/nginx/cache-${CACHE_MODE:-revalidate}.conf
+if [[ ! -f "$CACHE_CONF" ]]; then
+  echo "Unknown CACHE_MODE: $CACHE_MODE"
+  exit 1
+fi
+ln -sf "$CACHE_CONF" /etc/nginx/packages-cache.conf
 echo "Starting web server..."
 supervisord -c /etc/supervisord.conf
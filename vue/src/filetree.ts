@@ -0,0 +1,19 @@
+import Vue from "vue";
+import FileTree from "./FileTree.vue";
+
+function init(): void {
+    const element = document.getElementById("file-tree");
+    if (!element || !element.dataset.src) {
+        console.error("Could not find the file tree!");
+        return;
+    }
+    const src = element.dataset.src;
+    const count = Number(element.dataset.count);
+
+    new Vue({
+        el: element,
+        render: (h) => h(FileTree, { props: { src, count } })
+    });
+}
+
+init();
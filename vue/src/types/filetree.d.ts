@@ -0,0 +1,3 @@
+// A file is its name, a directory a [name, content] pair. Entries are
+// sorted by name, see file_tree_fragment() in bin/generate-html.py.
+export type FileTreeEntry = string | [string, FileTreeEntry[]];
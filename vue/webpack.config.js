@@ -5,7 +5,10 @@ const ForkTsCheckerWebpackPlugin = require("fork-ts-checker-webpack-plugin");
 module.exports = {
   mode: "development",
   devtool: "source-map",
-  entry: "./src/index.ts",
+  entry: {
+    main: "./src/index.ts",
+    filetree: "./src/filetree.ts"
+  },
   module: {
     rules: [
       {